@@ -0,0 +1,213 @@
+""" Benchmarks of the moseq2-env orchestration layer.
+
+Everything runs against stand-ins: a stub singularity and moseq2-extract
+on PATH, and a local HTTP server in place of the release API. The numbers
+therefore measure moseq2-env itself, not the container or the network.
+Results are written as JSON, so runs of different commits can be compared:
+
+    python benchmarks/run_benchmarks.py -o before.json
+    git checkout <other commit>
+    python benchmarks/run_benchmarks.py -o after.json --compare before.json
+"""
+import argparse, contextlib, io, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from fakes import installFakeRuntime, startReleaseServer, stopReleaseServer, makeSessions
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+#end benchmark()
+
+def summarize(samples, **extra):
+    """ Summary of the timed runs of a benchmark, in seconds. """
+    result = {'samples': samples, 'min': min(samples), 'median': statistics.median(samples),
+        'mean': statistics.mean(samples)}
+    result.update(extra)
+    return result
+#end summarize()
+
+def timeRuns(fn, repeat, setup=None):
+    """ Times repeat calls of fn, running setup untimed before each one.
+
+    :rtype: List of seconds.
+    """
+    samples = []
+    for i in range(repeat):
+        state = setup(i) if setup is not None else None
+        start = time.perf_counter()
+        fn(state)
+        samples.append(time.perf_counter() - start)
+    return samples
+#end timeRuns()
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+#end quiet()
+
+@benchmark('cli_startup')
+def benchCliStartup(workDir, scale, repeat):
+    """ Wall time of moseq2-env --help in a fresh interpreter. """
+    command = [sys.executable, '-m', 'moseq2_build.cli', '--help']
+    samples = timeRuns(lambda s: subprocess.run(command, stdout=subprocess.DEVNULL, check=True, cwd=ROOT), repeat)
+    return summarize(samples)
+#end benchCliStartup()
+
+@benchmark('mount_planning')
+def benchMountPlanning(workDir, scale, repeat):
+    """ Planning the bind mounts of a command with many input paths, with
+    and without a cached plan.
+    """
+    from moseq2_build.utils.constants import EXTRACT_TABLE
+    from moseq2_build.utils.mount import mountDirectories, clearMountPlans
+
+    count = int(5000 * scale)
+    paths = [os.path.join(workDir, 'data', 'rig_{}'.format(i % 20), 'session_{}'.format(i), 'depth.dat')
+        for i in range(count)]
+    for path in paths[:200]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    remainder = ['extract', paths[0], '--output-dir', os.path.join(workDir, 'out')]
+    plan = lambda s: mountDirectories(remainder, '-B', EXTRACT_TABLE['extract'], extraPaths=paths)
+    cold = timeRuns(plan, repeat, setup=lambda i: clearMountPlans())
+    warm = timeRuns(plan, repeat)
+    return summarize(cold, paths=count, binds=plan(None).count('-B '), warmMedian=statistics.median(warm))
+#end benchMountPlanning()
+
+@benchmark('batch_script')
+def benchBatchScript(workDir, scale, repeat):
+    """ Describing the jobs of a large batch and rendering its run_batch.sh. """
+    from moseq2_build.utils.constants import SINGULARITY_COMS
+    from moseq2_build.auto.submit import describeJobs, SlurmBackend
+
+    count = int(2000 * scale)
+    sessions = makeSessions(os.path.join(workDir, 'batch'), [16] * count)
+    resources = {'cpus': 2, 'mem': 8, 'time': '2:00:00'}
+    backend = SlurmBackend(os.path.join(workDir, 'batch_out'), concurrency=100, timeout=3600)
+    def render(s):
+        jobs = describeJobs('/images/moseq2.sif', sessions, ['extract'], SINGULARITY_COMS, 1, resources)
+        return backend.writeScript(jobs)
+    samples = timeRuns(render, repeat)
+    return summarize(samples, sessions=count, scriptBytes=os.path.getsize(render(None)))
+#end benchBatchScript()
+
+@benchmark('download')
+def benchDownload(workDir, scale, repeat):
+    """ Downloading, verifying and unpacking a release asset from a local
+    server, in parallel byte ranges.
+    """
+    from moseq2_build.utils.release import downloadAssets
+
+    server = startReleaseServer(dockerSize=1, singularitySize=int(64 * 1024 * 1024 * scale))
+    try:
+        size = server.release['assets'][1]['size']
+        def setup(i):
+            out = os.path.join(workDir, 'download_{}'.format(i))
+            os.makedirs(out)
+            return out
+        def download(out):
+            with quiet():
+                downloadAssets(None, None, [1], out, None, baseUrl=server.url)
+        samples = timeRuns(download, repeat, setup=setup)
+    finally:
+        stopReleaseServer(server)
+    return summarize(samples, bytes=size, megabytesPerSecond=size / 1024.0 ** 2 / statistics.median(samples))
+#end benchDownload()
+
+@benchmark('schedule')
+def benchSchedule(workDir, scale, repeat):
+    """ Overhead of extracting many sessions concurrently when every
+    extraction returns at once.
+    """
+    from moseq2_build.utils.constants import SINGULARITY_COMS
+    from moseq2_build.auto.schedule import scheduleExtractions
+
+    count, workers = max(4, int(64 * scale)), 8
+    binDir, image = installFakeRuntime(os.path.join(workDir, 'runtime'))
+    sessions = makeSessions(os.path.join(workDir, 'schedule'), [16] * count)
+    path = os.environ['PATH']
+    os.environ['PATH'] = binDir + os.pathsep + path
+    try:
+        run = lambda s: scheduleExtractions(image, sessions, ['extract'], SINGULARITY_COMS, workers=workers, verbose=False)
+        samples = timeRuns(run, repeat)
+    finally:
+        os.environ['PATH'] = path
+    median = statistics.median(samples)
+    return summarize(samples, sessions=count, workers=workers, secondsPerSession=median * workers / count)
+#end benchSchedule()
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+#end gitCommit()
+
+def runBenchmarks(names=None, scale=1.0, repeat=5):
+    """ Runs the named benchmarks, all of them if names is None.
+
+    :type scale: Float
+    :param scale: Factor applied to the problem sizes, e.g. 0.01 for a smoke run.
+
+    :rtype: Dictionary with the environment and the result of every benchmark.
+    """
+    results = {}
+    for name in names or list(BENCHMARKS):
+        workDir = tempfile.mkdtemp(prefix='moseq2-bench-')
+        try:
+            results[name] = BENCHMARKS[name](workDir, scale, repeat)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+    return {'commit': gitCommit(), 'created': time.time(), 'python': platform.python_version(),
+        'platform': platform.platform(), 'cpus': os.cpu_count(), 'scale': scale, 'repeat': repeat,
+        'benchmarks': results}
+#end runBenchmarks()
+
+def compareResults(previous, current):
+    """ Lines comparing the medians of two runs; ratios below 1 are speedups. """
+    lines = []
+    if previous.get('scale') != current.get('scale'):
+        lines.append('Note: the runs used different scales ({} and {})'.format(previous.get('scale'), current.get('scale')))
+    for name, result in current['benchmarks'].items():
+        before = previous['benchmarks'].get(name)
+        if before is None:
+            lines.append('{:<16} {:>10.4f}s  (new)'.format(name, result['median']))
+            continue
+        lines.append('{:<16} {:>10.4f}s -> {:>10.4f}s  x{:.2f}'.format(name, before['median'], result['median'],
+            result['median'] / before['median']))
+    return lines
+#end compareResults()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the moseq2-env orchestration layer.')
+    parser.add_argument('-o', '--output', default='benchmarks.json', help='File the results are written to.')
+    parser.add_argument('-b', '--benchmark', action='append', choices=sorted(BENCHMARKS),
+        help='Benchmark to run, can be given several times. All of them by default.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of every benchmark.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Factor applied to the problem sizes.')
+    parser.add_argument('--compare', help='Results of an earlier run to compare against.')
+    args = parser.parse_args(argv)
+
+    report = runBenchmarks(args.benchmark, args.scale, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            lines = compareResults(json.load(f), report)
+    else:
+        lines = ['{:<16} {:>10.4f}s'.format(name, r['median']) for name, r in report['benchmarks'].items()]
+    print('\n'.join(lines))
+    return 0
+#end main()
+
+if __name__ == '__main__':
+    sys.exit(main())
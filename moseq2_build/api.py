@@ -0,0 +1,271 @@
+""" Python API for running the containerized pipeline from a long-lived process.
+
+Unlike the CLI, nothing here prints or exits: invalid arguments raise
+ValueError, every call returns a RunResult describing the outcome, and the
+helpers shared with the CLI leave printing to it. A Runner can be used
+from several threads, or from asyncio through the *Async methods, at the
+same time. The async methods run their containers directly on the event
+loop, so many of them can be multiplexed in one thread.
+
+    runner = Runner('moseq2.sif')
+    result = runner.generateConfig('config.yaml')
+    results = runner.extractSessions(['data/session_*'], ['--config-file', 'config.yaml'], workers=4)
+"""
+import asyncio, functools, glob, os, time
+
+from moseq2_build.utils.constants import getDefaultImage, DEFAULT_FLIP_PATH
+
+class RunResult(object):
+    """ Outcome of one containerized command.
+
+    :type returnCode: Integer
+    :param returnCode: Exit code of the command.
+
+    :type command: String
+    :param command: Command line that was executed.
+
+    :type started: Float
+    :param started: Time the command was started, in seconds since the epoch.
+
+    :type elapsed: Float
+    :param elapsed: Run time in seconds.
+
+    :type stdout: String
+    :param stdout: Captured standard output, or the log of a session extraction.
+
+    :type stderr: String
+    :param stderr: Captured standard error, or why a session extraction could not run.
+
+    :type outputPaths: List of Strings
+    :param outputPaths: Files and folders the command writes its results to.
+
+    :type log: String
+    :param log: Log file of the command, if it was written to one.
+    """
+    def __init__(self, returnCode, command, started, elapsed, stdout='', stderr='', outputPaths=(),
+            log=None, skipped=False):
+        self.returnCode = returnCode
+        self.command = command
+        self.started = started
+        self.elapsed = elapsed
+        self.stdout = stdout
+        self.stderr = stderr
+        self.outputPaths = list(outputPaths)
+        self.log = log
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        return self.returnCode == 0
+
+    def asDict(self):
+        return {'returnCode': self.returnCode, 'command': self.command, 'started': self.started,
+            'elapsed': self.elapsed, 'stdout': self.stdout, 'stderr': self.stderr,
+            'outputPaths': self.outputPaths, 'log': self.log, 'skipped': self.skipped}
+
+    def __repr__(self):
+        return 'RunResult(returnCode={}, elapsed={:.1f}, outputPaths={})'.format(self.returnCode,
+            self.elapsed, self.outputPaths)
+#end RunResult
+
+def containerCommands(image, instance=None, runtime=None, cpus=None, memoryGB=None):
+    """ Determines the container command table for the passed in image.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :type instance: String
+    :param instance: Name of a warm instance the commands are sent to.
+
+    :type runtime: String
+    :param runtime: Container runtime to use, picked from the image and
+    the installed runtimes when None or 'auto'.
+
+    :type cpus: Float
+    :param cpus: CPUs a container may use, for runtimes that limit them.
+
+    :type memoryGB: Float
+    :param memoryGB: Memory in GB a container may use, for runtimes that limit it.
+
+    :rtype: Dictionary
+    """
+    from moseq2_build.utils.instance import instanceCommands, isRunning
+    from moseq2_build.utils.runtimes import selectDriver
+
+    if image is None:
+        raise ValueError('No valid image path was passed in')
+    driver = selectDriver(image, runtime)
+    if instance is not None:
+        if not driver.supportsInstances:
+            raise ValueError('Warm instances are not supported with {}'.format(driver.name))
+        if not isRunning(instance):
+            raise ValueError('Instance {} is not running'.format(instance))
+        return instanceCommands(instance)
+    try:
+        return driver.commands(image, cpus, memoryGB)
+    except RuntimeError as e:
+        raise ValueError(str(e))
+#end containerCommands()
+
+class Runner(object):
+    """ Runs moseq2-extract in containers without any CLI side effects.
+    A Runner holds no per-call state, so one instance can serve many
+    concurrent calls.
+
+    :type image: String
+    :param image: Path to the image file, the default image if None.
+
+    :type flipPath: String
+    :param flipPath: Flip classifier written into generated configs.
+
+    :type instance: String
+    :param instance: Name of a warm instance the commands are sent to.
+
+    :type runtime: String
+    :param runtime: Container runtime, picked automatically when None.
+
+    :type cpus: Float
+    :param cpus: CPUs every container may use (docker and podman only).
+
+    :type memoryGB: Float
+    :param memoryGB: Memory in GB every container may use (docker and podman only).
+    """
+    def __init__(self, image=None, flipPath=DEFAULT_FLIP_PATH, instance=None, runtime=None, cpus=None, memoryGB=None):
+        self.image = image if image is not None else getDefaultImage()
+        self.flipPath = flipPath
+        self.instance = instance
+        self.command = containerCommands(self.image, instance, runtime, cpus, memoryGB)
+
+    def _buildCommand(self, remainder, extraPaths=()):
+        from moseq2_build.auto.extract import buildExtractCommand
+        try:
+            return buildExtractCommand(self.image, remainder, self.command, extraPaths=extraPaths)
+        except ValueError:
+            raise ValueError('Every option needs a value: {}'.format(' '.join(remainder)))
+
+    async def _runAsync(self, finalCommand, cwd=None, outputPaths=(), timeout=None):
+        from moseq2_build.utils.execution import runCommandAsync
+        started = time.time()
+        (stdout, stderr), retCode = await runCommandAsync(finalCommand, cwd=cwd, timeout=timeout)
+        return RunResult(retCode, finalCommand, started, time.time() - started,
+            stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace'), outputPaths)
+
+    def _prepareExtract(self, remainder, cwd=None):
+        from moseq2_build.auto.manifest import sessionOutputDir
+        remainder = list(remainder)
+        extraPaths = [cwd] if cwd is not None else []
+        outputPaths = []
+        if len(remainder) > 1 and remainder[0] == 'extract':
+            session = os.path.join(cwd or os.getcwd(), remainder[1])
+            outputPaths.append(sessionOutputDir(session, remainder))
+        return self._buildCommand(remainder, extraPaths), outputPaths
+
+    async def extractAsync(self, remainder, cwd=None, timeout=None):
+        """ Runs moseq2-extract with the given arguments, e.g.
+        ['extract', 'depth.dat', '--config-file', 'config.yaml'].
+        Cancelling the task terminates the container.
+
+        :type remainder: List of Strings
+        :param remainder: Arguments passed through to moseq2-extract.
+
+        :type cwd: String
+        :param cwd: Folder the command runs in; it is mounted into the
+        container. Paths in remainder should be absolute when it is given.
+
+        :type timeout: Float
+        :param timeout: Seconds after which the container is terminated; the
+        result then has the return code TIMEOUT_RETURN_CODE.
+
+        :rtype: RunResult
+        """
+        finalCommand, outputPaths = self._prepareExtract(remainder, cwd)
+        return await self._runAsync(finalCommand, cwd, outputPaths, timeout)
+
+    def extract(self, remainder, cwd=None, timeout=None):
+        """ Synchronous version of extractAsync. """
+        return asyncio.run(self.extractAsync(remainder, cwd, timeout))
+
+    async def generateConfigAsync(self, configPath='config.yaml', cwd=None, timeout=None):
+        """ Generates a moseq2-extract config file containing the flip
+        classifier of this Runner.
+
+        :type configPath: String
+        :param configPath: Location of the config file, relative to cwd.
+
+        :rtype: RunResult
+        """
+        from moseq2_build.auto.extract import placeClassifierInYaml
+        configPath = os.path.join(cwd or os.getcwd(), configPath)
+        remainder = ['generate-config', '--output-file', configPath]
+        result = await self._runAsync(self._buildCommand(remainder), cwd, [configPath], timeout)
+        if result.ok:
+            placeClassifierInYaml(configPath, self.flipPath)
+        return result
+
+    def generateConfig(self, configPath='config.yaml', cwd=None, timeout=None):
+        """ Synchronous version of generateConfigAsync. """
+        return asyncio.run(self.generateConfigAsync(configPath, cwd, timeout))
+
+    def extractSessions(self, sessions, remainder=(), workers=None, memPerSession=None,
+            incremental=False, useHash=False, scratchDir=None, timeout=None, retries=0, journalPath=None,
+            resume=False):
+        """ Extracts several sessions at the same time, each in its own
+        container. The output of every session is logged next to its data.
+
+        :type sessions: List of Strings
+        :param sessions: Session directories, depth files or glob patterns.
+
+        :type remainder: List of Strings
+        :param remainder: Arguments passed through to moseq2-extract extract.
+
+        :type scratchDir: String
+        :param scratchDir: When given, sessions are staged to this node-local
+        folder before they are extracted.
+
+        :type timeout: Float
+        :param timeout: Seconds after which a single extraction is terminated.
+
+        :type retries: Integer
+        :param retries: Retries of an extraction whose container failed to start or was killed.
+
+        :type journalPath: String
+        :param journalPath: Journal recording the state of every session.
+
+        :type resume: Boolean
+        :param resume: Skip the sessions the journal shows as finished.
+
+        :rtype: List of RunResults, one per session.
+        """
+        from moseq2_build.auto.schedule import findSessionInput, findSessions, scheduleExtractions
+        from moseq2_build.auto.manifest import sessionOutputDir
+        from moseq2_build.auto.journal import RunJournal
+        missing = [s for s in sessions if not glob.has_magic(s) and findSessionInput(s) is None]
+        if len(missing) != 0:
+            raise ValueError('No session data found in {}'.format(', '.join(missing)))
+        from moseq2_build.auto.staging import Stager
+        # Folders matched by a pattern without session data are left out
+        sessionInputs = findSessions(sessions, missing=[])
+        started = time.time()
+        stager = Stager(scratchDir) if scratchDir is not None else None
+        records = scheduleExtractions(self.image, sessionInputs, list(remainder), self.command,
+            workers=workers, memPerSession=memPerSession, incremental=incremental, useHash=useHash,
+            verbose=False, stager=stager, timeout=timeout, retries=retries,
+            journal=RunJournal(journalPath) if journalPath is not None else None, resume=resume)
+        results = []
+        for record in records:
+            log = record['log']
+            output = ''
+            if not record['skipped'] and os.path.isfile(log):
+                with open(log, 'r', errors='replace') as f:
+                    output = f.read()
+            args = ['extract', record['session']] + list(remainder)
+            results.append(RunResult(record['returnCode'], 'moseq2-extract ' + ' '.join(args), started,
+                record['elapsed'], output, record.get('error', ''), [sessionOutputDir(record['session'], args)], log,
+                record['skipped']))
+        return results
+
+    async def extractSessionsAsync(self, sessions, remainder=(), **kwargs):
+        """ Awaitable version of extractSessions, run in the default executor. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.extractSessions, sessions, remainder, **kwargs))
+#end Runner
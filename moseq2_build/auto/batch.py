@@ -1,52 +1,219 @@
 import os
 from termcolor import colored
 
-from moseq2_build.utils.constants import BATCH_TABLE
+from moseq2_build.utils.constants import BATCH_TABLE, BATCH_ONLY_OPTIONS, CLUSTER_TYPES, BATCH_JOBS_NAME, JOURNAL_NAME, FAILURE_REPORT_NAME, RETRY_BACKOFF_SECONDS
 from moseq2_build.utils.mount import mountDirectories
-from moseq2_build.utils.commands import executeCommand, printSuccessMessage, panicIfStderr
+from moseq2_build.utils.commands import executeCommand, printSuccessMessage, printErrorMessage, panicIfStderr, buildContainerCommand
+from moseq2_build.utils.resources import getCpuCount
+from moseq2_build.utils.admission import AdmissionController, footprintRuntime
+from moseq2_build.utils.profiling import NoProfile
+from moseq2_build.utils.prewarm import prewarmImage
 
-from moseq2_build.auto.extract import placeClassifierInYaml
+from moseq2_build.auto.configs import ConfigTemplate, cachedConfigTemplate, loadRigOverrides, writeSessionConfigs
+from moseq2_build.auto.submit import findBatchSessions, describeJobs, writeJobDescriptions, LocalBackend, SlurmBackend
+from moseq2_build.auto.schedule import sessionRemainder
+from moseq2_build.auto.manifest import filterChangedSessions
+from moseq2_build.auto.journal import RunJournal, writeFailureReport
 
-def doBatch(image, flip_path, batch_output, remainder, command):
-    mountCommand = mountDirectories(remainder, command['mount'], BATCH_TABLE['batch'])
+def parseBatchArgs(remainder):
+    """ Splits the arguments of an extract-batch call into the options
+    handled here and the ones passed through to moseq2-extract extract.
+    The cluster type is given with --cluster-type, or as the first
+    argument after extract-batch.
+
+    :type remainder: List of Strings
+    :param remainder: Arguments given after the batch command.
+
+    :rtype: Tuple of a Dictionary with the input dir, config file, depth
+    file name and cluster type, and a List of the remaining arguments.
+    Raises ValueError on options of moseq2-batch that moseq2-extract
+    does not know, see BATCH_ONLY_OPTIONS.
+    """
+    options = {'inputDir': os.getcwd(), 'configFile': None, 'filename': 'depth.dat', 'clusterType': 'local'}
+    keys = {'-i': 'inputDir', '--input-dir': 'inputDir', '-c': 'configFile', '--config-file': 'configFile',
+        '--filename': 'filename', '--cluster-type': 'clusterType'}
+    remainder = list(remainder)
+    if len(remainder) != 0 and remainder[0] == 'extract-batch':
+        remainder = remainder[1:]
+    if len(remainder) != 0 and remainder[0] in CLUSTER_TYPES:
+        options['clusterType'] = remainder[0]
+        remainder = remainder[1:]
+    extra = []
+    i = 0
+    while i < len(remainder):
+        arg = remainder[i]
+        name = arg.split('=', 1)[0]
+        if name in BATCH_ONLY_OPTIONS:
+            replacement = BATCH_ONLY_OPTIONS[name]
+            raise ValueError('{} of moseq2-batch is not supported{}.'.format(name,
+                ', use {} of the batch command instead'.format(replacement) if replacement is not None else ''))
+        if arg in keys:
+            if i + 1 >= len(remainder):
+                raise ValueError('Please make sure each parameter has a valid value.')
+            options[keys[arg]] = remainder[i + 1]
+            i += 2
+            continue
+        extra.append(arg)
+        i += 1
+    if options['clusterType'] not in CLUSTER_TYPES:
+        raise ValueError('Unknown cluster type {}, use one of {}.'.format(options['clusterType'], ', '.join(CLUSTER_TYPES)))
+    return options, extra
+#end parseBatchArgs()
+
+def doExtractBatch(image, batch_output, remainder, command, configFile, sessionsPerJob=1,
+        concurrency=None, resources=None, submit=False, wait=False, incremental=False, useHash=False,
+        prewarm=False, rigOverrides=None, timeout=None, retries=0, backoff=RETRY_BACKOFF_SECONDS, journalPath=None,
+        resume=False, admit=True):
+    """ Extracts every session below the input dir, either with a local
+    process pool or as a Slurm job array. When incremental, sessions
+    whose manifest shows nothing changed are left out. With prewarm, the
+    image is read into the page cache of every node before extracting.
+    With rigOverrides, every session gets its own config, written next
+    to its input from the batch config and the matching overrides.
+    Extractions running longer than timeout seconds are terminated.
+
+    Local runs retry transient failures up to retries times, go on past
+    failed sessions and record the state of every session in a journal
+    (journalPath, or JOURNAL_NAME in batch_output). With resume, only the
+    sessions the journal does not show as finished are extracted. Slurm
+    tasks commit their session manifests themselves, so there resume
+    skips the sessions whose manifest is up to date. With admit, local
+    extractions start only once they fit into the memory of the node,
+    with concurrency as the ceiling.
+    """
+    try:
+        options, extra = parseBatchArgs(remainder)
+    except ValueError as e:
+        printErrorMessage('{}\n'.format(e))
+        exit(1)
+    local = options['clusterType'] != 'slurm'
+    if resume and not local:
+        incremental = True
+    configFile = options['configFile'] or configFile
+    sessions = findBatchSessions(options['inputDir'], options['filename'])
+    if len(sessions) == 0:
+        printErrorMessage('No sessions with a {} found in {}\n'.format(options['filename'], options['inputDir']))
+        exit(1)
+
+    extractArgs = ['extract'] + extra
+    if configFile is not None:
+        extractArgs += ['--config-file', os.path.abspath(configFile)]
+    sessionArgs = None
+    if rigOverrides is not None:
+        template = ConfigTemplate.load(configFile) if configFile is not None else cachedConfigTemplate(image, command)
+        configs = writeSessionConfigs(template, sessions, rigOverrides=loadRigOverrides(rigOverrides))
+        sessionArgs = {s: ['extract'] + extra + ['--config-file', configs[s]] for s in sessions}
+    argsFor = lambda s: sessionArgs[s] if sessionArgs is not None else extractArgs
+    journal = RunJournal(journalPath or os.path.join(batch_output, JOURNAL_NAME)) if local else None
+    if resume and local:
+        finished = len(sessions)
+        sessions = journal.unfinished(sessions)
+        print(colored('Resuming: {} sessions already finished\n'.format(finished - len(sessions)), 'white', attrs=['bold']))
+        if len(sessions) == 0:
+            printSuccessMessage('All sessions are finished\n')
+            return
+    fingerprints = None
+    if incremental:
+        sessions, skipped, fingerprints = filterChangedSessions(sessions,
+            lambda s: sessionRemainder(s, argsFor(s)), image, useHash)
+        print(colored('Skipping {} unchanged sessions\n'.format(len(skipped)), 'white', attrs=['bold']))
+        for s in skipped if journal is not None else ():
+            journal.record(s, 'skipped')
+        if len(sessions) == 0:
+            printSuccessMessage('All sessions are up to date\n')
+            return
+
+    jobs = describeJobs(image, sessions, extractArgs, command, sessionsPerJob, resources, fingerprints, sessionArgs)
+    writeJobDescriptions(jobs, batch_output)
+    print(colored('Packed {} sessions into {} jobs, see {}\n'.format(len(sessions), len(jobs),
+        os.path.join(batch_output, BATCH_JOBS_NAME)), 'white', attrs=['bold']))
+
+    if not local:
+        backend = SlurmBackend(batch_output, concurrency, prewarm=image if prewarm else None, timeout=timeout)
+        if not submit:
+            path = backend.writeScript(jobs)
+            printSuccessMessage('Wrote job array script {}, submit it with sbatch\n'.format(path))
+            return
+        jobId = backend.submit(jobs)
+        if wait:
+            try:
+                failed = backend.wait(jobId)
+            except RuntimeError as e:
+                printErrorMessage('{}\n'.format(e))
+                exit(1)
+            for taskId, (state, exitCode) in sorted(failed.items()):
+                index = taskId.rsplit('_', 1)[-1]
+                sessions = jobs[int(index)]['sessions'] if index.isdigit() and int(index) < len(jobs) else []
+                printErrorMessage('Task {} ended {} ({}): {}\n'.format(taskId, state, exitCode, ', '.join(sessions)))
+            if len(failed) != 0:
+                printErrorMessage('{} of {} tasks of job array {} failed, see the logs in {}\n'.format(len(failed),
+                    len(jobs), jobId, os.path.join(batch_output, 'logs')))
+                exit(1)
+            printSuccessMessage('Job array {} finished\n'.format(jobId))
+        return
+
+    if prewarm:
+        total, elapsed = prewarmImage(image)
+        printSuccessMessage('Pre-warmed {} ({:.2f} GB in {:.1f}s)\n'.format(image, total / 1024 ** 3, elapsed))
+    concurrency = concurrency or getCpuCount()
+    memPerJob = (resources or {}).get('mem')
+    admission = AdmissionController(concurrency, int(memPerJob * 1024 ** 3) if memPerJob else None,
+        runtime=footprintRuntime(command)) if admit else None
+    backend = LocalBackend(concurrency, logDir=os.path.join(batch_output, 'logs'), timeout=timeout,
+        retries=retries, backoff=backoff, journal=journal, admission=admission)
+    try:
+        results = backend.submit(jobs)
+    finally:
+        if admission is not None:
+            admission.close()
+    outcomes = [{'session': session, 'returnCode': code, 'attempts': n, 'log': log}
+        for r in results for session, code, n, log in zip(r['sessions'], r['returnCodes'], r['attempts'], r['logs'])]
+    report = writeFailureReport(outcomes, os.path.join(batch_output, FAILURE_REPORT_NAME))
+    if report is not None:
+        printErrorMessage('{} of {} sessions failed, see {}. Rerun with --resume to retry only those.\n'.format(
+            sum(o['returnCode'] != 0 for o in outcomes), len(outcomes), report))
+        exit(1)
+#end doExtractBatch()
+
+def doBatch(image, flip_path, batch_output, remainder, command, stream=False, logPath=None,
+        sessionsPerJob=1, concurrency=None, resources=None, submit=False, wait=False,
+        incremental=False, useHash=False, profile=None, prewarm=False, rigOverrides=None, timeout=None,
+        retries=0, backoff=RETRY_BACKOFF_SECONDS, journalPath=None, resume=False, admit=True):
+    profile = profile or NoProfile()
+    with profile.phase('prepare'):
+        try:
+            mountCommand = mountDirectories(remainder, command['mount'], BATCH_TABLE['batch'], fullBinds=command.get('fullBinds', False))
+        except ValueError as e:
+            print(colored(str(e), 'red'))
+            exit(1)
     print(mountCommand)
 
     configFile = ''
     if ('-c' not in remainder and '--config-file' not in remainder):
-        print(colored("No config file was passed in... generating one now.\n", 'yellow'))
-        bashCommand = " bash -c 'source activate moseq2; moseq2-extract generate-config;'"
-        configCommand = command["exec"] + ' ' + mountCommand + ' ' + image + bashCommand
-        result, retCode = executeCommand(configCommand)
-
-        panicIfStderr(retCode, result, "Config file generated\n")
-        placeClassifierInYaml("config.yaml", flip_path)
+        print(colored("No config file was passed in... using the default config of the image.\n", 'yellow'))
+        with profile.phase('generate-config'):
+            try:
+                template = cachedConfigTemplate(image, command)
+            except RuntimeError as e:
+                printErrorMessage('{}\n'.format(e))
+                exit(1)
+            template.write("config.yaml", {'flip_classifier': flip_path})
         configFile = " -c config.yaml"
         printSuccessMessage("Config file generated\n")
 
-    bashCommand = " bash -c 'source activate moseq2; moseq2-batch " + ' '.join(remainder) + configFile + "'"
-    finalCommand = command["exec"] + ' ' + mountCommand + ' ' + image + bashCommand
-    result, retCode = executeCommand(finalCommand)
+    if 'extract-batch' in remainder:
+        with profile.phase('extract'):
+            doExtractBatch(image, batch_output, remainder, command, 'config.yaml' if configFile else None,
+                sessionsPerJob, concurrency, resources, submit, wait, incremental, useHash, prewarm,
+                rigOverrides, timeout, retries, backoff, journalPath, resume, admit)
+        return
+
+    finalCommand = buildContainerCommand(command, mountCommand, image, 'moseq2-batch ' + ' '.join(remainder) + configFile)
+    with profile.phase('batch'):
+        result, retCode = executeCommand(finalCommand, stream=stream, logPath=logPath, timeout=timeout)
 
     panicIfStderr(retCode, result, "Executed batch command\n")
 
-    if ('extract-batch' in remainder and 'slurm' in remainder):
-        output = result[0].decode('utf-8')
-        finalCommand = ''
-        with open('run_batch.sh', 'w') as f:
-            for line in output.split('\n'):
-                commandList = re.findall(r'"([^"]*)', line)
-
-                if len(commandList) != 0:
-                    com = commandList[0]
-                    t = command["exec"] + ' ' + mountCommand + ' ' + image + ' bash -c \'' + com
-                    line = line.replace(com, t)
-                    line = line[:-1] + "\'\";\n"
-                    finalCommand += line
-            f.write(finalCommand + '\n')
-            outputPath = os.path.join(batch_output, 'run_batch.sh') # just in case we have been passed a location for batch script
-            os.chmod(outputPath, S_IEXEC | os.stat(outputPath).st_mode)
-
-    if len(result[0]) != 0:
+    if len(result[0]) != 0 and not stream:
         print(result[0].decode('utf-8'))
 #end doBatch()
-
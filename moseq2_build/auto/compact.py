@@ -0,0 +1,256 @@
+""" Compaction of extraction outputs.
+
+After extraction, the HDF5 results of every session can be repacked with
+h5repack inside of the container, which chunks and compresses their
+datasets. Artifacts with identical contents, e.g. the outputs of re-runs
+with configs that did not change them, are replaced by hardlinks to a
+single copy. Only files sharing a size are hashed, in a process pool.
+Configs are never linked, as users edit them in place.
+
+Hardlinked files must not be rewritten in place, so extractSession
+separates the links of a session's outputs before it extracts it again.
+"""
+import asyncio, json, os, shlex, shutil, uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from moseq2_build.utils.constants import COMPACT_SUFFIXES, COMPACT_EDITABLE_SUFFIXES, COMPACT_INDEX_NAME, H5REPACK_FILTERS
+from moseq2_build.utils.commands import buildContainerCommand
+from moseq2_build.utils.mount import mountDirectories
+from moseq2_build.utils.resources import getCpuCount
+from moseq2_build.auto.manifest import fileHash
+
+def isArtifact(name):
+    # The manifests, logs and configs of moseq2-env are left alone
+    return name.lower().endswith(tuple(COMPACT_SUFFIXES)) and not name.startswith('moseq2-env-')
+#end isArtifact()
+
+def findArtifacts(folders):
+    """ Extraction artifacts in the given folders and their subfolders.
+
+    :rtype: Sorted list of unique absolute paths.
+    """
+    paths = set()
+    for folder in folders:
+        for root, dirs, files in os.walk(os.path.abspath(folder)):
+            for name in files:
+                path = os.path.join(root, name)
+                if isArtifact(name) and os.path.isfile(path) and not os.path.islink(path):
+                    paths.add(path)
+    return sorted(paths)
+#end findArtifacts()
+
+def diskUsage(paths):
+    """ Bytes the files take up, counting hardlinked files once. """
+    inodes = {}
+    for path in paths:
+        st = os.stat(path)
+        inodes[(st.st_dev, st.st_ino)] = st.st_size
+    return sum(inodes.values())
+#end diskUsage()
+
+def replaceWithLink(source, target):
+    """ Atomically replaces target with a hardlink to source. """
+    tmp = '{}.{}.link'.format(target, uuid.uuid4().hex[:8])
+    os.link(source, tmp)
+    os.replace(tmp, target)
+#end replaceWithLink()
+
+def deduplicateArtifacts(paths, workers=None):
+    """ Replaces artifacts with identical contents by hardlinks to the first
+    of them. Files on different filesystems, and configs (see
+    COMPACT_EDITABLE_SUFFIXES), are never linked.
+
+    :type paths: List of Strings
+    :param paths: Artifacts to deduplicate, see findArtifacts.
+
+    :type workers: Integer
+    :param workers: Processes hashing the files, the CPU count if None.
+
+    :rtype: Integer number of files that were replaced by a link.
+    """
+    # Only one name per inode is hashed, and only sizes seen more than once
+    names, sizes = {}, {}
+    for path in paths:
+        if path.lower().endswith(tuple(COMPACT_EDITABLE_SUFFIXES)):
+            continue
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+        if key not in names:
+            names[key] = []
+            sizes.setdefault((st.st_dev, st.st_size), []).append(key)
+        names[key].append(path)
+    candidates = [key for group in sizes.values() if len(group) > 1 for key in group]
+    if len(candidates) == 0:
+        return 0
+    with ProcessPoolExecutor(max_workers=max(1, min(workers or getCpuCount(), len(candidates)))) as pool:
+        hashes = list(pool.map(fileHash, [names[key][0] for key in candidates], chunksize=4))
+
+    originals, linked = {}, 0
+    for (dev, ino), digest in zip(candidates, hashes):
+        source = originals.setdefault((dev, digest), names[(dev, ino)][0])
+        if source == names[(dev, ino)][0]:
+            continue
+        for path in names[(dev, ino)]:
+            replaceWithLink(source, path)
+            linked += 1
+    return linked
+#end deduplicateArtifacts()
+
+def separateArtifacts(folder):
+    """ Gives every hardlinked artifact in folder its own copy again, so
+    that a new extraction writing into folder cannot change the files it
+    was linked to.
+
+    :rtype: Integer number of files that were copied.
+    """
+    copied = 0
+    for path in findArtifacts([folder]) if os.path.isdir(folder) else []:
+        if os.stat(path).st_nlink < 2:
+            continue
+        tmp = '{}.{}.copy'.format(path, uuid.uuid4().hex[:8])
+        shutil.copy2(path, tmp)
+        os.replace(tmp, path)
+        copied += 1
+    return copied
+#end separateArtifacts()
+
+def loadCompactIndex(folder):
+    """ Files of a folder that were already repacked, by name, with the
+    size and modification time they had afterwards.
+
+    :rtype: Dictionary
+    """
+    try:
+        with open(os.path.join(folder, COMPACT_INDEX_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+#end loadCompactIndex()
+
+def saveCompactIndex(folder, index):
+    path = os.path.join(folder, COMPACT_INDEX_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(path + '.tmp', path)
+#end saveCompactIndex()
+
+def isRepacked(path, indexes):
+    folder = os.path.dirname(path)
+    if folder not in indexes:
+        indexes[folder] = loadCompactIndex(folder)
+    st = os.stat(path)
+    return indexes[folder].get(os.path.basename(path)) == [st.st_size, st.st_mtime_ns]
+#end isRepacked()
+
+def buildRepackCommand(image, path, outPath, command):
+    """ Builds the container command line that repacks an HDF5 file.
+
+    :type path: String
+    :param path: HDF5 file to repack.
+
+    :type outPath: String
+    :param outPath: Location of the repacked copy, in the same folder.
+
+    :type command: Dictionary
+    :param command: Container command table (e.g. SINGULARITY_COMS).
+
+    :rtype: String
+    """
+    mountCommand = mountDirectories([], command['mount'], [], [os.path.dirname(path)],
+        fullBinds=command.get('fullBinds', False))
+    innerCommand = ' '.join(['h5repack'] + H5REPACK_FILTERS + [shlex.quote(path), shlex.quote(outPath)])
+    return buildContainerCommand(command, mountCommand, image, innerCommand)
+#end buildRepackCommand()
+
+def repackArtifacts(image, paths, command, workers=None, timeout=None):
+    """ Repacks the HDF5 artifacts that were not repacked yet, several at
+    the same time. A repacked file replaces the original, and every link
+    to it, only when it is smaller.
+
+    :type paths: List of Strings
+    :param paths: Artifacts, only the HDF5 files among them are repacked.
+
+    :type workers: Integer
+    :param workers: Containers running at the same time, the CPU count if None.
+
+    :type timeout: Float
+    :param timeout: Seconds after which a single repack is terminated.
+
+    :rtype: Tuple of the number of repacked files and a list of those that failed.
+    """
+    from moseq2_build.utils.execution import runCommandsAsync
+
+    indexes, groups = {}, {}
+    for path in paths:
+        if path.lower().endswith(('.h5', '.hdf5')) and not isRepacked(path, indexes):
+            st = os.stat(path)
+            groups.setdefault((st.st_dev, st.st_ino), []).append(path)
+    groups = list(groups.values())
+    if len(groups) == 0:
+        return 0, []
+    outPaths = ['{}.{}.repack'.format(group[0], uuid.uuid4().hex[:8]) for group in groups]
+    commands = [buildRepackCommand(image, group[0], outPath, command) for group, outPath in zip(groups, outPaths)]
+    results = asyncio.run(runCommandsAsync(commands, limit=workers or getCpuCount(), timeout=timeout))
+
+    repacked, failed = 0, []
+    for group, outPath, (output, retCode) in zip(groups, outPaths, results):
+        if retCode != 0 or not os.path.isfile(outPath):
+            failed.append(group[0])
+            if os.path.exists(outPath):
+                os.remove(outPath)
+            continue
+        if os.path.getsize(outPath) < os.path.getsize(group[0]):
+            os.replace(outPath, group[0])
+            for other in group[1:]:
+                replaceWithLink(group[0], other)
+            repacked += 1
+        else:
+            os.remove(outPath)
+        st = os.stat(group[0])
+        for path in group:
+            indexes[os.path.dirname(path)][os.path.basename(path)] = [st.st_size, st.st_mtime_ns]
+    for folder, index in indexes.items():
+        saveCompactIndex(folder, index)
+    return repacked, failed
+#end repackArtifacts()
+
+def compactOutputs(image, folders, command, repack=True, dedup=True, workers=None, timeout=None):
+    """ Compacts the extraction outputs in the given folders: the HDF5
+    files are repacked, then identical artifacts are hardlinked.
+
+    :type image: String
+    :param image: Path to the image file, which provides h5repack.
+
+    :type folders: List of Strings
+    :param folders: Output folders of sessions, or folders containing them.
+
+    :type command: Dictionary
+    :param command: Container command table (e.g. SINGULARITY_COMS).
+
+    :type workers: Integer
+    :param workers: Processes and containers used at the same time, the CPU count if None.
+
+    :rtype: Dictionary with the number of files, repacked, linked and
+    failed files, and the bytes used before and after.
+    """
+    paths = findArtifacts(folders)
+    summary = {'files': len(paths), 'repacked': 0, 'linked': 0, 'failed': [], 'bytesBefore': diskUsage(paths)}
+    if dedup:
+        # Linking first means files that are already identical are repacked once
+        summary['linked'] += deduplicateArtifacts(paths, workers)
+    if repack:
+        summary['repacked'], summary['failed'] = repackArtifacts(image, paths, command, workers, timeout)
+    if dedup and summary['repacked'] != 0:
+        summary['linked'] += deduplicateArtifacts(paths, workers)
+    summary['bytesAfter'] = diskUsage(paths)
+    return summary
+#end compactOutputs()
+
+def printCompactSummary(summary):
+    from moseq2_build.utils.commands import printSuccessMessage, printErrorMessage
+    for path in summary['failed']:
+        printErrorMessage('Could not repack {}\n'.format(path))
+    printSuccessMessage('Compacted {} files from {:.1f} MB to {:.1f} MB ({} repacked, {} hardlinked)\n'.format(
+        summary['files'], summary['bytesBefore'] / 1024.0 ** 2, summary['bytesAfter'] / 1024.0 ** 2,
+        summary['repacked'], summary['linked']))
+#end printCompactSummary()
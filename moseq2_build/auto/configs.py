@@ -0,0 +1,146 @@
+import copy, fnmatch, os, threading, uuid
+import ruamel.yaml as yaml
+
+from moseq2_build.utils.constants import CONFIG_CACHE_DIR, SESSION_CONFIG_NAME, EXTRACT_TABLE
+from moseq2_build.utils.commands import executeCommand, buildContainerCommand
+from moseq2_build.utils.mount import mountDirectories
+from moseq2_build.env.store import imageFingerprint
+
+_templateCache = {}
+_templateLock = threading.Lock()
+
+class ConfigTemplate(object):
+    """ A parsed moseq2-extract config that is specialized for sessions in
+    process. The file is parsed once; every rendered config is a copy of
+    the parsed contents with its own overrides, so comments and key order
+    of the template are kept.
+    """
+    def __init__(self, contents):
+        self.contents = contents
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(yaml.round_trip_load(f) or yaml.comments.CommentedMap())
+
+    def render(self, overrides=None):
+        """ Returns a copy of the template with the overrides applied. """
+        contents = copy.deepcopy(self.contents)
+        for key, value in (overrides or {}).items():
+            contents[key] = value
+        return contents
+
+    def write(self, path, overrides=None):
+        """ Writes a specialized config, replacing path atomically. """
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
+        with open(tmp, 'w') as f:
+            yaml.round_trip_dump(self.render(overrides), f)
+        os.replace(tmp, path)
+        return path
+#end ConfigTemplate
+
+def templatePath(image, cacheDir=None):
+    """ Location of the cached default config of an image. """
+    return os.path.join(cacheDir or CONFIG_CACHE_DIR, imageFingerprint(image).replace(':', '-').replace('/', '_') + '.yaml')
+#end templatePath()
+
+def cachedConfigTemplate(image, command, cacheDir=None):
+    """ Returns the default config of an image. It is generated with
+    moseq2-extract generate-config only the first time for every image,
+    then read from the cache folder, and kept parsed in memory.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :type command: Dictionary
+    :param command: Container command table (e.g. SINGULARITY_COMS).
+
+    :type cacheDir: String
+    :param cacheDir: Folder of the cached configs, CONFIG_CACHE_DIR if None.
+
+    :rtype: ConfigTemplate
+    """
+    path = templatePath(image, cacheDir)
+    with _templateLock:
+        if path in _templateCache:
+            return _templateCache[path]
+        if not os.path.isfile(path):
+            generateTemplate(image, command, path)
+        template = ConfigTemplate.load(path)
+        _templateCache[path] = template
+        return template
+#end cachedConfigTemplate()
+
+def generateTemplate(image, command, path):
+    """ Runs moseq2-extract generate-config in a container to create the
+    default config at path.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.yaml'.format(path, uuid.uuid4().hex[:8])
+    remainder = ['generate-config', '--output-file', tmp]
+    mountCommand = mountDirectories(remainder, command['mount'], EXTRACT_TABLE['generate-config'], fullBinds=command.get('fullBinds', False))
+    finalCommand = buildContainerCommand(command, mountCommand, image, 'moseq2-extract ' + ' '.join(remainder))
+    (stdout, stderr), retCode = executeCommand(finalCommand)
+    if retCode != 0 or not os.path.isfile(tmp):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise RuntimeError('Could not generate the default config: ' + stderr.decode('utf-8', 'replace'))
+    os.replace(tmp, path)
+#end generateTemplate()
+
+def clearTemplateCache():
+    with _templateLock:
+        _templateCache.clear()
+#end clearTemplateCache()
+
+def loadRigOverrides(path):
+    """ Reads per-rig overrides: a YAML mapping of session path glob
+    patterns to the config values of the sessions they match, e.g.
+
+        '*/rig2/*':
+          flip_classifier: /moseq2_data/flip_files/flip_classifier_k2_inscopix.pkl
+
+    :rtype: List of (pattern, Dictionary) tuples in file order.
+    """
+    with open(path, 'r') as f:
+        contents = yaml.safe_load(f) or {}
+    return [(pattern, dict(values or {})) for pattern, values in contents.items()]
+#end loadRigOverrides()
+
+def sessionOverrides(session, rigOverrides):
+    """ Combines the overrides of every pattern matching the session; later
+    patterns win.
+
+    :rtype: Dictionary
+    """
+    overrides = {}
+    for pattern, values in rigOverrides:
+        if fnmatch.fnmatch(session, pattern):
+            overrides.update(values)
+    return overrides
+#end sessionOverrides()
+
+def writeSessionConfigs(template, sessions, flipPath=None, rigOverrides=()):
+    """ Writes the config of every session next to its input in one pass.
+
+    :type template: ConfigTemplate
+    :param template: Config the session configs are based on.
+
+    :type sessions: List of Strings
+    :param sessions: Depth files of the sessions.
+
+    :type flipPath: String
+    :param flipPath: Flip classifier of sessions without an override.
+
+    :type rigOverrides: List of (pattern, Dictionary) tuples
+    :param rigOverrides: Output of loadRigOverrides.
+
+    :rtype: Dictionary of session to config path.
+    """
+    configs = {}
+    for session in sessions:
+        overrides = {'flip_classifier': flipPath} if flipPath is not None else {}
+        overrides.update(sessionOverrides(session, rigOverrides))
+        configs[session] = template.write(os.path.join(os.path.dirname(session), SESSION_CONFIG_NAME), overrides)
+    return configs
+#end writeSessionConfigs()
@@ -1,46 +1,84 @@
-import os, ruamel.yaml as yaml
+import os
 from termcolor import colored
 
 from moseq2_build.utils.constants import getDefaultImage, DEFAULT_FLIP_PATH, SINGULARITY_COMS, EXTRACT_TABLE
-from moseq2_build.utils.commands import executeCommand, panicIfStderr
+from moseq2_build.utils.commands import executeCommand, panicIfStderr, buildContainerCommand
 from moseq2_build.utils.mount import mountDirectories
+from moseq2_build.utils.profiling import NoProfile
+from moseq2_build.auto.configs import ConfigTemplate
 
-def doExtract(image, flip_path, remainder, command):
+def buildExtractCommand(image, remainder, command, extraPaths=(), verbose=False, markerPath=None):
+    """ Builds the container command line that runs moseq2-extract
+    with the given arguments.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :type remainder: List of Strings
+    :param remainder: Arguments passed through to moseq2-extract.
+
+    :type command: Dictionary
+    :param command: Container command table (e.g. SINGULARITY_COMS).
+
+    :type extraPaths: List of Strings
+    :param extraPaths: Additional paths that must be visible in the container.
+
+    :type verbose: Boolean
+    :param verbose: Print the intermediate commands as they are built.
+
+    :type markerPath: String
+    :param markerPath: File the container writes its start up timestamps
+    to, see buildContainerCommand.
+
+    :rtype: String
+    """
     if 'generate-config' in remainder:
         tab = EXTRACT_TABLE['generate-config']
     else:
         tab = EXTRACT_TABLE['extract']
-    mountCommand = mountDirectories(remainder, command['mount'], tab)
-    print(mountCommand)
+    mountCommand = mountDirectories(remainder, command['mount'], tab, extraPaths, fullBinds=command.get('fullBinds', False))
+    innerCommand = 'moseq2-extract ' + ' '.join(remainder)
+    finalCommand = buildContainerCommand(command, mountCommand, image, innerCommand, markerPath)
+    if verbose:
+        print(mountCommand)
+        print(innerCommand)
+        print(finalCommand)
+    return finalCommand
+#end buildExtractCommand()
 
-    bashCommand = " bash -c 'source activate moseq2; moseq2-extract " + ' '.join(remainder) + "'"
-    print(bashCommand)
-    finalCommand = command['exec'] + ' ' + mountCommand + ' ' + image + bashCommand
-    print(finalCommand)
+def doExtract(image, flip_path, remainder, command, stream=False, logPath=None, profile=None, timeout=None):
+    phaseName = 'generate-config' if 'generate-config' in remainder else 'extract'
+    profile = profile or NoProfile()
+    with profile.phase('prepare'):
+        markerPath = profile.markerPath()
+        try:
+            finalCommand = buildExtractCommand(image, remainder, command, verbose=True, markerPath=markerPath)
+        except ValueError as e:
+            print(colored(str(e), 'red'))
+            exit(1)
 
-    result, retCode = executeCommand(finalCommand)
+    with profile.containerPhases(phaseName, markerPath):
+        result, retCode = executeCommand(finalCommand, stream=stream, logPath=logPath, timeout=timeout)
     panicIfStderr(retCode, result, 'Executed extract command\n')
 
-    if ('generate-config' in remainder):
-        configPath = 'config.yaml'
-        if '-o' in remainder:
-            idx = remainder.index('-o') + 1
-            assert(idx < len(remainder))
-            configPath = remainder[idx]
-        elif '--output-file' in remainder:
-            idx = remainder.index('--output-file') + 1
-            assert(idx < len(remainder))
-            configPath = remainder[idx]
-        placeClassifierInYaml(os.path.abspath(configPath), flip_path)
-
-    if len(result[0]) != 0:
-        print(result[0].decode('utf-8'))
+    with profile.phase('output'):
+        if ('generate-config' in remainder):
+            configPath = 'config.yaml'
+            if '-o' in remainder:
+                idx = remainder.index('-o') + 1
+                assert(idx < len(remainder))
+                configPath = remainder[idx]
+            elif '--output-file' in remainder:
+                idx = remainder.index('--output-file') + 1
+                assert(idx < len(remainder))
+                configPath = remainder[idx]
+            placeClassifierInYaml(os.path.abspath(configPath), flip_path)
+
+        # Streamed output has already been printed as it arrived
+        if len(result[0]) != 0 and not stream:
+            print(result[0].decode('utf-8'))
 #end do_extract()
 
 def placeClassifierInYaml(configPath, flipPath):
-    with open(configPath, 'r') as f:
-        contents = yaml.safe_load(f)
-        contents['flip_classifier'] = flipPath
-    with open(configPath, 'w') as f:
-        yaml.dump(contents, f, Dumper=yaml.RoundTripDumper)
+    ConfigTemplate.load(configPath).write(configPath, {'flip_classifier': flipPath})
 #end placeClassifierInYaml()
@@ -0,0 +1,131 @@
+import json, os, random, threading, time, uuid
+
+from moseq2_build.utils.constants import RETRY_RETURN_CODES, RETRY_BACKOFF_SECONDS, RETRY_BACKOFF_MAX_SECONDS
+
+FINISHED_STATES = ('done', 'skipped')
+
+class RunJournal(object):
+    """ Append-only JSON lines file recording the state of every session of
+    a run: running, retrying, done, failed or skipped. Every record is
+    flushed to disk before the run goes on, so an interrupted run can be
+    resumed with only the sessions that did not finish.
+
+    :type path: String
+    :param path: Location of the journal file.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.runId = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+
+    def record(self, session, state, **fields):
+        """ Appends the new state of a session. """
+        entry = {'run': self.runId, 'session': session, 'state': state, 'time': time.time()}
+        entry.update(fields)
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def entries(self):
+        """ Every record of the journal in order. A line cut short by a crash is ignored.
+
+        :rtype: List of Dictionaries
+        """
+        entries = []
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return entries
+
+    def states(self):
+        """ Latest record of every session in the journal.
+
+        :rtype: Dictionary of session to its last record.
+        """
+        return {entry['session']: entry for entry in self.entries()}
+
+    def finished(self, sessions):
+        """ Sessions that finished in an earlier run. """
+        states = self.states()
+        return [s for s in sessions if states.get(s, {}).get('state') in FINISHED_STATES]
+
+    def unfinished(self, sessions):
+        """ Sessions that still need to run, in the order given. """
+        done = set(self.finished(sessions))
+        return [s for s in sessions if s not in done]
+#end RunJournal
+
+def isTransientFailure(returnCode):
+    """ Tells whether a failed command is worth retrying: the container
+    could not be started, or it was killed, e.g. out of memory. Errors
+    of moseq2-extract itself fail the same way every time.
+
+    :rtype: Boolean
+    """
+    return returnCode != 0 and (returnCode < 0 or returnCode in RETRY_RETURN_CODES)
+#end isTransientFailure()
+
+def retryDelay(attempt, backoff=RETRY_BACKOFF_SECONDS):
+    """ Seconds to wait before the next attempt: exponential backoff with
+    jitter, so failed sessions do not all retry at the same time.
+
+    :rtype: Float
+    """
+    return min(RETRY_BACKOFF_MAX_SECONDS, backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+#end retryDelay()
+
+def runWithRetries(run, retries=0, backoff=RETRY_BACKOFF_SECONDS, onRetry=None):
+    """ Calls run until it returns 0, fails permanently, or all retries are used.
+
+    :type run: Function
+    :param run: Called with the attempt number, returns a return code.
+
+    :type retries: Integer
+    :param retries: Attempts made after the first one for transient failures.
+
+    :type backoff: Float
+    :param backoff: Seconds to wait before the first retry, doubled for every further one.
+
+    :type onRetry: Function
+    :param onRetry: Called with the attempt, its return code and the delay before the next attempt.
+
+    :rtype: Tuple of the last return code and the number of attempts.
+    """
+    attempt = 1
+    while True:
+        retCode = run(attempt)
+        if retCode == 0 or attempt > retries or not isTransientFailure(retCode):
+            return retCode, attempt
+        delay = retryDelay(attempt, backoff)
+        if onRetry is not None:
+            onRetry(attempt, retCode, delay)
+        time.sleep(delay)
+        attempt += 1
+#end runWithRetries()
+
+def writeFailureReport(results, path):
+    """ Writes the sessions that failed, their return codes, attempts and
+    logs as JSON.
+
+    :type results: List of Dictionaries
+    :param results: Outcome of every session, see extractSession.
+
+    :rtype: String path of the report, None when nothing failed.
+    """
+    failed = [{'session': r['session'], 'returnCode': r['returnCode'], 'attempts': r.get('attempts', 1),
+        'log': r.get('log')} for r in results if r['returnCode'] != 0]
+    if len(failed) == 0:
+        return None
+    with open(path, 'w') as f:
+        json.dump({'created': time.time(), 'failed': failed}, f, indent=2)
+    return path
+#end writeFailureReport()
@@ -0,0 +1,151 @@
+import hashlib, json, os, shlex
+import ruamel.yaml as yaml
+
+from moseq2_build.utils.constants import MANIFEST_NAME, DOWNLOAD_CHUNK_SIZE
+from moseq2_build.env.store import imageFingerprint
+
+def argumentValue(args, *names):
+    """ Returns the value following the first of the given options in args. """
+    for name in names:
+        if name in args:
+            idx = args.index(name) + 1
+            if idx < len(args):
+                return args[idx]
+    return None
+#end argumentValue()
+
+def sessionOutputDir(sessionInput, extractArgs):
+    """ Folder moseq2-extract writes the results of a session to.
+
+    :type sessionInput: String
+    :param sessionInput: Path to the depth file of the session.
+
+    :type extractArgs: List of Strings
+    :param extractArgs: Arguments passed to moseq2-extract extract.
+
+    :rtype: String
+    """
+    outputDir = argumentValue(extractArgs, '--output-dir') or 'proc'
+    return os.path.join(os.path.dirname(os.path.abspath(sessionInput)), outputDir)
+#end sessionOutputDir()
+
+def fileHash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            h.update(block)
+    return 'sha256:' + h.hexdigest()
+#end fileHash()
+
+def sessionFingerprint(sessionInput, extractArgs, image, useHash=False, imageDigest=None):
+    """ Describes everything an extraction result depends on: the input
+    file, the config file contents, the flip classifier, the image and
+    the remaining arguments.
+
+    :type useHash: Boolean
+    :param useHash: Identify the input by its hash instead of its size
+    and modification time.
+
+    :type imageDigest: String
+    :param imageDigest: Fingerprint of the image, computed when None.
+
+    :rtype: Dictionary
+    """
+    st = os.stat(sessionInput)
+    fingerprint = {'input': os.path.abspath(sessionInput), 'size': st.st_size}
+    if useHash:
+        fingerprint['hash'] = fileHash(sessionInput)
+    else:
+        fingerprint['mtime'] = st.st_mtime_ns
+
+    configPath = argumentValue(extractArgs, '--config-file')
+    config = None
+    if configPath is not None and os.path.isfile(configPath):
+        with open(configPath, 'r') as f:
+            config = f.read()
+    fingerprint['config'] = config
+
+    flipPath = argumentValue(extractArgs, '--flip-classifier')
+    if flipPath is None and config is not None:
+        flipPath = (yaml.safe_load(config) or {}).get('flip_classifier')
+    fingerprint['flipClassifier'] = flipPath
+
+    fingerprint['image'] = imageDigest or imageFingerprint(image)
+    fingerprint['arguments'] = [a for a in extractArgs if a != sessionInput]
+    return fingerprint
+#end sessionFingerprint()
+
+def manifestPaths(sessionInput, extractArgs):
+    """ Location of the manifest of a session and of the pending manifest
+    that replaces it once the extraction succeeded.
+
+    :rtype: Tuple of Strings
+    """
+    manifestPath = os.path.join(sessionOutputDir(sessionInput, extractArgs), MANIFEST_NAME)
+    return manifestPath, manifestPath + '.pending'
+#end manifestPaths()
+
+def isUpToDate(sessionInput, extractArgs, fingerprint):
+    """ Whether the session was already extracted with exactly these inputs.
+
+    :rtype: Boolean
+    """
+    manifestPath, _ = manifestPaths(sessionInput, extractArgs)
+    try:
+        with open(manifestPath, 'r') as f:
+            return json.load(f) == fingerprint
+    except (OSError, ValueError):
+        return False
+#end isUpToDate()
+
+def prepareManifest(sessionInput, extractArgs, fingerprint):
+    """ Writes the pending manifest of a session that is about to be extracted.
+
+    :rtype: Tuple of the manifest and pending manifest paths.
+    """
+    manifestPath, pendingPath = manifestPaths(sessionInput, extractArgs)
+    os.makedirs(os.path.dirname(manifestPath), exist_ok=True)
+    with open(pendingPath, 'w') as f:
+        json.dump(fingerprint, f, indent=2)
+    return manifestPath, pendingPath
+#end prepareManifest()
+
+def commitManifest(manifestPath, pendingPath):
+    """ Marks the extraction of a session as complete. """
+    os.replace(pendingPath, manifestPath)
+#end commitManifest()
+
+def manifestCommand(finalCommand, manifestPath, pendingPath):
+    """ Extends a container command so that it commits the manifest once
+    it succeeded, for commands that do not run in this process.
+
+    :rtype: String
+    """
+    return '{} && mv -f {} {}'.format(finalCommand, shlex.quote(pendingPath), shlex.quote(manifestPath))
+#end manifestCommand()
+
+def filterChangedSessions(sessions, extractArgsFor, image, useHash=False):
+    """ Splits sessions into the ones that need to be extracted and the
+    ones whose manifest shows nothing changed since the last extraction.
+
+    :type sessions: List of Strings
+    :param sessions: Depth files of the sessions.
+
+    :type extractArgsFor: Function
+    :param extractArgsFor: Returns the moseq2-extract arguments of a session.
+
+    :rtype: Tuple of the sessions to extract and the skipped sessions,
+    and a Dictionary with the fingerprint of every session to extract.
+    """
+    imageDigest = imageFingerprint(image)
+    changed, skipped, fingerprints = [], [], {}
+    for session in sessions:
+        args = extractArgsFor(session)
+        fingerprint = sessionFingerprint(session, args, image, useHash, imageDigest)
+        if isUpToDate(session, args, fingerprint):
+            skipped.append(session)
+        else:
+            changed.append(session)
+            fingerprints[session] = fingerprint
+    return changed, skipped, fingerprints
+#end filterChangedSessions()
@@ -0,0 +1,291 @@
+""" Extract, PCA and model pipeline.
+
+The pipeline is a dependency graph: one extraction per session, followed
+by the stages of PIPELINE_STAGES, each running one moseq2 command in the
+image. A step starts as soon as the steps it depends on finished, so
+independent extractions, and stages such as apply-pca and changepoints,
+run at the same time.
+
+Every step has a key, a hash of its command, its parameters, the image
+and the keys of the steps it depends on; extractions use the fingerprint
+of their manifest. Stages write to <output>/<stage>/<key>, so a step
+whose key did not change is not run again. Changing a model parameter
+therefore only reruns the model, and results for earlier parameters stay
+available. <output>/<stage>/latest links to the folder of the last run.
+"""
+import hashlib, json, os, shutil, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import ruamel.yaml as yaml
+
+from moseq2_build.utils.constants import PIPELINE_STAGES, PIPELINE_RECORD_NAME, PIPELINE_LOG_NAME, RETRY_BACKOFF_SECONDS
+from moseq2_build.utils.commands import executeCommandToLog, buildContainerCommand, printSuccessMessage, printErrorMessage
+from moseq2_build.utils.execution import terminateAllCommands
+from moseq2_build.utils.mount import mountDirectories
+from moseq2_build.env.store import imageFingerprint
+from moseq2_build.auto.manifest import sessionFingerprint, sessionOutputDir, isUpToDate
+from moseq2_build.auto.schedule import sessionRemainder, extractSession
+
+def loadPipelineParams(path):
+    """ Reads the parameters of the pipeline stages from a YAML file, e.g.
+
+        extract: {config-file: config.yaml}
+        model: {kappa: 1000000, num-iter: 100}
+
+    maps every stage to options added to its command. A 'command' entry
+    replaces the command of the stage.
+
+    :rtype: Dictionary of stage names to Dictionaries.
+    """
+    if path is None:
+        return {}
+    with open(path, 'r') as f:
+        params = yaml.safe_load(f) or {}
+    stages = ['extract'] + [s['name'] for s in PIPELINE_STAGES]
+    unknown = [name for name in params if name not in stages]
+    if len(unknown) != 0:
+        raise ValueError('Unknown pipeline stages in {}: {}'.format(path, ', '.join(unknown)))
+    return params
+#end loadPipelineParams()
+
+def paramArguments(params):
+    """ Turns a mapping of options to values into command line arguments.
+    True adds the option alone, False and None leave it out.
+
+    :rtype: List of Strings
+    """
+    args = []
+    for name, value in sorted(params.items()):
+        if name == 'command' or value is None or value is False:
+            continue
+        option = name if name.startswith('-') else '--' + name
+        args.append(option)
+        if value is not True:
+            args.append(str(value))
+    return args
+#end paramArguments()
+
+def stepKey(description):
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+#end stepKey()
+
+class PipelineStep(object):
+    """ A node of the pipeline graph.
+
+    :type name: String
+    :param name: Unique name, the stage name or extract:<session>.
+
+    :type stage: String
+    :param stage: Name of the stage, extract for extractions.
+
+    :type after: List of Strings
+    :param after: Names of the steps that have to finish first.
+
+    :type key: String
+    :param key: Hash identifying the inputs and parameters of the step.
+
+    :type output: String
+    :param output: Folder the step writes to.
+
+    :type command: String
+    :param command: Command a stage runs in the image.
+
+    :type mounts: List of Strings
+    :param mounts: Folders a stage needs to see in the container.
+    """
+    def __init__(self, name, stage, after, key, output, command=None, mounts=(), session=None, fingerprint=None,
+            remainder=None):
+        self.name = name
+        self.stage = stage
+        self.after = after
+        self.key = key
+        self.output = output
+        self.command = command
+        self.mounts = list(mounts)
+        self.session = session
+        self.fingerprint = fingerprint
+        self.remainder = remainder
+
+    def isCached(self):
+        """ Whether the step already ran with the same key. """
+        if self.stage == 'extract':
+            return isUpToDate(self.session, sessionRemainder(self.session, self.remainder), self.fingerprint)
+        try:
+            with open(os.path.join(self.output, PIPELINE_RECORD_NAME), 'r') as f:
+                return json.load(f).get('key') == self.key
+        except (OSError, ValueError):
+            return False
+#end PipelineStep
+
+def planPipeline(image, sessions, remainder, outputDir, params=None, useHash=False):
+    """ Builds the steps of the pipeline and their keys.
+
+    :type sessions: List of Strings
+    :param sessions: Depth files of the sessions.
+
+    :type remainder: List of Strings
+    :param remainder: Arguments passed through to moseq2-extract extract.
+
+    :type outputDir: String
+    :param outputDir: Folder the stages after the extractions write to.
+
+    :type params: Dictionary
+    :param params: Options of every stage, see loadPipelineParams.
+
+    :rtype: List of PipelineSteps in the order they can run in.
+    """
+    params = params or {}
+    outputDir = os.path.abspath(outputDir)
+    imageDigest = imageFingerprint(image)
+    remainder = list(remainder) + paramArguments(params.get('extract', {}))
+    dataDir = os.path.commonpath([os.path.dirname(s) for s in sessions])
+
+    steps, byStage = [], {}
+    for session in sessions:
+        args = sessionRemainder(session, remainder)
+        fingerprint = sessionFingerprint(session, args, image, useHash, imageDigest)
+        step = PipelineStep('extract:' + session, 'extract', [], stepKey(fingerprint), sessionOutputDir(session, args),
+            session=session, fingerprint=fingerprint, remainder=remainder)
+        steps.append(step)
+        byStage.setdefault('extract', []).append(step)
+    for stage in PIPELINE_STAGES:
+        stageParams = params.get(stage['name'], {})
+        template = stageParams.get('command', stage['command'])
+        after = [s for name in stage['after'] for s in byStage[name]]
+        key = stepKey({'stage': stage['name'], 'command': template, 'params': paramArguments(stageParams),
+            'image': imageDigest, 'after': sorted(s.key for s in after)})
+        output = os.path.join(outputDir, stage['name'], key[:16])
+        folders = {name: byStage[name][0].output for name in stage['after'] if name != 'extract'}
+        command = ' '.join([template.format(data=dataDir, output=output, **folders)] + paramArguments(stageParams))
+        step = PipelineStep(stage['name'], stage['name'], [s.name for s in after], key, output, command,
+            mounts=[dataDir, outputDir])
+        steps.append(step)
+        byStage[stage['name']] = [step]
+    return steps
+#end planPipeline()
+
+def runStage(image, step, command, timeout=None):
+    """ Runs the command of a stage in a container, in a fresh output
+    folder. The record marking the step as finished is written last, so
+    an interrupted step runs again.
+
+    :rtype: Integer return code.
+    """
+    if os.path.isdir(step.output):
+        shutil.rmtree(step.output)
+    os.makedirs(step.output)
+    mountCommand = mountDirectories([], command['mount'], [], step.mounts + [step.output], fullBinds=command.get('fullBinds', False))
+    finalCommand = buildContainerCommand(command, mountCommand, image, step.command)
+    retCode = executeCommandToLog(finalCommand, os.path.join(step.output, PIPELINE_LOG_NAME), timeout=timeout)
+    if retCode == 0:
+        recordPath = os.path.join(step.output, PIPELINE_RECORD_NAME)
+        with open(recordPath + '.pending', 'w') as f:
+            json.dump({'stage': step.stage, 'key': step.key, 'command': step.command, 'finished': time.time()}, f, indent=2)
+        os.replace(recordPath + '.pending', recordPath)
+        linkLatest(step.output)
+    return retCode
+#end runStage()
+
+def linkLatest(output):
+    link = os.path.join(os.path.dirname(output), 'latest')
+    tmp = link + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.basename(output), tmp)
+    os.replace(tmp, link)
+#end linkLatest()
+
+def runPipeline(image, steps, command, workers=1, force=(), timeout=None, retries=0, backoff=RETRY_BACKOFF_SECONDS,
+        verbose=True):
+    """ Runs the steps of a pipeline, each as soon as the steps it depends on
+    finished. Steps that already ran with the same key are skipped. When a
+    step fails, the steps depending on it are blocked while the others go on.
+
+    :type steps: List of PipelineSteps
+    :param steps: Output of planPipeline.
+
+    :type command: Dictionary
+    :param command: Container command table (e.g. SINGULARITY_COMS).
+
+    :type workers: Integer
+    :param workers: Steps running at the same time.
+
+    :type force: List of Strings
+    :param force: Stages that run even when their key did not change.
+
+    :rtype: List of Dictionaries with the step, its stage, key, state
+    (done, cached, failed or blocked), return code, output folder and
+    elapsed seconds, in the order of steps.
+    """
+    results = {}
+
+    def finish(step, state, retCode=0, elapsed=0.0):
+        results[step.name] = {'step': step.name, 'stage': step.stage, 'key': step.key, 'state': state,
+            'returnCode': retCode, 'output': step.output, 'elapsed': elapsed}
+        if not verbose or state == 'cached':
+            return
+        if state == 'done':
+            printSuccessMessage('Finished {} in {:.1f}s\n'.format(step.name, elapsed))
+        elif state == 'failed':
+            printErrorMessage('{} failed ({}), see the log in {}\n'.format(step.name, retCode, step.output))
+        else:
+            printErrorMessage('Skipping {}, a step it depends on failed\n'.format(step.name))
+
+    def run(step):
+        start = time.time()
+        if step.stage == 'extract':
+            retCode = extractSession(image, step.session, step.remainder, command, step.fingerprint, timeout=timeout,
+                retries=retries, backoff=backoff, verbose=verbose)['returnCode']
+        else:
+            try:
+                retCode = runStage(image, step, command, timeout)
+            except OSError as e:
+                printErrorMessage('Could not run {}: {}\n'.format(step.name, e))
+                retCode = -1
+        return retCode, time.time() - start
+
+    pending, running = list(steps), {}
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        while len(pending) != 0 or len(running) != 0:
+            progressed = True
+            while progressed:
+                progressed = False
+                for step in list(pending):
+                    states = [results[name]['state'] if name in results else None for name in step.after]
+                    if any(s in ('failed', 'blocked') for s in states):
+                        finish(step, 'blocked', None)
+                    elif all(s in ('done', 'cached') for s in states):
+                        if step.stage not in force and step.isCached():
+                            finish(step, 'cached')
+                        else:
+                            running[pool.submit(run, step)] = step
+                    else:
+                        continue
+                    pending.remove(step)
+                    progressed = True
+            if len(running) == 0:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                retCode, elapsed = future.result()
+                finish(step, 'done' if retCode == 0 else 'failed', retCode, elapsed)
+    except KeyboardInterrupt:
+        # The steps wait on containers in their own process groups
+        pool.shutdown(wait=False, cancel_futures=True)
+        terminateAllCommands()
+        raise
+    pool.shutdown()
+    return [results[step.name] for step in steps]
+#end runPipeline()
+
+def printPipelineSummary(results):
+    counts = {}
+    for result in results:
+        counts[result['state']] = counts.get(result['state'], 0) + 1
+    summary = ', '.join('{} {}'.format(counts.get(state, 0), state) for state in ('done', 'cached', 'failed', 'blocked'))
+    if counts.get('failed', 0) + counts.get('blocked', 0) == 0:
+        printSuccessMessage('Pipeline finished: {}\n'.format(summary))
+    else:
+        printErrorMessage('Pipeline did not finish: {}\n'.format(summary))
+#end printPipelineSummary()
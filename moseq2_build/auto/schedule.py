@@ -0,0 +1,280 @@
+import glob, os, sys, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from termcolor import colored
+
+from moseq2_build.utils.constants import SESSION_FILE_NAMES, SESSION_LOG_NAME, TIMEOUT_RETURN_CODE, RETRY_BACKOFF_SECONDS
+from moseq2_build.utils.execution import terminateAllCommands
+from moseq2_build.utils.commands import executeCommandToLog, printSuccessMessage, printErrorMessage
+from moseq2_build.utils.resources import defaultWorkerCount
+from moseq2_build.auto.extract import buildExtractCommand
+from moseq2_build.auto.manifest import filterChangedSessions, prepareManifest, commitManifest, sessionOutputDir
+from moseq2_build.auto.compact import separateArtifacts
+from moseq2_build.auto.journal import runWithRetries
+
+def findSessionInput(path):
+    """ Finds the raw depth file of a session.
+
+    :type path: String
+    :param path: Either a session directory or the depth file itself.
+
+    :rtype: String path to the depth file, or None if there is none.
+    """
+    if os.path.isfile(path):
+        return os.path.abspath(path)
+    if os.path.isdir(path):
+        for name in SESSION_FILE_NAMES:
+            candidate = os.path.join(path, name)
+            if os.path.isfile(candidate):
+                return os.path.abspath(candidate)
+    return None
+#end findSessionInput()
+
+def findSessions(patterns, missing=None):
+    """ Expands the passed in directories and glob patterns into a sorted
+    list of unique session depth files.
+
+    :type patterns: List of Strings
+    :param patterns: Session directories, depth files or glob patterns.
+
+    :type missing: List
+    :param missing: Receives the matches without session data, which are
+    printed if None.
+
+    :rtype: List of Strings
+    """
+    sessions = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern))) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            sessionInput = findSessionInput(match)
+            if sessionInput is None and missing is not None:
+                missing.append(match)
+            elif sessionInput is None:
+                printErrorMessage('No session data found in {}\n'.format(match))
+            elif sessionInput not in sessions:
+                sessions.append(sessionInput)
+    return sessions
+#end findSessions()
+
+def sessionRemainder(sessionInput, remainder):
+    """ Inserts the session input file into the moseq2-extract arguments.
+
+    :type sessionInput: String
+    :param sessionInput: Path to the depth file of the session.
+
+    :type remainder: List of Strings
+    :param remainder: Arguments passed through to moseq2-extract.
+
+    :rtype: List of Strings
+    """
+    remainder = list(remainder)
+    if len(remainder) != 0 and remainder[0] == 'extract':
+        return ['extract', sessionInput] + remainder[1:]
+    return ['extract', sessionInput] + remainder
+#end sessionRemainder()
+
+def extractSession(image, sessionInput, remainder, command, fingerprint=None, stager=None, timeout=None,
+        retries=0, backoff=RETRY_BACKOFF_SECONDS, journal=None, admission=None, verbose=True):
+    """ Runs a single extraction, logging its output next to the session data.
+    When a fingerprint is given, the session manifest is updated once the
+    extraction succeeded. With a stager, the extraction runs on the staged
+    copy of the session and its outputs are copied back afterwards. An
+    extraction running longer than timeout seconds is terminated. Transient
+    failures are retried up to retries times, and every attempt and the
+    outcome are recorded in the journal. With an AdmissionController,
+    every attempt waits until it fits on the node. Retries and errors are
+    only printed when verbose; an error is also kept in the outcome.
+
+    :rtype: Dictionary describing the outcome of the extraction.
+    """
+    logPath = os.path.join(os.path.dirname(sessionInput), SESSION_LOG_NAME)
+    args = sessionRemainder(sessionInput, remainder)
+    start = time.time()
+    attempts, error = 0, None
+    def attempt(n):
+        if admission is None:
+            if journal is not None:
+                journal.record(sessionInput, 'running', attempt=n)
+            return executeCommandToLog(finalCommand, logPath, timeout=timeout)
+        with admission.admitted(sessionInput, inputBytes) as ticket:
+            if journal is not None:
+                journal.record(sessionInput, 'running', attempt=n, footprint=ticket.footprint)
+            ticket.returnCode = executeCommandToLog(finalCommand, logPath, timeout=timeout, onStart=ticket.started)
+            return ticket.returnCode
+    def onRetry(n, retCode, delay):
+        if verbose:
+            printErrorMessage('Extraction of {} failed ({}), retrying in {:.0f}s\n'.format(sessionInput, retCode, delay))
+        if journal is not None:
+            journal.record(sessionInput, 'retrying', attempt=n, returnCode=retCode, delay=delay)
+    try:
+        # Outputs hardlinked by compactOutputs would be overwritten for every link
+        separateArtifacts(sessionOutputDir(sessionInput, args))
+        runInput = stager.get(sessionInput) if stager is not None else sessionInput
+        finalCommand = buildExtractCommand(image, sessionRemainder(runInput, remainder), command,
+            extraPaths=[os.path.dirname(runInput)])
+        inputBytes = os.path.getsize(runInput)
+        if fingerprint is not None:
+            manifestPath, pendingPath = prepareManifest(sessionInput, args, fingerprint)
+        retCode, attempts = runWithRetries(attempt, retries, backoff, onRetry)
+        if stager is not None:
+            stager.finish(sessionInput, args, retCode == 0)
+        if fingerprint is not None and retCode == 0:
+            commitManifest(manifestPath, pendingPath)
+    except (OSError, RuntimeError, ValueError) as e:
+        error = str(e)
+        if verbose:
+            printErrorMessage('Could not run extraction for {}: {}\n'.format(sessionInput, e))
+        if stager is not None:
+            stager.finish(sessionInput, args, False)
+        retCode = -1
+    result = {'session': sessionInput, 'returnCode': retCode, 'attempts': max(1, attempts),
+        'elapsed': time.time() - start, 'log': logPath, 'skipped': False}
+    if error is not None:
+        result['error'] = error
+    if journal is not None:
+        journal.record(sessionInput, 'done' if retCode == 0 else 'failed', returnCode=retCode,
+            attempts=result['attempts'], elapsed=result['elapsed'], log=logPath)
+    return result
+#end extractSession()
+
+def scheduleExtractions(image, sessions, remainder, command, workers=None, memPerSession=None,
+        incremental=False, useHash=False, verbose=True, stager=None, timeout=None, retries=0,
+        backoff=RETRY_BACKOFF_SECONDS, journal=None, resume=False, admission=None):
+    """ Extracts several sessions at the same time using a bounded
+    pool of workers, each running its own container.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :type sessions: List of Strings
+    :param sessions: Depth files of the sessions to extract.
+
+    :type remainder: List of Strings
+    :param remainder: Arguments passed through to moseq2-extract.
+
+    :type command: Dictionary
+    :param command: Container command table (e.g. SINGULARITY_COMS).
+
+    :type workers: Integer
+    :param workers: Number of concurrent extractions. Determined from the
+    node's cores and memory when None.
+
+    :type memPerSession: Integer
+    :param memPerSession: Expected peak memory of one extraction in bytes.
+
+    :type incremental: Boolean
+    :param incremental: Skip sessions whose manifest shows that neither
+    the input, the config, the flip classifier nor the image changed.
+
+    :type useHash: Boolean
+    :param useHash: Identify inputs by their hash instead of size and mtime.
+
+    :type verbose: Boolean
+    :param verbose: Print the progress of the extractions.
+
+    :type stager: Stager
+    :param stager: Stages the sessions to node-local scratch, prefetching
+    the next ones while the current ones extract.
+
+    :type timeout: Float
+    :param timeout: Seconds after which a single extraction is terminated.
+
+    :type retries: Integer
+    :param retries: Retries of an extraction that failed transiently.
+
+    :type backoff: Float
+    :param backoff: Seconds before the first retry, doubled for every further one.
+
+    :type journal: RunJournal
+    :param journal: Records the state of every session as the run goes on.
+
+    :type resume: Boolean
+    :param resume: Skip the sessions the journal shows as finished.
+
+    :type admission: AdmissionController
+    :param admission: Starts every extraction only once it fits on the
+    node. Its parallel ceiling then sizes the pool instead of workers.
+
+    :rtype: List of Dictionaries, one per session, in the order given.
+    """
+    results = {}
+    toExtract, fingerprints = sessions, {}
+    if resume and journal is not None:
+        finished = set(journal.finished(sessions))
+        toExtract = [s for s in sessions if s not in finished]
+        for s in finished:
+            results[s] = {'session': s, 'returnCode': 0, 'attempts': 0, 'elapsed': 0.0,
+                'log': os.path.join(os.path.dirname(s), SESSION_LOG_NAME), 'skipped': True}
+        if verbose:
+            print(colored('Resuming: {} sessions already finished\n'.format(len(finished)), 'white', attrs=['bold']))
+    if incremental:
+        toExtract, skipped, fingerprints = filterChangedSessions(toExtract,
+            lambda s: sessionRemainder(s, remainder), image, useHash)
+        for s in skipped:
+            results[s] = {'session': s, 'returnCode': 0, 'attempts': 0, 'elapsed': 0.0,
+                'log': os.path.join(os.path.dirname(s), SESSION_LOG_NAME), 'skipped': True}
+            if journal is not None:
+                journal.record(s, 'skipped')
+        if verbose:
+            print(colored('Skipping {} unchanged sessions\n'.format(len(skipped)), 'white', attrs=['bold']))
+    if len(toExtract) == 0:
+        return [results[s] for s in sessions]
+
+    if admission is not None:
+        workers = admission.maxParallel
+    elif workers is None:
+        workers = defaultWorkerCount(memPerSession)
+    workers = max(1, min(workers, len(toExtract)))
+    if verbose:
+        print(colored('Extracting {} sessions with {} workers{}\n'.format(len(toExtract), workers,
+            ', admitted as memory allows' if admission is not None else ''), 'white', attrs=['bold']))
+
+    if stager is not None:
+        stager.start(toExtract, workers)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {pool.submit(extractSession, image, s, remainder, command, fingerprints.get(s), stager, timeout,
+            retries, backoff, journal, admission, verbose): s
+            for s in toExtract}
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if not verbose:
+                continue
+            if result['returnCode'] == 0:
+                printSuccessMessage('Extracted {}\n'.format(result['session']))
+            elif result['returnCode'] == TIMEOUT_RETURN_CODE and timeout is not None:
+                printErrorMessage('Extraction of {} timed out after {}s\n'.format(result['session'], timeout))
+            else:
+                printErrorMessage('Failed to extract {} (see {})\n'.format(result['session'], result['log']))
+        pool.shutdown()
+    except KeyboardInterrupt:
+        # The workers wait on containers in their own process groups
+        pool.shutdown(wait=False, cancel_futures=True)
+        terminateAllCommands()
+        raise
+    finally:
+        # Scratch copies of the sessions must not stay on the node
+        if stager is not None:
+            stager.close()
+    return [results[s] for s in sessions]
+#end scheduleExtractions()
+
+def printExtractionSummary(results):
+    """ Prints a table with the exit code, run time and log of every session.
+
+    :type results: List of Dictionaries
+    :param results: Output of scheduleExtractions.
+    """
+    failed = [r for r in results if r['returnCode'] != 0]
+    skipped = [r for r in results if r.get('skipped')]
+    sys.stdout.write(colored('\n\nExtraction summary\n', 'white', attrs=['bold']))
+    for r in results:
+        color = 'green' if r['returnCode'] == 0 else 'red'
+        status = 'skip' if r.get('skipped') else r['returnCode']
+        sys.stdout.write(colored('{:>5} {:>10.1f}s  {}\n'.format(status, r['elapsed'], r['session']), color))
+    sys.stdout.write('\n{} succeeded, {} skipped, {} failed\n'.format(len(results) - len(failed) - len(skipped),
+        len(skipped), len(failed)))
+    for r in failed:
+        sys.stdout.write('  log: {}\n'.format(r['log']))
+#end printExtractionSummary()
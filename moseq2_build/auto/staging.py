@@ -0,0 +1,170 @@
+import os, shutil, tempfile, threading, uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from moseq2_build.utils.constants import SESSION_FILE_NAMES, STAGE_COPY_THREADS, STAGE_CHUNK_SIZE, STAGE_PREFETCH
+from moseq2_build.auto.manifest import sessionOutputDir
+
+def scratchRoot(scratchDir=None):
+    """ Node-local folder sessions are staged to: scratchDir if given,
+    otherwise $TMPDIR.
+
+    :rtype: String
+    """
+    return os.path.abspath(scratchDir or os.environ.get('TMPDIR') or tempfile.gettempdir())
+#end scratchRoot()
+
+def sessionFiles(sessionInput):
+    """ Files of a session that extraction reads: the depth file and the
+    metadata next to it. Other raw depth files and folders are left out.
+
+    :rtype: List of Strings
+    """
+    folder = os.path.dirname(sessionInput)
+    files = [sessionInput]
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if name not in SESSION_FILE_NAMES and os.path.isfile(path):
+            files.append(path)
+    return files
+#end sessionFiles()
+
+class Stager(object):
+    """ Stages session inputs to node-local scratch before they are extracted.
+
+    Sessions are staged one after the other in a background thread, each
+    with up to copyThreads parallel copies, so the next session is copied
+    while the current one extracts. At most window sessions are kept on
+    scratch at a time. When a session finished, its outputs are copied back
+    next to the original input and the staged copy is removed. Files are
+    hardlinked instead of copied when the scratch folder is on the same
+    filesystem.
+
+    :type scratchDir: String
+    :param scratchDir: Node-local folder, $TMPDIR if None.
+
+    :type copyThreads: Integer
+    :param copyThreads: Number of parallel copies.
+
+    :type prefetch: Integer
+    :param prefetch: Sessions staged ahead of the ones being extracted.
+    """
+    def __init__(self, scratchDir=None, copyThreads=STAGE_COPY_THREADS, prefetch=STAGE_PREFETCH,
+            chunkSize=STAGE_CHUNK_SIZE):
+        self.root = os.path.join(scratchRoot(scratchDir), 'moseq2-env-stage-' + uuid.uuid4().hex[:8])
+        self.copyThreads = max(1, copyThreads)
+        self.prefetch = max(0, prefetch)
+        self.chunkSize = chunkSize
+        self.staged = {}
+        self.thread = None
+        self.closed = False
+
+    def start(self, sessions, workers=1):
+        """ Begins staging the sessions in order in the background. """
+        os.makedirs(self.root, exist_ok=True)
+        self.copyPool = ThreadPoolExecutor(max_workers=self.copyThreads)
+        self.window = threading.Semaphore(max(1, workers) + self.prefetch)
+        for session in sessions:
+            self.staged[session] = Future()
+        self.thread = threading.Thread(target=self._stageAll, args=(list(sessions),), daemon=True)
+        self.thread.start()
+
+    def _stageAll(self, sessions):
+        for i, session in enumerate(sessions):
+            self.window.acquire()
+            if self.closed:
+                self.staged[session].set_exception(RuntimeError('Staging was stopped'))
+                continue
+            try:
+                self.staged[session].set_result(self.stageSession(session, i))
+            except Exception as e:
+                self.staged[session].set_exception(e)
+
+    def stageSession(self, sessionInput, index=0):
+        """ Copies the files of a session into its own scratch folder.
+
+        :rtype: String path of the staged depth file.
+        """
+        target = os.path.join(self.root, '{}_{}'.format(index, os.path.basename(os.path.dirname(sessionInput))))
+        os.makedirs(target, exist_ok=True)
+        futures = []
+        for path in sessionFiles(sessionInput):
+            futures += self.copyFile(path, os.path.join(target, os.path.basename(path)))
+        for future in futures:
+            future.result()
+        return os.path.join(target, os.path.basename(sessionInput))
+
+    def copyFile(self, source, destination):
+        """ Hardlinks source when possible, otherwise schedules copies of its
+        chunks on the copy threads.
+
+        :rtype: List of Futures, one per chunk.
+        """
+        try:
+            os.link(source, destination)
+            return []
+        except OSError:
+            pass
+        size = os.path.getsize(source)
+        with open(destination, 'wb') as f:
+            f.truncate(size)
+        chunks = range(0, max(size, 1), self.chunkSize)
+        return [self.copyPool.submit(self._copyChunk, source, destination, start, min(self.chunkSize, size - start))
+            for start in chunks]
+
+    @staticmethod
+    def _copyChunk(source, destination, start, length):
+        src = os.open(source, os.O_RDONLY)
+        dst = os.open(destination, os.O_WRONLY)
+        try:
+            end = start + length
+            while start < end:
+                data = os.pread(src, min(end - start, 8 * 1024 * 1024), start)
+                if len(data) == 0:
+                    break
+                os.pwrite(dst, data, start)
+                start += len(data)
+        finally:
+            os.close(src)
+            os.close(dst)
+
+    def get(self, sessionInput):
+        """ Waits until a session is staged.
+
+        :rtype: String path of the staged depth file.
+        """
+        return self.staged[sessionInput].result()
+
+    def finish(self, sessionInput, extractArgs, success=True):
+        """ Copies the outputs of a staged session back next to its original
+        input when it succeeded, then frees its scratch space.
+
+        :type extractArgs: List of Strings
+        :param extractArgs: moseq2-extract arguments of the original session.
+        """
+        future = self.staged.pop(sessionInput, None)
+        if future is None:
+            return
+        try:
+            if future.exception() is not None:
+                return
+            stagedInput = future.result()
+            stagedDir = os.path.dirname(stagedInput)
+            stagedArgs = [stagedInput if a == sessionInput else a for a in extractArgs]
+            stagedOutput = sessionOutputDir(stagedInput, stagedArgs)
+            # Absolute output folders are written in place and need no copy
+            if success and stagedOutput.startswith(stagedDir + os.sep) and os.path.isdir(stagedOutput):
+                shutil.copytree(stagedOutput, sessionOutputDir(sessionInput, extractArgs), dirs_exist_ok=True)
+            shutil.rmtree(stagedDir, ignore_errors=True)
+        finally:
+            self.window.release()
+
+    def close(self):
+        """ Stops staging and removes the scratch folder. """
+        self.closed = True
+        if self.thread is not None:
+            for future in self.staged.values():
+                self.window.release()
+            self.thread.join()
+            self.copyPool.shutdown()
+        shutil.rmtree(self.root, ignore_errors=True)
+#end Stager
@@ -0,0 +1,336 @@
+import json, math, os, shlex, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_IEXEC
+
+from moseq2_build.utils.constants import BATCH_SCRIPT_NAME, BATCH_JOBS_NAME, KILL_GRACE_SECONDS, RETRY_BACKOFF_SECONDS, \
+    SLURM_QUERY_RETRIES, SLURM_QUERY_BACKOFF_SECONDS
+from moseq2_build.utils.commands import executeCommandToLog, printSuccessMessage, printErrorMessage
+from moseq2_build.utils.execution import terminateAllCommands
+from moseq2_build.auto.extract import buildExtractCommand
+from moseq2_build.auto.schedule import sessionRemainder
+from moseq2_build.auto.manifest import prepareManifest, manifestCommand
+from moseq2_build.auto.journal import runWithRetries
+
+def findBatchSessions(inputDir, filename):
+    """ Finds every session below inputDir containing the given depth file.
+
+    :type inputDir: String
+    :param inputDir: Folder that is searched recursively.
+
+    :type filename: String
+    :param filename: Name of the depth file of a session.
+
+    :rtype: Sorted list of depth file paths.
+    """
+    sessions = []
+    for root, dirs, files in os.walk(os.path.abspath(inputDir)):
+        dirs[:] = sorted(d for d in dirs if d != 'proc')
+        if filename in files:
+            sessions.append(os.path.join(root, filename))
+    return sorted(sessions)
+#end findBatchSessions()
+
+def estimateSessionSize(session):
+    """ Estimates the cost of extracting a session from the size of its input. """
+    try:
+        return os.path.getsize(session)
+    except OSError:
+        return 0
+#end estimateSessionSize()
+
+def packSessions(sessions, sessionsPerJob=1):
+    """ Packs sessions into jobs so the estimated work of the jobs is as
+    even as possible. The largest sessions are placed first, each into
+    the job with the least work so far.
+
+    :type sessions: List of Strings
+    :param sessions: Depth files of the sessions.
+
+    :type sessionsPerJob: Integer
+    :param sessionsPerJob: Average number of sessions handled by one job.
+
+    :rtype: List of lists of sessions, one per job.
+    """
+    if len(sessions) == 0:
+        return []
+    numJobs = max(1, -(-len(sessions) // max(1, sessionsPerJob)))
+    bins = [[0, i, []] for i in range(numJobs)]
+    for size, session in sorted(((estimateSessionSize(s), s) for s in sessions), key=lambda x: (-x[0], x[1])):
+        target = min(bins, key=lambda b: (b[0], len(b[2]), b[1]))
+        target[0] += size
+        target[2].append(session)
+    return [sorted(b[2]) for b in bins if len(b[2]) != 0]
+#end packSessions()
+
+def sessionCommand(image, session, extractArgs, command, fingerprint=None):
+    """ Container command extracting one session. With a fingerprint, the
+    pending session manifest is written now and committed by the command
+    itself once the extraction succeeded, wherever it runs.
+
+    :rtype: String
+    """
+    args = sessionRemainder(session, extractArgs)
+    finalCommand = buildExtractCommand(image, args, command, extraPaths=[os.path.dirname(session)])
+    if fingerprint is not None:
+        manifestPath, pendingPath = prepareManifest(session, args, fingerprint)
+        finalCommand = manifestCommand(finalCommand, manifestPath, pendingPath)
+    return finalCommand
+#end sessionCommand()
+
+def describeJobs(image, sessions, extractArgs, command, sessionsPerJob=1, resources=None, fingerprints=None,
+        sessionArgs=None):
+    """ Builds the structured description of every job of a batch.
+
+    :type extractArgs: List of Strings
+    :param extractArgs: Arguments passed through to moseq2-extract extract.
+
+    :type resources: Dictionary
+    :param resources: Resources requested per job: cpus, mem (GB), time
+    and partition.
+
+    :type fingerprints: Dictionary
+    :param fingerprints: Session fingerprints for incremental extraction.
+
+    :type sessionArgs: Dictionary
+    :param sessionArgs: Arguments of sessions that do not use extractArgs,
+    e.g. because they have a config of their own.
+
+    :rtype: List of Dictionaries with the name, sessions, estimated size,
+    container commands and resources of each job.
+    """
+    jobs = []
+    for i, group in enumerate(packSessions(sessions, sessionsPerJob)):
+        jobs.append({
+            'name': 'moseq2-extract-{}'.format(i),
+            'sessions': group,
+            'size': sum(estimateSessionSize(s) for s in group),
+            'commands': [sessionCommand(image, s, (sessionArgs or {}).get(s, extractArgs), command,
+                (fingerprints or {}).get(s)) for s in group],
+            'resources': dict(resources or {}),
+        })
+    return jobs
+#end describeJobs()
+
+def writeJobDescriptions(jobs, outputDir):
+    """ Writes the job descriptions as JSON for later inspection or resubmission. """
+    path = os.path.join(outputDir, BATCH_JOBS_NAME)
+    with open(path, 'w') as f:
+        json.dump(jobs, f, indent=2)
+    return path
+#end writeJobDescriptions()
+
+class LocalBackend(object):
+    """ Runs the jobs of a batch on this machine, with at most concurrency
+    container processes running at the same time. Extractions running
+    longer than timeout seconds are terminated, transient failures are
+    retried up to retries times, and the state of every session is
+    recorded in the journal. With an AdmissionController, concurrency is
+    only the ceiling: every extraction waits until it fits on the node.
+    """
+    def __init__(self, concurrency=1, logDir=None, timeout=None, retries=0, backoff=RETRY_BACKOFF_SECONDS, journal=None,
+            admission=None):
+        self.concurrency = max(1, concurrency)
+        self.admission = admission
+        self.logDir = logDir
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.journal = journal
+
+    def record(self, session, state, **fields):
+        if self.journal is not None:
+            self.journal.record(session, state, **fields)
+
+    def runSession(self, session, jobCommand, logPath):
+        """ Runs the command of one session with retries.
+
+        :rtype: Tuple of the return code and the number of attempts.
+        """
+        def attempt(n):
+            if self.admission is None:
+                self.record(session, 'running', attempt=n)
+                return executeCommandToLog(jobCommand, logPath, timeout=self.timeout)
+            with self.admission.admitted(session, estimateSessionSize(session)) as ticket:
+                self.record(session, 'running', attempt=n, footprint=ticket.footprint)
+                ticket.returnCode = executeCommandToLog(jobCommand, logPath, timeout=self.timeout, onStart=ticket.started)
+                return ticket.returnCode
+        def onRetry(n, retCode, delay):
+            printErrorMessage('Extraction of {} failed ({}), retrying in {:.0f}s\n'.format(session, retCode, delay))
+            self.record(session, 'retrying', attempt=n, returnCode=retCode, delay=delay)
+        start = time.time()
+        retCode, attempts = runWithRetries(attempt, self.retries, self.backoff, onRetry)
+        self.record(session, 'done' if retCode == 0 else 'failed', returnCode=retCode, attempts=attempts,
+            elapsed=time.time() - start, log=logPath)
+        return retCode, attempts
+
+    def runJob(self, job):
+        logDir = self.logDir or os.path.dirname(job['sessions'][0])
+        codes, attempts, logs = [], [], []
+        for session, jobCommand in zip(job['sessions'], job['commands']):
+            logPath = os.path.join(logDir, '{}_{}.log'.format(job['name'], len(codes)))
+            retCode, n = self.runSession(session, jobCommand, logPath)
+            codes.append(retCode)
+            attempts.append(n)
+            logs.append(logPath)
+        return {'name': job['name'], 'sessions': job['sessions'], 'returnCodes': codes, 'attempts': attempts, 'logs': logs}
+
+    def submit(self, jobs):
+        """ Runs the jobs and waits for all of them.
+
+        :rtype: List of Dictionaries with the return code of every session.
+        """
+        if self.logDir is not None:
+            os.makedirs(self.logDir, exist_ok=True)
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            results = list(pool.map(self.runJob, jobs))
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True)
+            terminateAllCommands()
+            raise
+        pool.shutdown()
+        for result in results:
+            for session, code in zip(result['sessions'], result['returnCodes']):
+                if code == 0:
+                    printSuccessMessage('Extracted {}\n'.format(session))
+                else:
+                    printErrorMessage('Failed to extract {} ({})\n'.format(session, code))
+        return results
+#end LocalBackend
+
+class SlurmBackend(object):
+    """ Submits the jobs of a batch as a single Slurm job array. Each array
+    task runs the containers of one job; the number of tasks running at
+    the same time is limited by concurrency. With prewarm, every task
+    first reads that image into the page cache of its node, which is
+    quick when another task on the node already did. With timeout, every
+    extraction is wrapped in timeout(1), so a hung extraction frees its
+    allocation instead of holding it until the wall time. Failed squeue
+    and sacct calls are retried queryRetries times, queryBackoff seconds
+    apart.
+    """
+    def __init__(self, outputDir, concurrency=None, jobName='moseq2-extract', prewarm=None, timeout=None,
+            queryRetries=SLURM_QUERY_RETRIES, queryBackoff=SLURM_QUERY_BACKOFF_SECONDS):
+        self.outputDir = os.path.abspath(outputDir)
+        self.concurrency = concurrency
+        self.jobName = jobName
+        self.prewarm = prewarm
+        self.timeout = timeout
+        self.queryRetries = queryRetries
+        self.queryBackoff = queryBackoff
+
+    def renderScript(self, jobs):
+        """ Renders the sbatch script of the job array.
+
+        :rtype: String
+        """
+        # An array shares one resource request, so it has to fit the largest job
+        resources = dict(jobs[0]['resources'])
+        for key in ('cpus', 'mem'):
+            values = [job['resources'][key] for job in jobs if job['resources'].get(key)]
+            resources[key] = max(values) if len(values) != 0 else None
+        array = '0-{}'.format(len(jobs) - 1)
+        if self.concurrency:
+            array += '%{}'.format(self.concurrency)
+        lines = ['#!/bin/bash',
+            '#SBATCH --job-name={}'.format(self.jobName),
+            '#SBATCH --array={}'.format(array),
+            '#SBATCH --output={}'.format(os.path.join(self.outputDir, 'logs', self.jobName + '_%A_%a.log'))]
+        if resources.get('cpus'):
+            lines.append('#SBATCH --cpus-per-task={}'.format(resources['cpus']))
+        if resources.get('mem'):
+            lines.append('#SBATCH --mem={}G'.format(int(math.ceil(resources['mem']))))
+        if resources.get('time'):
+            lines.append('#SBATCH --time={}'.format(resources['time']))
+        if resources.get('partition'):
+            lines.append('#SBATCH --partition={}'.format(resources['partition']))
+        lines.append('')
+        if self.prewarm is not None:
+            lines.append(' '.join(shlex.quote(a) for a in [sys.executable, '-m', 'moseq2_build.utils.prewarm',
+                os.path.abspath(self.prewarm)]))
+        lines += ['status=0', 'case "$SLURM_ARRAY_TASK_ID" in']
+        for i, job in enumerate(jobs):
+            lines.append('{})'.format(i))
+            for session, jobCommand in zip(job['sessions'], job['commands']):
+                lines.append('    echo {}'.format(shlex.quote('Extracting ' + session)))
+                if self.timeout:
+                    jobCommand = 'timeout -k {} {} bash -c {}'.format(KILL_GRACE_SECONDS, int(math.ceil(self.timeout)),
+                        shlex.quote(jobCommand))
+                lines.append('    {} || status=1'.format(jobCommand))
+            lines.append('    ;;')
+        lines += ['esac', 'exit $status', '']
+        return '\n'.join(lines)
+
+    def writeScript(self, jobs):
+        os.makedirs(os.path.join(self.outputDir, 'logs'), exist_ok=True)
+        path = os.path.join(self.outputDir, BATCH_SCRIPT_NAME)
+        with open(path, 'w') as f:
+            f.write(self.renderScript(jobs))
+        os.chmod(path, S_IEXEC | os.stat(path).st_mode)
+        return path
+
+    def submit(self, jobs):
+        """ Writes the array script and submits it with sbatch.
+
+        :rtype: String Slurm job id.
+        """
+        path = self.writeScript(jobs)
+        proc = subprocess.run(['sbatch', '--parsable', path], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RuntimeError('sbatch failed: ' + proc.stderr.decode('utf-8', 'replace'))
+        jobId = proc.stdout.decode('utf-8').strip().split(';')[0]
+        printSuccessMessage('Submitted job array {} with {} tasks\n'.format(jobId, len(jobs)))
+        return jobId
+
+    def query(self, args):
+        """ Runs a Slurm query command, retrying it when it fails.
+
+        :rtype: String output of the command. Raises RuntimeError when
+        every attempt failed.
+        """
+        for attempt in range(self.queryRetries + 1):
+            proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode == 0:
+                return proc.stdout.decode('utf-8')
+            if attempt < self.queryRetries:
+                time.sleep(self.queryBackoff)
+        raise RuntimeError('{} failed: {}'.format(args[0], proc.stderr.decode('utf-8', 'replace').strip()))
+
+    def pendingTasks(self, jobId):
+        """ Asks squeue which tasks of the array are still queued or running.
+
+        :rtype: Dictionary of task id to state.
+        """
+        tasks = {}
+        for line in self.query(['squeue', '-h', '-r', '-j', jobId, '-o', '%i %T']).splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                tasks[parts[0]] = parts[1]
+        return tasks
+
+    def taskStates(self, jobId):
+        """ Asks sacct how the tasks of the array ended.
+
+        :rtype: Dictionary of task id to a tuple of its state and exit code.
+        """
+        tasks = {}
+        for line in self.query(['sacct', '-j', jobId, '-X', '-n', '-P', '-o', 'JobID,State,ExitCode']).splitlines():
+            parts = line.strip().split('|')
+            if len(parts) == 3:
+                tasks[parts[0]] = (parts[1], parts[2])
+        return tasks
+
+    def wait(self, jobId, interval=30):
+        """ Blocks until no task of the array is left in the queue.
+
+        :rtype: Dictionary of task id to state and exit code of every task
+        that did not complete successfully.
+        """
+        while len(self.pendingTasks(jobId)) != 0:
+            time.sleep(interval)
+        tasks = self.taskStates(jobId)
+        if len(tasks) == 0:
+            raise RuntimeError('sacct knows no tasks of job array {}'.format(jobId))
+        return {taskId: ended for taskId, ended in tasks.items() if ended != ('COMPLETED', '0:0')}
+#end SlurmBackend
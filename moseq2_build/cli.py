@@ -1,12 +1,10 @@
 import click
 import os
-from termcolor import colored
 
-from moseq2_build.utils.constants import getDefaultImage, DEFAULT_FLIP_PATH, SINGULARITY_COMS, EXTRACT_TABLE, BATCH_TABLE, ENVIRONMENT_CONFIG
-from moseq2_build.auto.extract import doExtract
-from moseq2_build.auto.batch import doBatch
-from moseq2_build.env.env import updateEnvironment, updateDefaultImage, cleanEnvironmentFolder, determineTargetAssets
-from moseq2_build.utils.commands import printSuccessMessage
+# NOTE: Only light modules are imported here. The subcommand implementations
+# pull in requests, tqdm, ruamel.yaml etc., so they are imported inside of
+# the commands that need them to keep "moseq2-env --help" and friends fast.
+from moseq2_build.utils.constants import getDefaultImage, DEFAULT_FLIP_PATH, CONTAINER_RUNTIMES, DEFAULT_SESSION_MEMORY_GB, STREAM_LOG_NAME, RUN_RECORDS_PATH, PROFILE_REGRESSION_THRESHOLD, STAGE_COPY_THREADS, JOURNAL_NAME, RETRY_ATTEMPTS, RETRY_BACKOFF_SECONDS, PIPELINE_DIR
 
 orig_init = click.core.Option.__init__
 
@@ -21,50 +19,248 @@ click.core.Option.__init__ = new_init
 def cli():
     pass
 
+def resolveCommands(image, instance=None, runtime=None, cpus=None, memoryGB=None):
+    """ Determines the container command table for the passed in image,
+    exiting when the image cannot be used.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :type instance: String
+    :param instance: Name of a warm instance the commands are sent to.
+
+    :type runtime: String
+    :param runtime: Container runtime, picked from the image and the host when 'auto'.
+
+    :type cpus: Float
+    :param cpus: CPU limit of every container, for runtimes that support it.
+
+    :type memoryGB: Float
+    :param memoryGB: Memory limit in GB of every container, for runtimes that support it.
+
+    :rtype: Dictionary
+    """
+    from termcolor import colored
+    from moseq2_build.api import containerCommands
+    from moseq2_build.env.store import ImageStore
+
+    try:
+        fileCommands = containerCommands(image, instance, runtime, cpus, memoryGB)
+    except ValueError as e:
+        print(colored('{}.'.format(e), 'red'))
+        exit(1)
+
+    print(colored('\nDetected {} image at {}\n'.format(fileCommands.get('runtime', 'singularity'), os.path.abspath(image)),
+        'white', attrs=['bold']))
+    ImageStore().touchPath(image)
+    return fileCommands
+#end resolveCommands()
+
 @cli.command(name='extract', context_settings=dict(ignore_unknown_options=True))
-@click.option('--image', default=getDefaultImage(), type=click.Path(exists=True), help='Location of the image file to be used.')
+@click.option('--image', default=getDefaultImage, type=click.Path(exists=True), help='Location of the image file to be used.')
 @click.option('--flip-path', default=DEFAULT_FLIP_PATH, type=click.Path(), help='Location of the flip classifier file.')
+@click.option('-s', '--sessions', multiple=True, type=str, help='Session directory, depth file or glob pattern to extract. May be given several times.')
+@click.option('-j', '--jobs', type=int, default=None, help='Maximum number of sessions extracted at the same time; fewer run while memory is short. Defaults to the number of cores.')
+@click.option('--mem-per-session', type=float, default=DEFAULT_SESSION_MEMORY_GB, help='Expected peak memory of one extraction in GB, used until the peaks of earlier extractions are known.')
+@click.option('--no-admission', is_flag=True, type=bool, default=False, help='Start -j extractions at once instead of admitting them as memory allows. Used with --sessions.')
+@click.option('--stream', is_flag=True, type=bool, default=False, help='Print the container output as it arrives instead of buffering it.')
+@click.option('--log-file', type=click.Path(), default=STREAM_LOG_NAME, help='Rotating log file the streamed output is written to.')
+@click.option('--incremental', is_flag=True, type=bool, default=False, help='Skip sessions that were already extracted with the same input, config, flip classifier and image.')
+@click.option('--hash-inputs', is_flag=True, type=bool, default=False, help='Compare inputs by hash instead of size and modification time when running incrementally.')
+@click.option('--stage', is_flag=True, type=bool, default=False, help='Copy the inputs of every session to node-local scratch before extracting it, and its outputs back afterwards. Used with --sessions.')
+@click.option('--scratch-dir', type=click.Path(), default=None, help='Node-local folder sessions are staged to. Defaults to $TMPDIR.')
+@click.option('--copy-threads', type=int, default=STAGE_COPY_THREADS, help='Number of parallel copies used for staging.')
+@click.option('--instance', type=str, default=None, help='Run the commands in this warm instance (see "instance start") instead of new containers. Their output is only shown once they finished, also with --stream.')
+@click.option('--runtime', type=click.Choice(CONTAINER_RUNTIMES), default='auto', help='Container runtime used to run the image. Picked from the image type and the installed runtimes when auto.')
+@click.option('--timeout', type=float, default=None, help='Seconds after which an extraction and its container are terminated.')
+@click.option('--retries', type=int, default=RETRY_ATTEMPTS, help='Retries of an extraction whose container failed to start or was killed. Used with --sessions.')
+@click.option('--retry-backoff', type=float, default=RETRY_BACKOFF_SECONDS, help='Seconds before the first retry, doubled for every further one.')
+@click.option('--journal', type=click.Path(dir_okay=False), default=JOURNAL_NAME, help='Journal recording the state of every session. Used with --sessions.')
+@click.option('--resume', is_flag=True, type=bool, default=False, help='Only extract the sessions the journal does not show as finished. Used with --sessions.')
+@click.option('--compact', is_flag=True, type=bool, default=False, help='Repack the HDF5 outputs of the extracted sessions with compression and hardlink identical outputs (see "compact"). Used with --sessions.')
+@click.option('--profile', is_flag=True, type=bool, default=False, help='Record phase timings, CPU time, peak memory and I/O of the run in the run history (see "stats").')
+@click.option('--profile-file', type=click.Path(), default=None, help='Also write the run record of --profile to this .json or .csv file.')
 @click.argument('remainder', nargs=-1, type=click.UNPROCESSED)
-def extract(image, flip_path, remainder):
-    fileCommands = None
-    if (image is None):
-        print(colored('No valid path was passed in.', 'red'))
-        exit(1)
+def extract(image, flip_path, sessions, jobs, mem_per_session, no_admission, stream, log_file, incremental, hash_inputs, stage,
+        scratch_dir, copy_threads, instance, runtime, timeout, retries, retry_backoff, journal, resume, compact, profile,
+        profile_file, remainder):
+    fileCommands = resolveCommands(image, instance, runtime)
+    from moseq2_build.utils.profiling import profiledRun
 
-    if (image.endswith('.sif')):
-        print(colored('\nDetected singularity image at {}\n'.format(os.path.abspath(image)),
-            'white', attrs=['bold']))
-        fileCommands = SINGULARITY_COMS
+    with profiledRun(profile, 'extract', remainder, image, profile_file) as run:
+        if len(sessions) != 0:
+            from termcolor import colored
+            from moseq2_build.auto.schedule import findSessions, scheduleExtractions, printExtractionSummary
+            sessionInputs = findSessions(sessions)
+            if len(sessionInputs) == 0:
+                print(colored('No sessions matched the passed in patterns.', 'red'))
+                exit(1)
+            if run is not None:
+                run.command = 'extract-sessions'
+            stager = None
+            if stage:
+                from moseq2_build.auto.staging import Stager
+                stager = Stager(scratch_dir, copy_threads)
+            from moseq2_build.auto.journal import RunJournal, writeFailureReport
+            from moseq2_build.utils.constants import FAILURE_REPORT_NAME
+            runJournal = RunJournal(journal)
+            admission = None
+            if not no_admission:
+                from moseq2_build.utils.admission import AdmissionController, footprintRuntime
+                admission = AdmissionController(jobs, int(mem_per_session * 1024 ** 3), runtime=footprintRuntime(fileCommands))
+            try:
+                results = scheduleExtractions(image, sessionInputs, list(remainder), fileCommands,
+                    workers=jobs, memPerSession=int(mem_per_session * 1024 ** 3), incremental=incremental, useHash=hash_inputs,
+                    stager=stager, timeout=timeout, retries=retries, backoff=retry_backoff, journal=runJournal, resume=resume,
+                    admission=admission)
+            finally:
+                if admission is not None:
+                    admission.close()
+            printExtractionSummary(results)
+            if compact:
+                from moseq2_build.auto.manifest import sessionOutputDir
+                from moseq2_build.auto.schedule import sessionRemainder
+                from moseq2_build.auto.compact import compactOutputs, printCompactSummary
+                from moseq2_build.utils.profiling import NoProfile
+                folders = [sessionOutputDir(r['session'], sessionRemainder(r['session'], remainder))
+                    for r in results if r['returnCode'] == 0]
+                with (run or NoProfile()).phase('compact'):
+                    printCompactSummary(compactOutputs(image, folders, fileCommands, workers=jobs, timeout=timeout))
+            report = writeFailureReport(results, os.path.join(os.path.dirname(runJournal.path), FAILURE_REPORT_NAME))
+            if report is not None:
+                print(colored('Failures are listed in {}, rerun with --resume to retry only those.'.format(report), 'red'))
+                exit(1)
+            return
 
-    else:
-        print('Docker is not supported at the moment... sorry :)')
-        exit(1)
-
-    doExtract(image, flip_path, list(remainder), fileCommands)
+        from moseq2_build.auto.extract import doExtract
+        if run is not None and 'generate-config' in remainder:
+            run.command = 'generate-config'
+        doExtract(image, flip_path, list(remainder), fileCommands, stream=stream, logPath=log_file, profile=run, timeout=timeout)
 #end test()
 
 @cli.command(name='batch', context_settings=dict(ignore_unknown_options=True))
-@click.option('--image', default=getDefaultImage(), type=click.Path(exists=True), help='Location of the image file to be used.')
+@click.option('--image', default=getDefaultImage, type=click.Path(exists=True), help='Location of the image file to be used.')
 @click.option('--flip-path', default=DEFAULT_FLIP_PATH, type=click.Path(), help='Location of the flip classifier file.')
 @click.option('--batch-output', default=os.getcwd(), type=click.Path(exists=True), help='Location for which the batched command script will be output to.')
+@click.option('--stream', is_flag=True, type=bool, default=False, help='Print the container output as it arrives instead of buffering it.')
+@click.option('--log-file', type=click.Path(), default=STREAM_LOG_NAME, help='Rotating log file the streamed output is written to.')
+@click.option('--sessions-per-job', type=int, default=1, help='Average number of sessions packed into one job, balanced by input size.')
+@click.option('--max-concurrent', type=int, default=None, help='Maximum number of jobs running at the same time. Local jobs only start once they fit into the memory of the node.')
+@click.option('--no-admission', is_flag=True, type=bool, default=False, help='Start --max-concurrent local jobs at once instead of admitting them as memory allows.')
+@click.option('--cpus-per-job', type=int, default=None, help='CPUs requested for every job.')
+@click.option('--mem-per-job', type=float, default=None, help='Memory in GB requested for every job.')
+@click.option('--wall-time', type=str, default=None, help='Wall time requested for every job, e.g. 4:00:00.')
+@click.option('--partition', type=str, default=None, help='Slurm partition the jobs are submitted to.')
+@click.option('--submit', is_flag=True, type=bool, default=False, help='Submit the Slurm job array instead of only writing its script.')
+@click.option('--wait', is_flag=True, type=bool, default=False, help='Wait until the submitted job array has finished.')
+@click.option('--prewarm', is_flag=True, type=bool, default=False, help='Read the image into the page cache of every node before its extractions start.')
+@click.option('--rig-overrides', type=click.Path(exists=True, dir_okay=False), default=None, help='YAML file mapping session path patterns to config values, e.g. the flip classifier of a rig. Every session of extract-batch then gets its own config.')
+@click.option('--incremental', is_flag=True, type=bool, default=False, help='Skip sessions that were already extracted with the same input, config, flip classifier and image.')
+@click.option('--hash-inputs', is_flag=True, type=bool, default=False, help='Compare inputs by hash instead of size and modification time when running incrementally.')
+@click.option('--instance', type=str, default=None, help='Run the commands in this warm instance (see "instance start") instead of new containers. Their output is only shown once they finished, also with --stream.')
+@click.option('--runtime', type=click.Choice(CONTAINER_RUNTIMES), default='auto', help='Container runtime used to run the image. Picked from the image type and the installed runtimes when auto.')
+@click.option('--timeout', type=float, default=None, help='Seconds after which an extraction and its container are terminated.')
+@click.option('--retries', type=int, default=RETRY_ATTEMPTS, help='Retries of an extraction whose container failed to start or was killed, in local batches.')
+@click.option('--retry-backoff', type=float, default=RETRY_BACKOFF_SECONDS, help='Seconds before the first retry, doubled for every further one.')
+@click.option('--journal', type=click.Path(dir_okay=False), default=None, help='Journal recording the state of every session of a local batch. Defaults to {} in the batch output folder.'.format(JOURNAL_NAME))
+@click.option('--resume', is_flag=True, type=bool, default=False, help='Only extract the sessions that did not finish: those the journal does not show as finished, or for Slurm, those without an up to date manifest.')
+@click.option('--profile', is_flag=True, type=bool, default=False, help='Record phase timings, CPU time, peak memory and I/O of the run in the run history (see "stats").')
+@click.option('--profile-file', type=click.Path(), default=None, help='Also write the run record of --profile to this .json or .csv file.')
 @click.argument('remainder', nargs=-1, type=click.UNPROCESSED)
-def batch(image, flip_path, batch_output, remainder):
-    fileCommands = None
-    if (image is None):
-        print(colored('No valid path was passed in.', 'red'))
-        exit(1)
+def batch(image, flip_path, batch_output, stream, log_file, sessions_per_job, max_concurrent, no_admission, cpus_per_job,
+        mem_per_job, wall_time, partition, submit, wait, prewarm, rig_overrides, incremental, hash_inputs, instance, runtime, timeout,
+        retries, retry_backoff, journal, resume, profile, profile_file, remainder):
+    # Local docker and podman jobs are held to the resources requested per job
+    fileCommands = resolveCommands(image, instance, runtime, cpus_per_job, mem_per_job)
 
-    if (image.endswith('.sif')):
-        print(colored('\nDetected singularity image at {}\n'.format(os.path.abspath(image)),
-            'white', attrs=['bold']))
-        fileCommands = SINGULARITY_COMS
+    from moseq2_build.auto.batch import doBatch
+    from moseq2_build.utils.profiling import profiledRun
+    resources = {'cpus': cpus_per_job, 'mem': mem_per_job, 'time': wall_time, 'partition': partition}
+    with profiledRun(profile, 'batch', remainder, image, profile_file) as run:
+        doBatch(image, flip_path, batch_output, list(remainder), fileCommands, stream=stream, logPath=log_file,
+            sessionsPerJob=sessions_per_job, concurrency=max_concurrent, resources=resources, submit=submit, wait=wait,
+            incremental=incremental, useHash=hash_inputs, profile=run, prewarm=prewarm, rigOverrides=rig_overrides, timeout=timeout,
+            retries=retries, backoff=retry_backoff, journalPath=journal, resume=resume, admit=not no_admission)
+#end batch()
 
-    else:
-        print('Docker is not supported at the moment... sorry :)')
+@cli.command(name='pipeline', context_settings=dict(ignore_unknown_options=True))
+@click.option('--image', default=getDefaultImage, type=click.Path(exists=True), help='Location of the image file to be used.')
+@click.option('-s', '--sessions', multiple=True, type=str, required=True, help='Session directory, depth file or glob pattern to extract. May be given several times.')
+@click.option('-o', '--output-dir', type=click.Path(file_okay=False), default=PIPELINE_DIR, help='Folder the stages after the extractions write their results to, one folder per stage and key.')
+@click.option('--params', type=click.Path(exists=True, dir_okay=False), default=None, help='YAML file mapping stages (extract, aggregate, train-pca, apply-pca, changepoints, model) to the options passed to their commands.')
+@click.option('-j', '--jobs', type=int, default=None, help='Number of steps running at the same time. Defaults to what the cores and memory of the node allow.')
+@click.option('--mem-per-session', type=float, default=DEFAULT_SESSION_MEMORY_GB, help='Expected peak memory of one extraction in GB, used to size the worker pool.')
+@click.option('--hash-inputs', is_flag=True, type=bool, default=False, help='Identify session inputs by hash instead of size and modification time.')
+@click.option('--force', multiple=True, type=str, help='Stage that runs even when its inputs and parameters did not change. May be given several times.')
+@click.option('--dry-run', is_flag=True, type=bool, default=False, help='Only print which steps would run and which are cached.')
+@click.option('--instance', type=str, default=None, help='Run the commands in this warm instance (see "instance start") instead of new containers.')
+@click.option('--runtime', type=click.Choice(CONTAINER_RUNTIMES), default='auto', help='Container runtime used to run the image. Picked from the image type and the installed runtimes when auto.')
+@click.option('--timeout', type=float, default=None, help='Seconds after which a step and its container are terminated.')
+@click.option('--retries', type=int, default=RETRY_ATTEMPTS, help='Retries of an extraction whose container failed to start or was killed.')
+@click.option('--retry-backoff', type=float, default=RETRY_BACKOFF_SECONDS, help='Seconds before the first retry, doubled for every further one.')
+@click.argument('remainder', nargs=-1, type=click.UNPROCESSED)
+def pipeline(image, sessions, output_dir, params, jobs, mem_per_session, hash_inputs, force, dry_run, instance, runtime,
+        timeout, retries, retry_backoff, remainder):
+    """ Runs extraction, PCA and modeling as one pipeline. Steps start as
+    soon as their inputs are ready, and steps whose inputs and parameters
+    did not change are not run again.
+    """
+    from termcolor import colored
+    from moseq2_build.utils.constants import PIPELINE_STAGES
+    from moseq2_build.utils.resources import defaultWorkerCount
+    from moseq2_build.auto.schedule import findSessions
+    from moseq2_build.auto.pipeline import loadPipelineParams, planPipeline, runPipeline, printPipelineSummary
+
+    unknown = [stage for stage in force if stage not in ['extract'] + [s['name'] for s in PIPELINE_STAGES]]
+    if len(unknown) != 0:
+        print(colored('Unknown stages: {}.'.format(', '.join(unknown)), 'red'))
+        exit(1)
+    fileCommands = resolveCommands(image, instance, runtime)
+    sessionInputs = findSessions(sessions)
+    if len(sessionInputs) == 0:
+        print(colored('No sessions matched the passed in patterns.', 'red'))
+        exit(1)
+    try:
+        steps = planPipeline(image, sessionInputs, list(remainder), output_dir, loadPipelineParams(params), hash_inputs)
+    except ValueError as e:
+        print(colored('{}.'.format(e), 'red'))
         exit(1)
 
-    doBatch(image, flip_path, batch_output, list(remainder), fileCommands)
-#end batch()
+    if dry_run:
+        for step in steps:
+            state = 'cached' if step.stage not in force and step.isCached() else 'run'
+            print('{:<7} {}  {}  {}'.format(state, step.key[:12], step.name, step.output))
+        return
+    workers = jobs or defaultWorkerCount(int(mem_per_session * 1024 ** 3))
+    results = runPipeline(image, steps, fileCommands, workers, force, timeout, retries, retry_backoff)
+    printPipelineSummary(results)
+    if any(r['state'] in ('failed', 'blocked') for r in results):
+        exit(1)
+#end pipeline()
+
+@cli.command(name='compact')
+@click.argument('folders', nargs=-1, required=True, type=click.Path(exists=True, file_okay=False))
+@click.option('--image', default=getDefaultImage, type=click.Path(exists=True), help='Location of the image file providing h5repack.')
+@click.option('--instance', type=str, default=None, help='Run h5repack in this warm instance (see "instance start") instead of new containers.')
+@click.option('--runtime', type=click.Choice(CONTAINER_RUNTIMES), default='auto', help='Container runtime used to run the image. Picked from the image type and the installed runtimes when auto.')
+@click.option('--no-repack', is_flag=True, type=bool, default=False, help='Only hardlink identical outputs, do not repack HDF5 files.')
+@click.option('--no-dedup', is_flag=True, type=bool, default=False, help='Only repack HDF5 files, do not hardlink identical outputs.')
+@click.option('-j', '--jobs', type=int, default=None, help='Number of files hashed and repacked at the same time. Defaults to the number of cores.')
+@click.option('--timeout', type=float, default=None, help='Seconds after which a single repack and its container are terminated.')
+def compact(folders, image, instance, runtime, no_repack, no_dedup, jobs, timeout):
+    """ Compacts extraction outputs: HDF5 results are repacked with chunked
+    compression, and identical HDF5, MP4 and YAML outputs in the given
+    folders are replaced by hardlinks to one copy.
+    """
+    from moseq2_build.auto.compact import compactOutputs, printCompactSummary
+
+    fileCommands = resolveCommands(image, instance, runtime) if not no_repack else None
+    summary = compactOutputs(image, list(folders), fileCommands, repack=not no_repack, dedup=not no_dedup,
+        workers=jobs, timeout=timeout)
+    printCompactSummary(summary)
+    if len(summary['failed']) != 0:
+        exit(1)
+#end compact()
 
 @cli.command(name='env')
 @click.option('-c', '--clean', is_flag=True, type=bool, default=False, help='Deletes all data in the environment folder.')
@@ -72,23 +268,138 @@ def batch(image, flip_path, batch_output, remainder):
 @click.option('-d', '--download-image', is_flag=True, type=bool, default=False, help='Downloads new image to specified folder.')
 @click.option('--no-default', is_flag=True, type=bool, default=True, help='Override the current default image.')
 @click.option('-v', '--version', type=str, default=None, help='Specific version number to download. Format: v24')
-def env(clean, update_image, download_image, no_default, version):
+@click.option('--stream-extract', is_flag=True, type=bool, default=False, help='Unpack the image while it downloads, needing half the disk space. Such downloads cannot be resumed.')
+@click.option('--cache-budget', type=float, default=None, help='Disk budget of the image store in GB. Least recently used images are evicted beyond it.')
+@click.option('-l', '--list-images', is_flag=True, type=bool, default=False, help='Lists the images in the image store.')
+@click.option('--shared-store', type=click.Path(), default=None, help='Shared image store. Alone, uses its default image instead of a copy of your own; with -d or --install-image, installs the image into it.')
+@click.option('--install-image', type=click.Path(exists=True, dir_okay=False), default=None, help='Image file installed into the --shared-store as its default image.')
+@click.option('--digest', type=str, default=None, help='Expected sha256 digest of the --install-image.')
+@click.option('--prewarm', is_flag=True, type=bool, default=False, help='Reads the default image into the page cache of this node, e.g. on every node with srun before a batch.')
+@click.option('--mirror', type=click.Path(file_okay=False), default=None, help='Copies the metadata and images of the release (-v, or the latest) into this folder, for nodes without outbound network.')
+@click.option('--release-source', type=str, default=None, help='Mirror folder or url of a served mirror to download from instead of GitHub. Alone, makes it the default; "" goes back to GitHub.')
+def env(clean, update_image, download_image, no_default, version, stream_extract, cache_budget, list_images,
+        shared_store, install_image, digest, prewarm, mirror, release_source):
+    from moseq2_build.env.env import updateEnvironment, updateDefaultImage, cleanEnvironmentFolder, determineTargetAssets, setCacheBudget, listStoredImages, installSharedDownload, prewarmDefaultImage, setReleaseSource, mirrorRelease
+    from moseq2_build.utils.commands import printSuccessMessage, printErrorMessage
+    from moseq2_build.utils.constants import getReleaseSource
+
     if clean == True:
         print("DELETING ALL DATA IN THE ENVIRONMENT!")
         cleanEnvironmentFolder()
 
+    if release_source is not None and not download_image and mirror is None:
+        setReleaseSource(release_source)
+    releaseSource = release_source if release_source is not None else getReleaseSource()
+
+    if mirror is not None:
+        mirrorRelease(mirror, version, baseUrl=releaseSource or None)
+
     if download_image == True:
-        assetsIndices, imageType, paths = determineTargetAssets(version)
-        if no_default == True:
+        assetsIndices, imageType, paths = determineTargetAssets(version, streamed=stream_extract, storeRoot=shared_store,
+            baseUrl=releaseSource or None)
+        if shared_store is not None:
+            installSharedDownload(shared_store, paths)
+        elif no_default == True:
             updateEnvironment(assetsIndices, imageType, paths)
         else:
             printSuccessMessage('Skipping envrionment file\n\n')
 
+    if install_image is not None:
+        from moseq2_build.env.shared import installSharedImage
+        if shared_store is None:
+            printErrorMessage('--install-image needs a --shared-store\n')
+            exit(1)
+        try:
+            installSharedImage(shared_store, install_image, digest)
+        except ValueError as e:
+            printErrorMessage('{}\n'.format(e))
+            exit(1)
+
+    if shared_store is not None and not download_image and install_image is None:
+        from moseq2_build.env.shared import attachSharedStore
+        try:
+            attachSharedStore(shared_store)
+        except ValueError as e:
+            printErrorMessage('{}\n'.format(e))
+            exit(1)
+
     if update_image is not None:
         updateDefaultImage(update_image)
 
+    if cache_budget is not None:
+        setCacheBudget(cache_budget)
+
+    if list_images == True:
+        listStoredImages()
+
+    if prewarm == True:
+        prewarmDefaultImage()
+
     printSuccessMessage('Exiting now\n\n')
 #end env()
 
+@cli.command(name='stats')
+@click.option('-r', '--records', multiple=True, type=click.Path(), default=[RUN_RECORDS_PATH], help='Run history or .json/.csv run record files to aggregate. May be given several times.')
+@click.option('--command', type=str, default=None, help='Only aggregate runs of this command, e.g. extract or batch.')
+@click.option('--threshold', type=float, default=PROFILE_REGRESSION_THRESHOLD, help='Relative increase of the median run time between images that is reported as a regression.')
+@click.option('--json', 'as_json', is_flag=True, type=bool, default=False, help='Print the aggregated statistics as JSON.')
+def stats(records, command, threshold, as_json):
+    """ Aggregates the records of profiled runs per command and image. """
+    import json
+    from moseq2_build.utils.profiling import loadRunRecords, aggregateRunRecords, printRunStats
+
+    runs = [r for r in loadRunRecords(records) if command is None or r['command'] == command]
+    summaries = aggregateRunRecords(runs, threshold)
+    if as_json:
+        print(json.dumps(summaries, indent=2))
+    else:
+        printRunStats(summaries)
+#end stats()
+
+@cli.group(name='instance')
+def instance_group():
+    """ Manage warm container instances. """
+    pass
+#end instance_group()
+
+@instance_group.command(name='start')
+@click.option('--name', type=str, default='default', help='Name of the instance.')
+@click.option('--image', default=getDefaultImage, type=click.Path(exists=True), help='Location of the image file to be used.')
+@click.option('--bind', multiple=True, type=click.Path(exists=True), help='Folder mounted into the instance. May be given several times.')
+@click.option('--workers', type=int, default=1, help='Number of warm shells, i.e. commands that can run at the same time.')
+def instance_start(name, image, bind, workers):
+    from termcolor import colored
+    from moseq2_build.utils.instance import startInstance
+    from moseq2_build.utils.commands import printSuccessMessage
+
+    if (image is None):
+        print(colored('No valid path was passed in.', 'red'))
+        exit(1)
+    pid = startInstance(name, image, list(bind) + [os.getcwd()], workers)
+    printSuccessMessage('Started instance {} (pid {})\n\n'.format(name, pid))
+#end instance_start()
+
+@instance_group.command(name='stop')
+@click.option('--name', type=str, default='default', help='Name of the instance.')
+def instance_stop(name):
+    from termcolor import colored
+    from moseq2_build.utils.instance import stopInstance, isRunning
+    from moseq2_build.utils.commands import printSuccessMessage
+
+    if not isRunning(name):
+        print(colored('Instance {} is not running.'.format(name), 'red'))
+        exit(1)
+    stopInstance(name)
+    printSuccessMessage('Stopped instance {}\n\n'.format(name))
+#end instance_stop()
+
+@instance_group.command(name='list')
+def instance_list():
+    from moseq2_build.utils.instance import listInstances
+
+    for meta in listInstances():
+        print('{}  pid {}  {} worker(s)  {}'.format(meta['name'], meta['pid'], meta['workers'], meta['image']))
+#end instance_list()
+
 if __name__ == '__main__':
     cli()
@@ -1,11 +1,14 @@
 import argparse, os, ruamel.yaml as yaml, shutil
 from pathlib import Path
 
-from moseq2_build.utils.constants import ENVIRONMENT_CONFIG, getDefaultImage, C57_FLIP_PATH, FIBER_FLIP_PATH, INSCOPIX_FLIP_PATH
+from moseq2_build.utils.constants import ENVIRONMENT_CONFIG, getDefaultImage, loadEnvironmentConfig, getCacheBudget, C57_FLIP_PATH, FIBER_FLIP_PATH, INSCOPIX_FLIP_PATH
 from moseq2_build.utils.commands import printErrorMessage, printSuccessMessage
 from moseq2_build.utils.release import getUnamPword, downloadAssets
+from moseq2_build.env.store import ImageStore
 
 def updateEnvironment(assetsIndices, image_type, paths):
+    from moseq2_build.env.shared import imageFileIn
+
     use_image = ''
     outputPath = os.path.join(str(Path.home()), ".config", "moseq2_environment")
     # We need to determine which one to make default as the user asked for both
@@ -16,6 +19,7 @@ def updateEnvironment(assetsIndices, image_type, paths):
     else:
         use_image = image_type
 
+    contents = loadEnvironmentConfig()
     with open(ENVIRONMENT_CONFIG, 'w') as f:
         # Set singularity as the default
         if use_image == '1':
@@ -32,12 +36,10 @@ def updateEnvironment(assetsIndices, image_type, paths):
                     p = os.path.join(pt, "image")
             singPath = p
 
-        singFile = [fi for fi in os.listdir(singPath) if os.path.isfile(os.path.join(singPath, fi))][0]
-        singPath = os.path.join(singPath, singFile)
-        d = {'defaultImage': str(os.path.join(outputPath, singPath))}
-        flipPaths = {'flipPaths': [C57_FLIP_PATH, FIBER_FLIP_PATH, INSCOPIX_FLIP_PATH]}
-        yaml.dump(d, f, Dumper=yaml.RoundTripDumper)
-        yaml.dump(flipPaths, f, Dumper=yaml.RoundTripDumper)
+        singPath = imageFileIn(os.path.dirname(singPath))
+        contents['defaultImage'] = str(os.path.join(outputPath, singPath))
+        contents['flipPaths'] = [C57_FLIP_PATH, FIBER_FLIP_PATH, INSCOPIX_FLIP_PATH]
+        yaml.dump(contents, f, Dumper=yaml.RoundTripDumper)
     printSuccessMessage("Updated environment file\n\n")
 #end updateEnvironment()
 
@@ -68,12 +70,22 @@ def cleanEnvironmentFolder():
     printSuccessMessage("Successfully cleaned folder.\n\n")
 #end cleanEnvironment()
 
-def determineTargetAssets(version):
+def determineTargetAssets(version, streamed=False, storeRoot=None, baseUrl=None):
     """ Prompts for user input for which asset image
     to download.
     :type version: String
     :param version: String representing the specific version
     of the images to download.
+
+    :type streamed: Boolean
+    :param streamed: Unpack the images while they download.
+
+    :type storeRoot: String
+    :param storeRoot: Shared image store the images are installed into
+    instead of the store of this user.
+
+    :type baseUrl: String
+    :param baseUrl: Release mirror folder or url used instead of GitHub.
     """
     image_options = ['0', '1', '2'] # 0 - Docker, 1 - Singularity, 2 - Both
     image_type = '' # Assume both at the start
@@ -84,7 +96,8 @@ def determineTargetAssets(version):
     if not os.path.isdir(outputPath):
         os.makedirs(outputPath)
 
-    username, password = getUnamPword()
+    # Mirrors need no GitHub credentials
+    username, password = getUnamPword() if baseUrl is None else (None, None)
 
     # Download singularity
     if (image_type == '1'):
@@ -96,7 +109,101 @@ def determineTargetAssets(version):
     else:
         assetsIndices = [0, 1]
 
-    paths = downloadAssets(username, password, assetsIndices, outputPath, version)
+    store = ImageStore(storeRoot) if storeRoot is not None else ImageStore()
+    paths = downloadAssets(username, password, assetsIndices, outputPath, version, baseUrl=baseUrl, store=store,
+        streamed=streamed)
+    if storeRoot is None:
+        evictStoredImages(store, keep=paths)
 
     return assetsIndices, image_type, paths
 #end determineTargetAssets()
+
+def evictStoredImages(store, keep=()):
+    """ Removes the least recently used images from the store until it
+    fits into the configured budget. The default image and the paths
+    in keep are never removed.
+    """
+    budget = getCacheBudget()
+    if budget is None:
+        return
+    for digest in store.evict(budget, keep=list(keep) + [getDefaultImage()]):
+        printSuccessMessage("Evicted stored image {}\n".format(digest))
+#end evictStoredImages()
+
+def setCacheBudget(budgetGB):
+    """ Sets the disk budget of the image store and evicts images that
+    no longer fit.
+
+    :type budgetGB: Float
+    :param budgetGB: Budget in GB.
+    """
+    contents = loadEnvironmentConfig()
+    contents['cacheBudgetGB'] = budgetGB
+    os.makedirs(os.path.dirname(ENVIRONMENT_CONFIG), exist_ok=True)
+    with open(ENVIRONMENT_CONFIG, 'w') as f:
+        yaml.dump(contents, f, Dumper=yaml.RoundTripDumper)
+    printSuccessMessage("Set image store budget to {} GB\n".format(budgetGB))
+    evictStoredImages(ImageStore())
+#end setCacheBudget()
+
+def setReleaseSource(source):
+    """ Sets the release mirror, a folder or url, images are downloaded
+    from instead of GitHub. An empty source goes back to GitHub.
+    """
+    contents = loadEnvironmentConfig()
+    if source:
+        contents['releaseSource'] = source if '://' in source else os.path.abspath(source)
+    else:
+        contents.pop('releaseSource', None)
+    os.makedirs(os.path.dirname(ENVIRONMENT_CONFIG), exist_ok=True)
+    with open(ENVIRONMENT_CONFIG, 'w') as f:
+        yaml.dump(contents, f, Dumper=yaml.RoundTripDumper)
+    printSuccessMessage("Downloading images from {}\n".format(contents.get('releaseSource', 'GitHub')))
+#end setReleaseSource()
+
+def mirrorRelease(mirrorDir, version=None, baseUrl=None):
+    """ Copies a release into a mirror folder, see syncMirror. """
+    from moseq2_build.utils.release import syncMirror
+    from moseq2_build.utils.download import DownloadError
+
+    username, password = getUnamPword() if baseUrl is None else (None, None)
+    try:
+        jsonData = syncMirror(username, password, mirrorDir, version, baseUrl)
+    except DownloadError as e:
+        printErrorMessage("Could not mirror the release: {}\n".format(e))
+        exit(1)
+    printSuccessMessage("Mirrored release {} to {}\n".format(jsonData.get('tag_name'), os.path.abspath(mirrorDir)))
+#end mirrorRelease()
+
+def listStoredImages():
+    """ Prints the images in the store, least recently used first. """
+    entries = ImageStore().entries()
+    if len(entries) == 0:
+        print("No images stored.")
+    for digest, entry in entries:
+        print("{}  {:>8.2f} GB  {}  {}".format(digest[:19], entry['size'] / 1024 ** 3,
+            ','.join(entry['tags']), entry['asset']))
+#end listStoredImages()
+
+def installSharedDownload(storeRoot, paths):
+    """ Makes the downloaded singularity image the default image of a shared store. """
+    from moseq2_build.env.shared import imageFileIn, publishSharedImage
+
+    store = ImageStore(storeRoot)
+    for pt in paths:
+        if 'singularity' in pt:
+            image = imageFileIn(pt)
+            publishSharedImage(storeRoot, image, store.digestForPath(image))
+#end installSharedDownload()
+
+def prewarmDefaultImage(image=None):
+    """ Reads the default image into the page cache of this node. """
+    from moseq2_build.utils.prewarm import prewarmImage
+
+    image = image or getDefaultImage()
+    if image is None:
+        printErrorMessage("No default image to pre-warm\n")
+        exit(1)
+    total, elapsed = prewarmImage(image)
+    printSuccessMessage("Pre-warmed {} ({:.2f} GB in {:.1f}s)\n".format(image, total / 1024 ** 3, elapsed))
+#end prewarmDefaultImage()
@@ -0,0 +1,110 @@
+""" Shared, read-only image stores.
+
+An admin installs one verified image into a store on a shared or
+node-local filesystem and marks it as the store's default. Clients attach
+their environment to the store and use that image without downloading a
+copy of their own.
+"""
+import hashlib, json, os, shutil, stat, time, uuid
+
+from moseq2_build.utils.constants import ENVIRONMENT_CONFIG, SHARED_DEFAULT_NAME, DOWNLOAD_CHUNK_SIZE, loadEnvironmentConfig, sharedImageInfo
+from moseq2_build.utils.commands import printSuccessMessage
+from moseq2_build.env.store import ImageStore
+
+def imageFileIn(folder):
+    """ Finds the image file inside of an unpacked release asset. Docker
+    assets unpack to "docker save" output, whose folder is the image.
+
+    :rtype: String
+    """
+    from moseq2_build.utils.runtimes import isDockerFolder
+
+    imageDir = os.path.join(folder, 'image')
+    if isDockerFolder(imageDir):
+        return imageDir
+    return os.path.join(imageDir, sorted(f for f in os.listdir(imageDir) if os.path.isfile(os.path.join(imageDir, f)))[0])
+#end imageFileIn()
+
+def copyWithDigest(source, destination, algorithm='sha256'):
+    """ Copies a file and computes its digest in the same pass.
+
+    :rtype: String of the form "<algorithm>:<hex digest>".
+    """
+    h = hashlib.new(algorithm)
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        for block in iter(lambda: src.read(DOWNLOAD_CHUNK_SIZE), b''):
+            h.update(block)
+            dst.write(block)
+    return algorithm + ':' + h.hexdigest()
+#end copyWithDigest()
+
+def makeReadable(path):
+    """ Lets every user read, but only the owner modify, the files below path. """
+    readOnly = ~(stat.S_IWGRP | stat.S_IWOTH)
+    for root, dirs, files in os.walk(path):
+        os.chmod(root, (os.stat(root).st_mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+            | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH) & readOnly)
+        for name in files:
+            fpath = os.path.join(root, name)
+            if not os.path.islink(fpath):
+                os.chmod(fpath, (os.stat(fpath).st_mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH) & readOnly)
+#end makeReadable()
+
+def publishSharedImage(storeRoot, image, digest):
+    """ Marks an image of the store as the default image of its clients. """
+    path = os.path.join(storeRoot, SHARED_DEFAULT_NAME)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'image': os.path.abspath(image), 'digest': digest, 'installed': time.time()}, f, indent=2)
+    os.replace(tmp, path)
+    makeReadable(storeRoot)
+    printSuccessMessage('Published {} as the default image of {}\n'.format(image, storeRoot))
+#end publishSharedImage()
+
+def installSharedImage(storeRoot, imagePath, expectedDigest=None, tag='installed'):
+    """ Copies an image file into a shared store, verifies it and makes it
+    the store's default image.
+
+    :type storeRoot: String
+    :param storeRoot: Folder of the shared store.
+
+    :type imagePath: String
+    :param imagePath: Image file to install.
+
+    :type expectedDigest: String
+    :param expectedDigest: Digest the image must have, "sha256:<hex>" or a bare hex digest.
+
+    :rtype: String path of the installed image.
+    """
+    store = ImageStore(storeRoot)
+    name = os.path.basename(imagePath)
+    staging = os.path.join(store.stagingDir(), uuid.uuid4().hex)
+    os.makedirs(os.path.join(staging, 'image'))
+    digest = copyWithDigest(imagePath, os.path.join(staging, 'image', name))
+    if expectedDigest is not None and expectedDigest.split(':')[-1].lower() != digest.split(':')[-1]:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise ValueError('Digest mismatch for {}: expected {}, got {}'.format(imagePath, expectedDigest, digest))
+    folder = store.add(digest, tag, os.path.splitext(name)[0], staging)
+    image = os.path.join(folder, 'image', name)
+    publishSharedImage(storeRoot, image, digest)
+    return image
+#end installSharedImage()
+
+def attachSharedStore(storeRoot):
+    """ Points the environment at a shared store. Its default image is used
+    unless another one is set with "env -u".
+    """
+    import ruamel.yaml as yaml
+
+    storeRoot = os.path.abspath(storeRoot)
+    info = sharedImageInfo(storeRoot)
+    if info is None:
+        raise ValueError('{} has no default image, install one first'.format(storeRoot))
+    contents = loadEnvironmentConfig()
+    contents['sharedStore'] = storeRoot
+    contents.pop('defaultImage', None)
+    os.makedirs(os.path.dirname(ENVIRONMENT_CONFIG), exist_ok=True)
+    with open(ENVIRONMENT_CONFIG, 'w') as f:
+        yaml.dump(contents, f, Dumper=yaml.RoundTripDumper)
+    printSuccessMessage('Using the shared image {}\n'.format(info['image']))
+#end attachSharedStore()
@@ -0,0 +1,208 @@
+import fcntl, json, os, shutil, time
+from contextlib import contextmanager
+
+from moseq2_build.utils.constants import IMAGE_STORE_DIR, getSharedStore, sharedImageInfo
+from moseq2_build.utils.download import assetStem
+
+def directorySize(path):
+    """ Returns the number of bytes used by all files below path.
+
+    :rtype: Integer
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            fpath = os.path.join(root, name)
+            if not os.path.islink(fpath):
+                total += os.path.getsize(fpath)
+    return total
+#end directorySize()
+
+class ImageStore(object):
+    """ Content-addressed store of unpacked release images.
+
+    Every image lives in <root>/<algorithm>/<hex digest>/<asset stem> and
+    is recorded in an index together with the release tags it belongs
+    to, its size and when it was last used. The index is guarded by a
+    file lock so several processes can share one store.
+    """
+    def __init__(self, root=IMAGE_STORE_DIR):
+        self.root = root
+        self.indexPath = os.path.join(root, 'index.json')
+        self.lockPath = os.path.join(root, '.lock')
+
+    @contextmanager
+    def locked(self):
+        """ Holds the store lock and yields the index, writing it back
+        when the block finishes without an error.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.lockPath, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._readIndex()
+                yield index
+                self._writeIndex(index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _readIndex(self):
+        if not os.path.isfile(self.indexPath):
+            return {'images': {}, 'tags': {}}
+        with open(self.indexPath, 'r') as f:
+            return json.load(f)
+
+    def _writeIndex(self, index):
+        tmp = self.indexPath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.indexPath)
+
+    def imagePath(self, digest, assetName):
+        """ Location of an image inside the store. """
+        algorithm, hexDigest = digest.split(':', 1)
+        return os.path.join(self.root, algorithm, hexDigest, assetStem(assetName))
+
+    def stagingDir(self):
+        """ Folder on the same filesystem as the store where downloads are
+        unpacked before being moved in.
+        """
+        path = os.path.join(self.root, 'staging')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def lookup(self, tag=None, assetName=None, digest=None):
+        """ Finds an image by digest, or by release tag and asset name.
+        A hit counts as a use of the image.
+
+        :rtype: String path of the image, or None if it is not stored.
+        """
+        with self.locked() as index:
+            if digest is None:
+                digest = index['tags'].get(tagKey(tag, assetName))
+            entry = index['images'].get(digest) if digest is not None else None
+            if entry is None or not os.path.isdir(self.imagePath(digest, entry['asset'])):
+                return None
+            entry['lastUsed'] = time.time()
+            if tag is not None and assetName is not None:
+                index['tags'][tagKey(tag, assetName)] = digest
+                if tag not in entry['tags']:
+                    entry['tags'].append(tag)
+            return self.imagePath(digest, entry['asset'])
+
+    def add(self, digest, tag, assetName, unpackedDir):
+        """ Moves an unpacked image into the store.
+
+        :rtype: String path of the image inside the store.
+        """
+        target = self.imagePath(digest, assetName)
+        with self.locked() as index:
+            if os.path.isdir(target):
+                shutil.rmtree(unpackedDir)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(unpackedDir, target)
+            entry = index['images'].setdefault(digest, {'asset': assetName, 'tags': [],
+                'added': time.time(), 'size': directorySize(target)})
+            entry['lastUsed'] = time.time()
+            if tag is not None:
+                index['tags'][tagKey(tag, assetName)] = digest
+                if tag not in entry['tags']:
+                    entry['tags'].append(tag)
+        return target
+
+    def contains(self, path):
+        """ Whether path lies inside of the store. """
+        path = os.path.abspath(path)
+        return path.startswith(os.path.abspath(self.root) + os.sep) and os.path.isfile(self.indexPath)
+
+    def digestForPath(self, path):
+        """ Finds the digest of the stored image containing path.
+
+        :rtype: String digest, or None if path is not in the store.
+        """
+        if not self.contains(path):
+            return None
+        path = os.path.abspath(path)
+        with self.locked() as index:
+            for digest, entry in index['images'].items():
+                if path.startswith(self.imagePath(digest, entry['asset']) + os.sep):
+                    return digest
+        return None
+
+    def touchPath(self, path):
+        """ Marks the image containing path as used, if it is in the store. """
+        if not self.contains(path):
+            return
+        path = os.path.abspath(path)
+        with self.locked() as index:
+            for digest, entry in index['images'].items():
+                if path.startswith(self.imagePath(digest, entry['asset']) + os.sep):
+                    entry['lastUsed'] = time.time()
+
+    def entries(self):
+        """ Lists the stored images, least recently used first.
+
+        :rtype: List of (digest, entry) tuples.
+        """
+        with self.locked() as index:
+            images = index['images']
+        return sorted(images.items(), key=lambda item: item[1]['lastUsed'])
+
+    def evict(self, budget, keep=()):
+        """ Removes least recently used images until the store fits into
+        the budget. Images containing any of the paths in keep are never
+        removed.
+
+        :type budget: Integer
+        :param budget: Disk budget in bytes.
+
+        :rtype: List of removed digests.
+        """
+        keep = [os.path.abspath(p) for p in keep if p]
+        removed = []
+        with self.locked() as index:
+            images = index['images']
+            total = sum(e['size'] for e in images.values())
+            for digest, entry in sorted(images.items(), key=lambda item: item[1]['lastUsed']):
+                if total <= budget:
+                    break
+                path = self.imagePath(digest, entry['asset'])
+                if any(p == path or p.startswith(path + os.sep) for p in keep):
+                    continue
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                total -= entry['size']
+                del images[digest]
+                removed.append(digest)
+            index['tags'] = {k: d for k, d in index['tags'].items() if d in images}
+        return removed
+#end ImageStore
+
+def imageFingerprint(image, store=None):
+    """ Identifies the image a command runs in. Images from the store, or
+    the default image of a shared store, are identified by their digest;
+    for other images the size and modification time stand in, so multi-GB
+    files are never hashed.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :rtype: String
+    """
+    store = store or ImageStore()
+    digest = store.digestForPath(image)
+    if digest is not None:
+        return digest
+    shared = sharedImageInfo(getSharedStore())
+    if shared is not None and shared['image'] == os.path.abspath(image):
+        return shared['digest']
+    try:
+        st = os.stat(image)
+    except OSError:
+        return 'missing:' + os.path.abspath(image)
+    return 'stat:{}:{}'.format(st.st_size, st.st_mtime_ns)
+#end imageFingerprint()
+
+def tagKey(tag, assetName):
+    return '{}/{}'.format(tag, assetName)
+#end tagKey()
@@ -0,0 +1,240 @@
+""" Admission control for concurrent container runs.
+
+Instead of starting a fixed number of containers, every run asks the
+controller for admission first. It is admitted once it fits: fewer runs
+than the parallel ceiling are active, the node is not stalling on memory
+or I/O, and its expected footprint fits into the available memory (the
+node's, or what the cgroup limit leaves) minus what the active runs are
+still expected to grow by. The footprint is estimated from the input
+size and the peak memory of earlier runs, which the controller measures
+per container process group and keeps in a small history file, per
+runtime. Only runtimes whose containers run in that process group are
+measured: docker and podman containers run under their daemon, and
+commands sent to a warm instance inside of the instance, so their peaks
+would only be those of the client. Those runs use the default footprint.
+"""
+import json, os, threading, time, uuid
+from contextlib import contextmanager
+
+from moseq2_build.utils.constants import FOOTPRINTS_PATH, FOOTPRINT_HISTORY, FOOTPRINT_SAFETY_FACTOR, FOOTPRINT_RUNTIMES, ADMISSION_POLL_SECONDS, ADMISSION_RESERVE_BYTES, ADMISSION_PRESSURE_LIMIT, DEFAULT_SESSION_MEMORY_GB
+from moseq2_build.utils.resources import getCpuCount, getAvailableMemory, pressureStall, processGroupRss
+
+_footprintsLock = threading.Lock()
+
+def footprintRuntime(command):
+    """ Runtime the footprints of runs with this command table are kept
+    under, see the module description.
+
+    :type command: Dictionary
+    :param command: Container command table (e.g. SINGULARITY_COMS).
+
+    :rtype: String, or None when the memory of the containers cannot be measured.
+    """
+    runtime = command.get('runtime', 'singularity')
+    if 'instance' in command or runtime not in FOOTPRINT_RUNTIMES:
+        return None
+    return runtime
+#end footprintRuntime()
+
+def loadFootprints(path=FOOTPRINTS_PATH, limit=FOOTPRINT_HISTORY, runtime='singularity'):
+    """ The most recent per-session footprints of a runtime.
+
+    :rtype: List of Dictionaries with runtime, inputBytes, peakRss and elapsed.
+    """
+    entries = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('runtime') == runtime:
+                    entries.append(entry)
+    except OSError:
+        pass
+    return entries[-limit:]
+#end loadFootprints()
+
+def recordFootprint(inputBytes, peakRss, elapsed, path=FOOTPRINTS_PATH, runtime='singularity'):
+    """ Appends the measured footprint of a successful run to the history. """
+    entry = {'time': time.time(), 'runtime': runtime, 'inputBytes': inputBytes, 'peakRss': peakRss, 'elapsed': elapsed}
+    with _footprintsLock:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+#end recordFootprint()
+
+def estimateFootprint(inputBytes, history, default):
+    """ Expected peak memory of a run, from a least squares fit of peak
+    memory against input size over earlier runs, with a safety margin.
+
+    :type inputBytes: Integer
+    :param inputBytes: Size of the run's input.
+
+    :type history: List of Dictionaries
+    :param history: Output of loadFootprints.
+
+    :type default: Integer
+    :param default: Estimate in bytes when there is no history.
+
+    :rtype: Integer number of bytes.
+    """
+    points = [(h['inputBytes'], h['peakRss']) for h in history if h.get('peakRss')]
+    if len(points) == 0:
+        return int(default)
+    peaks = sorted(p for x, p in points)
+    estimate = peaks[-1]
+    n = float(len(points))
+    meanX, meanY = sum(x for x, p in points) / n, sum(p for x, p in points) / n
+    varX = sum((x - meanX) ** 2 for x, p in points)
+    if len(points) >= 3 and varX > 0:
+        slope = max(0.0, sum((x - meanX) * (p - meanY) for x, p in points) / varX)
+        # Never go below the smallest run seen, containers have a fixed base
+        estimate = max(peaks[0], meanY + slope * (inputBytes - meanX))
+    return int(estimate * FOOTPRINT_SAFETY_FACTOR)
+#end estimateFootprint()
+
+class Ticket(object):
+    """ An admitted run. Pass started as onStart to the command runner so
+    the memory of its process group is tracked.
+    """
+    def __init__(self, name, footprint, inputBytes):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.footprint = footprint
+        self.inputBytes = inputBytes
+        self.pgid = None
+        self.peakRss = 0
+        self.returnCode = None
+        self.admitted = time.time()
+
+    def started(self, pgid):
+        self.pgid = pgid
+#end Ticket
+
+class AdmissionController(object):
+    """ Admits container runs only when they fit on the node, see the
+    module description. Callers block until admitted, which throttles how
+    fast work is taken from the queue.
+
+    :type maxParallel: Integer
+    :param maxParallel: Ceiling on the runs active at the same time, the CPU count if None.
+
+    :type memPerSession: Integer
+    :param memPerSession: Footprint in bytes assumed while there is no history.
+
+    :type reserve: Integer
+    :param reserve: Bytes of memory that are always left free.
+
+    :type pressureLimit: Float
+    :param pressureLimit: Percentage of time stalled on memory or I/O
+    above which no further runs are admitted.
+
+    :type runtime: String
+    :param runtime: Runtime the footprints are kept under, see
+    footprintRuntime. None when they cannot be measured.
+    """
+    def __init__(self, maxParallel=None, memPerSession=None, reserve=ADMISSION_RESERVE_BYTES,
+            pressureLimit=ADMISSION_PRESSURE_LIMIT, interval=ADMISSION_POLL_SECONDS, footprintsPath=FOOTPRINTS_PATH,
+            runtime='singularity'):
+        self.maxParallel = max(1, maxParallel or getCpuCount())
+        self.memPerSession = memPerSession or DEFAULT_SESSION_MEMORY_GB * 1024 ** 3
+        self.reserve = reserve
+        self.pressureLimit = pressureLimit
+        self.interval = interval
+        self.footprintsPath = footprintsPath
+        self.runtime = runtime
+        self.history = loadFootprints(footprintsPath, runtime=runtime) if runtime is not None else []
+        self.running = {}
+        self.groupRss = {}
+        self.cond = threading.Condition()
+        self.closed = threading.Event()
+        self.monitor = None
+
+    def footprint(self, inputBytes):
+        return estimateFootprint(inputBytes, self.history, self.memPerSession)
+
+    def fits(self, footprint):
+        """ Tells whether a run with the given footprint can start now.
+        Called with the condition held.
+        """
+        if len(self.running) >= self.maxParallel:
+            return False
+        # A single run always goes, or a run larger than the node would never start
+        if len(self.running) == 0:
+            return True
+        for name in ('memory', 'io'):
+            stalled = pressureStall(name)
+            if stalled is not None and stalled > self.pressureLimit:
+                return False
+        available = getAvailableMemory()
+        if available is None:
+            return True
+        # Runs that just started have not reached their footprint yet
+        growth = sum(max(0, t.footprint - self.groupRss.get(t.pgid, 0)) for t in self.running.values())
+        return available - growth - self.reserve >= footprint
+
+    def acquire(self, name, inputBytes=0):
+        """ Blocks until a run fits.
+
+        :type name: String
+        :param name: Name of the run, e.g. its session.
+
+        :type inputBytes: Integer
+        :param inputBytes: Size of its input, used to estimate its footprint.
+
+        :rtype: Ticket
+        """
+        ticket = Ticket(name, self.footprint(inputBytes), inputBytes)
+        with self.cond:
+            self._startMonitor()
+            while not self.fits(ticket.footprint):
+                self.cond.wait(self.interval)
+            ticket.admitted = time.time()
+            self.running[ticket.id] = ticket
+        return ticket
+
+    def release(self, ticket, returnCode=None):
+        """ Frees the place of a finished run. The footprint of a successful
+        run is added to the history.
+        """
+        with self.cond:
+            self.running.pop(ticket.id, None)
+            peakRss = max(ticket.peakRss, self.groupRss.get(ticket.pgid, 0))
+            self.cond.notify_all()
+        if returnCode == 0 and peakRss > 0 and self.runtime is not None:
+            recordFootprint(ticket.inputBytes, peakRss, time.time() - ticket.admitted, self.footprintsPath, self.runtime)
+            self.history = (self.history + [{'inputBytes': ticket.inputBytes, 'peakRss': peakRss}])[-FOOTPRINT_HISTORY:]
+
+    @contextmanager
+    def admitted(self, name, inputBytes=0):
+        """ Context manager holding a Ticket for the duration of a run. Set
+        ticket.returnCode to record the footprint of a successful run.
+        """
+        ticket = self.acquire(name, inputBytes)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket, ticket.returnCode)
+
+    def _startMonitor(self):
+        if self.monitor is None:
+            self.monitor = threading.Thread(target=self._watch, daemon=True)
+            self.monitor.start()
+
+    def _watch(self):
+        while not self.closed.wait(self.interval):
+            rss = processGroupRss()
+            with self.cond:
+                self.groupRss = rss
+                for ticket in self.running.values():
+                    if ticket.pgid is not None:
+                        ticket.peakRss = max(ticket.peakRss, rss.get(ticket.pgid, 0))
+                self.cond.notify_all()
+
+    def close(self):
+        self.closed.set()
+        if self.monitor is not None:
+            self.monitor.join()
+#end AdmissionController
@@ -1,39 +1,195 @@
-import sys, subprocess, threading, time
+import sys, threading, time, logging, itertools, shlex
+from logging.handlers import RotatingFileHandler
 from termcolor import colored
 
-doneWorking = True
+from moseq2_build.utils.constants import STREAM_TAIL_LINES, STREAM_LOG_MAX_BYTES, STREAM_LOG_BACKUP_COUNT
+from moseq2_build.utils.execution import runCommand
 
-def executeCommand(commandString):
-    global doneWorking
+def executeCommand(commandString, stream=False, logPath=None, spinner=True, cwd=None, timeout=None):
     """ Executes the passed in command string and captures the output
     from stderr and stdout in a tuple and returns it. It also spawns a
     thread that is responsible for displaying a load cursor until the
-    command has been fully executed.
+    command has been fully executed. Every call keeps its own state, so
+    several commands can be executed from different threads at once.
     :type commandString: String
     :param commandString: Command(s) to be executed by subprocess
 
+    :type stream: Boolean
+    :param stream: Stream the output as it arrives instead of buffering
+    it, see streamCommand. Only the tail of the output is returned.
+
+    :type logPath: String
+    :param logPath: Rotating log file the streamed output is written to.
+
+    :type spinner: Boolean
+    :param spinner: Display the load cursor while the command runs.
+
+    :type cwd: String
+    :param cwd: Folder the command is executed in, the current one if None.
+
+    :type timeout: Float
+    :param timeout: Seconds after which the command and everything it
+    started is terminated, see runCommandAsync.
+
     :rtype: Tuple of stdin and stdout byte strings generated from
     executing passed in command string.
     """
-    doneWorking = False
-    spinThread = threading.Thread(target=spinCursor)
-    spinThread.start()
+    if stream:
+        return streamCommand(commandString, logPath, cwd=cwd, timeout=timeout)
 
-    proc = subprocess.Popen(commandString, stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True)
-    contents = proc.communicate()
+    done = threading.Event()
+    if spinner:
+        spinThread = threading.Thread(target=spinCursor, args=(done,))
+        spinThread.start()
 
-    doneWorking = True
-    spinThread.join()
-    return contents, proc.returncode
+    try:
+        return runCommand(commandString, cwd=cwd, timeout=timeout)
+    finally:
+        done.set()
+        if spinner:
+            spinThread.join()
 #end executeCommand()
 
-def spinCursor():
+_logCounter = itertools.count()
+
+def openRotatingLog(logPath):
+    """ Creates a logger that writes plain lines to a size-bounded,
+    rotating log file.
+
+    :type logPath: String
+    :param logPath: Location of the log file.
+
+    :rtype: Tuple of the logger and its handler, which must be closed
+    once the command has finished.
+    """
+    logger = logging.getLogger('moseq2_build.stream.{}'.format(next(_logCounter)))
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = RotatingFileHandler(logPath, maxBytes=STREAM_LOG_MAX_BYTES,
+        backupCount=STREAM_LOG_BACKUP_COUNT, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    return logger, handler
+#end openRotatingLog()
+
+def streamCommand(commandString, logPath=None, echo=True, tailLines=STREAM_TAIL_LINES, cwd=None, timeout=None):
+    """ Executes the passed in command string and reads its output line
+    by line as it is produced. Every line is echoed to the console and
+    written to a rotating log file, while only the last few lines of
+    each stream are kept in memory, so memory use does not grow with
+    the length of the job.
+
+    :type commandString: String
+    :param commandString: Command(s) to be executed by subprocess
+
+    :type logPath: String
+    :param logPath: Rotating log file receiving the output, or None.
+
+    :type echo: Boolean
+    :param echo: Whether the output is written to the console.
+
+    :type tailLines: Integer
+    :param tailLines: Number of lines of stdout and stderr to keep.
+
+    :type cwd: String
+    :param cwd: Folder the command is executed in, the current one if None.
+
+    :type timeout: Float
+    :param timeout: Seconds after which the command is terminated.
+
+    :rtype: Tuple of the stdout and stderr tails as byte strings, and
+    the return code of the command.
+    """
+    logger, handler = openRotatingLog(logPath) if logPath is not None else (None, None)
+    consoles = (sys.stdout, sys.stderr)
+
+    def onLine(index, line):
+        text = line.decode('utf-8', 'replace')
+        if echo:
+            consoles[index].write(text)
+            consoles[index].flush()
+        if logger is not None:
+            logger.info(text.rstrip('\r\n'))
+
+    try:
+        return runCommand(commandString, cwd=cwd, timeout=timeout, onLine=onLine, tailLines=tailLines)
+    finally:
+        if handler is not None:
+            logger.removeHandler(handler)
+            handler.close()
+#end streamCommand()
+
+def executeCommandToLog(commandString, logPath, timeout=None, onStart=None):
+    """ Executes the passed in command string, writing both stdout and
+    stderr to the given log file instead of holding them in memory.
+    Unlike executeCommand this does not touch the console, so it is safe
+    to call from several threads at once.
+
+    :type commandString: String
+    :param commandString: Command(s) to be executed by subprocess
+
+    :type logPath: String
+    :param logPath: File that will receive the combined output.
+
+    :type timeout: Float
+    :param timeout: Seconds after which the command is terminated.
+
+    :type onStart: Function
+    :param onStart: Called with the process group id of the command once it started.
+
+    :rtype: Integer return code of the command.
+    """
+    return runCommand(commandString, logPath=logPath, timeout=timeout, onStart=onStart)[1]
+#end executeCommandToLog()
+
+def buildContainerCommand(command, mountCommand, image, innerCommand, markerPath=None):
+    """ Assembles the full command line used to run a command inside of
+    the container image, in the activated moseq2 environment.
+
+    :type command: Dictionary
+    :param command: Container command table (e.g. SINGULARITY_COMS). Tables
+    with an 'instance' entry send the command to a running warm instance
+    instead of starting a new container, unless the command needs folders
+    the instance does not mount; an 'image' entry replaces the image path,
+    e.g. with the ID of a loaded docker image.
+
+    :type mountCommand: String
+    :param mountCommand: Mount arguments generated by mountDirectories.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :type innerCommand: String
+    :param innerCommand: Command that will be run in the container.
+
+    :type markerPath: String
+    :param markerPath: When given, the container appends a timestamp to this
+    file once it started and once the environment is activated, so the
+    time spent on both can be profiled.
+
+    :rtype: String
+    """
+    if 'instance' in command:
+        from moseq2_build.utils.instance import coldCommands
+        command = coldCommands(command['instance'], mountCommand) or command
+    activate = '' if 'instance' in command else 'source activate moseq2; '
+    if markerPath is not None:
+        stamp = 'echo {} $(date +%s.%N) >> "' + markerPath + '"; '
+        activate = stamp.format('container') + activate + stamp.format('activated')
+    if 'instance' in command:
+        return command['exec'] + ' ' + shlex.quote(activate + innerCommand)
+    bashCommand = " bash -c '" + activate + innerCommand + "'"
+    return command['exec'] + ' ' + mountCommand + ' ' + command.get('image', image) + bashCommand
+#end buildContainerCommand()
+
+def spinCursor(done):
     """ Thread function that spins a cursor while work
-    is being done. Uses a global variable to track whether
-    or not this thread should be joined.
+    is being done.
+
+    :type done: threading.Event
+    :param done: Set once the work is finished and the thread
+    should return.
     """
-    global doneWorking
     sys.stdout.flush()
     sys.stdout.write(colored("Executing commands ", "red", attrs=['bold']))
     while True:
@@ -41,7 +197,7 @@ def spinCursor():
             time.sleep(0.1)
             sys.stdout.write(colored("\rExecuting commands " + cursor + "\t\t", "red", attrs=['bold']))
             sys.stdout.flush()
-            if doneWorking:
+            if done.is_set():
                 sys.stdout.write('\n')
                 sys.stdout.write('\033[F')
                 sys.stdout.write('\033[K')
@@ -58,7 +214,8 @@ def panicIfStderr(retCode, output, msg):
 
     :type output: Tuple
     :param output: Tuple containing stdout and stderr output from
-    subprocess.communicate().
+    subprocess.communicate(). When the command was streamed this only
+    holds the last lines of each.
 
     :type msg: String
     :param msg: Message to print to the screen.
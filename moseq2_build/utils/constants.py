@@ -1,5 +1,5 @@
 from pathlib import Path
-import os, ruamel.yaml as yaml
+import copy, os
 
 FIBER_FLIP_PATH = '/moseq2_data/flip_files/flip_classifier_k2_largemicewithfiber.pkl'
 INSCOPIX_FLIP_PATH = '/moseq2_data/flip_files/flip_classifier_k2_inscopix.pkl'
@@ -7,18 +7,158 @@ C57_FLIP_PATH = '/moseq2_data/flip_files/flip_classifier_k2_c57_10to13weeks.pkl'
 DEFAULT_FLIP_PATH = C57_FLIP_PATH
 
 BATCH_TABLE = {'batch': ['--input-dir', '-i', '--config-file', '-c', '--filename']}
+# Options of moseq2-batch extract-batch that moseq2-extract does not know, with the batch option replacing them
+BATCH_ONLY_OPTIONS = {'--ncpus': '--cpus-per-job', '--mem': '--mem-per-job', '--temp-storage': None, '--prefix': None,
+    '--skip-checks': None}
+CLUSTER_TYPES = ['local', 'slurm']
 EXTRACT_TABLE = {'generate-config': ['-o', '--output-file'],
                 'extract': ['--config-file', '--flip-classifier']}
 SINGULARITY_COMS = {'exec': 'singularity exec', 'mount': '-B'}
+CONTAINER_RUNTIMES = ['auto', 'singularity', 'apptainer', 'docker', 'podman']
 ENVIRONMENT_CONFIG = os.path.join(str(Path.home()), ".config", "moseq2_environment", "moseq2_environment.yaml")
+SESSION_FILE_NAMES = ['depth.dat', 'depth.avi', 'depth.mkv']
+SESSION_LOG_NAME = 'moseq2-env-extract.log'
+DEFAULT_SESSION_MEMORY_GB = 8
+MANIFEST_NAME = 'moseq2-env-manifest.json'
+BATCH_SCRIPT_NAME = 'run_batch.sh'
+BATCH_JOBS_NAME = 'batch_jobs.json'
+# squeue and sacct calls are retried, the Slurm controller can be unreachable for a moment
+SLURM_QUERY_RETRIES = 3
+SLURM_QUERY_BACKOFF_SECONDS = 10
+STREAM_LOG_NAME = 'moseq2-env.log'
+STREAM_TAIL_LINES = 200
+STREAM_LOG_MAX_BYTES = 50 * 1024 * 1024
+STREAM_LOG_BACKUP_COUNT = 3
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_SEGMENTS = 8
+DOWNLOAD_RETRIES = 5
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_QUEUE_CHUNKS = 64
+INSTANCE_DIR = os.path.join(str(Path.home()), ".config", "moseq2_environment", "instances")
+IMAGE_STORE_DIR = os.path.join(str(Path.home()), ".config", "moseq2_environment", "store")
+SHARED_DEFAULT_NAME = 'default.json'
+PREWARM_CHUNK_SIZE = 16 * 1024 * 1024
+PREWARM_THREADS = 4
+RUNTIME_IMAGES_PATH = os.path.join(str(Path.home()), ".config", "moseq2_environment", "runtime_images.json")
+DOCKER_MANIFEST_NAME = 'manifest.json'
+SANDBOX_METADATA_DIR = '.singularity.d'
+CONFIG_CACHE_DIR = os.path.join(str(Path.home()), ".config", "moseq2_environment", "configs")
+SESSION_CONFIG_NAME = 'moseq2-env-config.yaml'
+RUN_RECORDS_PATH = os.path.join(str(Path.home()), ".config", "moseq2_environment", "runs.jsonl")
+TIMEOUT_RETURN_CODE = 124
+JOURNAL_NAME = 'moseq2-env-journal.jsonl'
+FAILURE_REPORT_NAME = 'moseq2-env-failures.json'
+RETRY_ATTEMPTS = 2
+# Container runtime errors (125, 255) and killed containers (137, 143)
+RETRY_RETURN_CODES = [125, 137, 143, 255]
+RETRY_BACKOFF_SECONDS = 10
+RETRY_BACKOFF_MAX_SECONDS = 300
+KILL_GRACE_SECONDS = 10
+STAGE_COPY_THREADS = 4
+STAGE_CHUNK_SIZE = 64 * 1024 * 1024
+STAGE_PREFETCH = 1
+PROFILE_SAMPLE_INTERVAL = 0.2
+FOOTPRINTS_PATH = os.path.join(str(Path.home()), ".config", "moseq2_environment", "footprints.jsonl")
+FOOTPRINT_HISTORY = 200
+FOOTPRINT_SAFETY_FACTOR = 1.25
+# Runtimes whose containers run in the process group of the command, so their memory can be measured
+FOOTPRINT_RUNTIMES = ['singularity', 'apptainer']
+ADMISSION_POLL_SECONDS = 0.5
+ADMISSION_RESERVE_BYTES = 512 * 1024 * 1024
+ADMISSION_PRESSURE_LIMIT = 25.0
+PROFILE_REGRESSION_THRESHOLD = 0.1
+COMPACT_SUFFIXES = ['.h5', '.hdf5', '.mp4', '.avi', '.yaml', '.yml', '.json']
+COMPACT_INDEX_NAME = 'moseq2-env-compact.json'
+# Configs users edit in place are never hardlinked, an edit would change every linked copy
+COMPACT_EDITABLE_SUFFIXES = ['.yaml', '.yml', '.json']
+# Byte shuffling followed by gzip, applied to every dataset; contiguous datasets become chunked
+H5REPACK_FILTERS = ['-f', 'SHUF', '-f', 'GZIP=4']
+PIPELINE_DIR = 'moseq2-pipeline'
+PIPELINE_RECORD_NAME = 'moseq2-env-stage.json'
+PIPELINE_LOG_NAME = 'moseq2-env-stage.log'
+# Stages run after the extractions, in the image. {data} is the folder holding the sessions,
+# {output} the folder of the stage and the name of an earlier stage the folder of that stage.
+PIPELINE_STAGES = [
+    {'name': 'aggregate', 'after': ['extract'], 'command': 'moseq2-extract aggregate-results -i {data} -o {output}'},
+    {'name': 'train-pca', 'after': ['aggregate'], 'command': 'moseq2-pca train-pca -i {aggregate} -o {output}'},
+    {'name': 'apply-pca', 'after': ['aggregate', 'train-pca'],
+        'command': 'moseq2-pca apply-pca -i {aggregate} -o {output} --pca-file {train-pca}/pca.h5'},
+    {'name': 'changepoints', 'after': ['aggregate', 'train-pca'],
+        'command': 'moseq2-pca compute-changepoints -i {aggregate} -o {output} --pca-file-components {train-pca}/pca.h5'},
+    {'name': 'model', 'after': ['apply-pca'], 'command': 'moseq2-model learn-model {apply-pca}/pca_scores.h5 {output}/model.p'},
+]
 GITHUB_LINK = "@api.github.com/repos/tischfieldlab/moseq2-build/releases"
+RELEASE_CACHE_DIR = os.path.join(str(Path.home()), ".config", "moseq2_environment", "releases")
+# Image types in the order of the download prompt; assets are matched by these names
+ASSET_KINDS = ['docker', 'singularity']
 
-def getDefaultImage():
-    if os.path.isfile(ENVIRONMENT_CONFIG):
+_environmentCache = {}
+
+def loadEnvironmentConfig():
+    """ Reads the environment config file. The parsed contents are cached
+    for as long as the file is not modified, so repeated lookups only
+    cost a stat call.
+
+    :rtype: Dictionary, empty if there is no config file yet.
+    """
+    try:
+        st = os.stat(ENVIRONMENT_CONFIG)
+    except OSError:
+        return {}
+    key = (ENVIRONMENT_CONFIG, st.st_mtime_ns, st.st_size)
+    if _environmentCache.get('key') != key:
+        import ruamel.yaml as yaml
         with open(ENVIRONMENT_CONFIG, "r") as f:
             contents = yaml.safe_load(f)
-        defaultImage = contents['defaultImage']
-    else:
-        defaultImage = None
-    return defaultImage
+        _environmentCache['key'] = key
+        _environmentCache['contents'] = contents or {}
+    return copy.deepcopy(_environmentCache['contents'])
+#end loadEnvironmentConfig()
+
+def getDefaultImage():
+    """ Returns the image set with "env -u", or else the default image of
+    the shared image store the environment is attached to.
+    """
+    contents = loadEnvironmentConfig()
+    if contents.get('defaultImage'):
+        return contents['defaultImage']
+    shared = sharedImageInfo(contents.get('sharedStore'))
+    return shared['image'] if shared is not None else None
 #end getDefaultImage()
+
+def getSharedStore():
+    return loadEnvironmentConfig().get('sharedStore')
+#end getSharedStore()
+
+def sharedImageInfo(storeRoot):
+    """ Reads the description of the default image an admin installed into
+    a shared image store.
+
+    :rtype: Dictionary with the image path and digest, or None.
+    """
+    if not storeRoot:
+        return None
+    import json
+    try:
+        with open(os.path.join(storeRoot, SHARED_DEFAULT_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+#end sharedImageInfo()
+
+def getReleaseSource():
+    """ Returns the release mirror set with "env --release-source", a
+    folder or url that is used instead of GitHub, or None.
+    """
+    return loadEnvironmentConfig().get('releaseSource')
+#end getReleaseSource()
+
+def getCacheBudget():
+    """ Returns the disk budget of the image store in bytes, or None
+    when the store may grow without limit.
+    """
+    budget = loadEnvironmentConfig().get('cacheBudgetGB')
+    if budget is None:
+        return None
+    return int(float(budget) * 1024 ** 3)
+#end getCacheBudget()
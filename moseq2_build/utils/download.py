@@ -0,0 +1,381 @@
+import hashlib, json, os, queue, re, shutil, tarfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+from moseq2_build.utils.constants import DOWNLOAD_CHUNK_SIZE, DOWNLOAD_SEGMENTS, DOWNLOAD_RETRIES, STREAM_CHUNK_SIZE, STREAM_QUEUE_CHUNKS
+
+class DownloadError(Exception):
+    pass
+#end DownloadError
+
+def assetStem(assetName):
+    """ Strips the archive extensions from an asset name. """
+    for ext in ('.tar.gz', '.tgz', '.tar'):
+        if assetName.endswith(ext):
+            return assetName[:-len(ext)]
+    return assetName
+#end assetStem()
+
+def createSession(poolSize=DOWNLOAD_SEGMENTS):
+    """ Creates a requests session whose connection pool is large enough
+    for every segment of a download to keep its own connection open.
+
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+#end createSession()
+
+def probeDownload(session, url, headers):
+    """ Asks the server for the first byte of the file to find its size,
+    the final location after redirects and whether ranges are supported.
+
+    :rtype: Tuple of the resolved url, total size in bytes (or None) and
+    a Boolean that is True when range requests are supported.
+    """
+    probeHeaders = dict(headers)
+    probeHeaders['Range'] = 'bytes=0-0'
+    with session.get(url, headers=probeHeaders, stream=True, timeout=60) as r:
+        if r.status_code == 206:
+            match = re.match(r'bytes \d+-\d+/(\d+)', r.headers.get('content-range', ''))
+            if match is not None:
+                return r.url, int(match.group(1)), True
+        if r.status_code in (200, 206):
+            length = r.headers.get('content-length')
+            return r.url, int(length) if length is not None else None, False
+        raise DownloadError('Server returned {} for {}'.format(r.status_code, url))
+#end probeDownload()
+
+def planSegments(totalSize, segments):
+    """ Splits a file of the given size into contiguous byte ranges.
+
+    :rtype: List of [start, end, done] lists, end inclusive.
+    """
+    segments = max(1, min(segments, totalSize // DOWNLOAD_CHUNK_SIZE + 1))
+    step = totalSize // segments
+    plan = []
+    for i in range(segments):
+        start = i * step
+        end = totalSize - 1 if i == segments - 1 else start + step - 1
+        plan.append([start, end, 0])
+    return plan
+#end planSegments()
+
+def loadPartialState(statePath, totalSize):
+    """ Loads the progress of an interrupted download, if any matches.
+
+    :rtype: List of segments or None.
+    """
+    if not os.path.isfile(statePath):
+        return None
+    try:
+        with open(statePath, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('size') != totalSize:
+        return None
+    return state['segments']
+#end loadPartialState()
+
+class _PartialState(object):
+    """ Tracks and persists the progress of every segment so an
+    interrupted download can continue where it stopped.
+    """
+    def __init__(self, statePath, totalSize, segments, progress):
+        self.statePath = statePath
+        self.totalSize = totalSize
+        self.segments = segments
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.save()
+
+    def save(self):
+        tmp = self.statePath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'size': self.totalSize, 'segments': self.segments}, f)
+        os.replace(tmp, self.statePath)
+
+    def advance(self, segment, nbytes):
+        with self.lock:
+            segment[2] += nbytes
+            self.save()
+        if self.progress is not None:
+            self.progress(nbytes)
+#end _PartialState
+
+def _fetchSegment(session, url, headers, partPath, segment, state):
+    start, end, done = segment
+    if start + done > end:
+        return
+    rangeHeaders = dict(headers)
+    rangeHeaders['Range'] = 'bytes={}-{}'.format(start + done, end)
+    with session.get(url, headers=rangeHeaders, stream=True, timeout=60) as r:
+        if r.status_code != 206:
+            raise DownloadError('Range request returned {}'.format(r.status_code))
+        with open(partPath, 'r+b') as f:
+            f.seek(start + done)
+            for data in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(data)
+                f.flush()
+                state.advance(segment, len(data))
+    if segment[0] + segment[2] <= segment[1]:
+        raise DownloadError('Connection closed before the segment was complete')
+#end _fetchSegment()
+
+def _fetchWhole(session, url, headers, partPath, progress):
+    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code != 200:
+            raise DownloadError('Server returned {} for {}'.format(r.status_code, url))
+        with open(partPath, 'wb') as f:
+            for data in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(data)
+                if progress is not None:
+                    progress(len(data))
+#end _fetchWhole()
+
+def downloadFile(url, outputPath, headers=None, session=None, segments=DOWNLOAD_SEGMENTS,
+        retries=DOWNLOAD_RETRIES, progress=None, onSize=None):
+    """ Downloads a file by fetching several byte ranges of it at the same
+    time. Progress is kept next to the partial file (outputPath + '.part')
+    so that an interrupted download resumes instead of starting over.
+
+    :type url: String
+    :param url: Location of the file.
+
+    :type outputPath: String
+    :param outputPath: Where the finished file is written.
+
+    :type headers: Dictionary
+    :param headers: Extra request headers.
+
+    :type session: requests.Session
+    :param session: Session to reuse connections from.
+
+    :type segments: Integer
+    :param segments: Number of ranges fetched in parallel.
+
+    :type retries: Integer
+    :param retries: Number of times the download is resumed after an error.
+
+    :type progress: Function
+    :param progress: Called with the number of bytes of every received chunk.
+
+    :type onSize: Function
+    :param onSize: Called with the total size and the number of bytes
+    already present before the transfer starts.
+
+    :rtype: String path of the downloaded file.
+    """
+    headers = headers or {}
+    session = session or createSession(segments)
+    partPath = outputPath + '.part'
+    statePath = partPath + '.json'
+
+    for attempt in range(retries + 1):
+        try:
+            resolved, totalSize, ranges = probeDownload(session, url, headers)
+            if onSize is not None:
+                onSize(totalSize, 0)
+
+            if not ranges or not totalSize:
+                _fetchWhole(session, resolved, headers, partPath, progress)
+            else:
+                plan = loadPartialState(statePath, totalSize) if os.path.isfile(partPath) else None
+                if plan is None:
+                    plan = planSegments(totalSize, segments)
+                    with open(partPath, 'wb') as f:
+                        f.truncate(totalSize)
+                elif onSize is not None:
+                    onSize(totalSize, sum(s[2] for s in plan))
+                state = _PartialState(statePath, totalSize, plan, progress)
+                with ThreadPoolExecutor(max_workers=len(plan)) as pool:
+                    futures = [pool.submit(_fetchSegment, session, resolved, headers, partPath, s, state)
+                        for s in plan]
+                    for future in futures:
+                        future.result()
+                os.remove(statePath)
+            os.replace(partPath, outputPath)
+            return outputPath
+        except (requests.RequestException, DownloadError, OSError) as e:
+            if attempt == retries:
+                raise DownloadError('Failed to download {}: {}'.format(url, e))
+            time.sleep(min(2 ** attempt, 30))
+#end downloadFile()
+
+def fileDigest(path, algorithm='sha256'):
+    """ Computes the digest of a file without reading it into memory.
+
+    :rtype: String of the form "<algorithm>:<hex digest>".
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            h.update(block)
+    return algorithm + ':' + h.hexdigest()
+#end fileDigest()
+
+def verifyDigest(path, expected):
+    """ Checks the file against the expected digest.
+
+    :type expected: String
+    :param expected: Digest of the form "<algorithm>:<hex digest>".
+
+    :rtype: String digest of the file, raises DownloadError on a mismatch.
+    """
+    if ':' not in expected:
+        expected = 'sha256:' + expected
+    algorithm = expected.split(':', 1)[0]
+    actual = fileDigest(path, algorithm)
+    if actual.lower() != expected.lower():
+        raise DownloadError('Digest mismatch for {}: expected {}, got {}'.format(path, expected, actual))
+    return actual
+#end verifyDigest()
+
+def extractTar(tar, path):
+    """ Unpacks an opened archive into path. Members that are absolute,
+    leave path through "..", or are links pointing outside of it are
+    rejected, as the archives come from the network.
+
+    :rtype: None, raises DownloadError on an unsafe member.
+    """
+    if hasattr(tarfile, 'data_filter'):
+        def memberFilter(member, dest):
+            # The data filter would only strip the leading slash
+            if os.path.isabs(member.name):
+                raise DownloadError('Unsafe archive member: {}'.format(member.name))
+            return tarfile.data_filter(member, dest)
+        try:
+            tar.extractall(path=path, filter=memberFilter)
+        except tarfile.FilterError as e:
+            raise DownloadError('Unsafe archive member: {}'.format(e))
+        return
+    for member in tar:
+        names = [member.name]
+        if member.issym():
+            names.append(os.path.join(os.path.dirname(member.name), member.linkname))
+        elif member.islnk():
+            names.append(member.linkname)
+        for name in names:
+            if os.path.isabs(name) or '..' in os.path.normpath(name).split(os.sep):
+                raise DownloadError('Unsafe archive member: {}'.format(member.name))
+        tar.extract(member, path=path)
+#end extractTar()
+
+class _QueueReader(object):
+    """ Read-only file object fed with chunks from a queue, so tarfile can
+    decode a download while it is still arriving. A None chunk marks
+    the end of the stream, an exception chunk is raised to the reader.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = b''
+        self.pos = 0
+        self.eof = False
+
+    def read(self, n=-1):
+        out = []
+        while n != 0:
+            if self.pos == len(self.buf):
+                if self.eof:
+                    break
+                data = self.chunks.get()
+                if data is None:
+                    self.eof = True
+                    break
+                if isinstance(data, BaseException):
+                    raise data
+                self.buf, self.pos = data, 0
+            take = len(self.buf) - self.pos if n < 0 else min(n, len(self.buf) - self.pos)
+            out.append(self.buf[self.pos:self.pos + take])
+            self.pos += take
+            if n > 0:
+                n -= take
+        return b''.join(out)
+#end _QueueReader
+
+def streamExtract(url, outputDir, headers=None, session=None, progress=None, onSize=None,
+        algorithm='sha256', expected=None):
+    """ Downloads a .tar.gz archive and unpacks it while it arrives, so the
+    archive never has to be stored on disk. Decompression runs in its
+    own thread and is fed through a bounded queue, overlapping network
+    and CPU work. The files are unpacked into outputDir + '.partial',
+    which is renamed to outputDir once the whole stream was read and
+    matched the expected digest, so a mismatch never replaces outputDir.
+
+    :type url: String
+    :param url: Location of the archive.
+
+    :type outputDir: String
+    :param outputDir: Folder the archive is unpacked into.
+
+    :type expected: String
+    :param expected: Digest of the form "<algorithm>:<hex digest>", not checked if None.
+
+    :rtype: String digest of the downloaded archive, "<algorithm>:<hex>".
+    """
+    headers = headers or {}
+    session = session or createSession(1)
+    partialDir = outputDir + '.partial'
+    if os.path.isdir(partialDir):
+        shutil.rmtree(partialDir)
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    failure = []
+
+    def decode():
+        reader = _QueueReader(chunks)
+        try:
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                extractTar(tar, partialDir)
+        except BaseException as e:
+            failure.append(e)
+        # Drain whatever follows the archive so the downloading side never blocks
+        while not reader.eof and chunks.get() is not None:
+            pass
+
+    if expected is not None:
+        if ':' not in expected:
+            expected = 'sha256:' + expected
+        algorithm = expected.split(':', 1)[0]
+    h = hashlib.new(algorithm)
+    decoder = threading.Thread(target=decode)
+    decoder.start()
+    try:
+        with session.get(url, headers=headers, stream=True, timeout=60) as r:
+            if r.status_code != 200:
+                raise DownloadError('Server returned {} for {}'.format(r.status_code, url))
+            if onSize is not None:
+                length = r.headers.get('content-length')
+                onSize(int(length) if length is not None else None, 0)
+            for data in r.iter_content(STREAM_CHUNK_SIZE):
+                h.update(data)
+                chunks.put(data)
+                if progress is not None:
+                    progress(len(data))
+        chunks.put(None)
+    except BaseException as e:
+        chunks.put(e if isinstance(e, DownloadError) else DownloadError(str(e)))
+        chunks.put(None)
+        decoder.join()
+        shutil.rmtree(partialDir, ignore_errors=True)
+        if isinstance(e, (requests.RequestException, OSError)):
+            raise DownloadError('Failed to download {}: {}'.format(url, e))
+        raise
+    decoder.join()
+
+    if len(failure) != 0:
+        shutil.rmtree(partialDir, ignore_errors=True)
+        raise DownloadError('Failed to unpack {}: {}'.format(url, failure[0]))
+    actual = algorithm + ':' + h.hexdigest()
+    if expected is not None and actual.lower() != expected.lower():
+        shutil.rmtree(partialDir, ignore_errors=True)
+        raise DownloadError('Digest mismatch for {}: expected {}, got {}'.format(url, expected, actual))
+    if os.path.isdir(outputDir):
+        shutil.rmtree(outputDir)
+    os.replace(partialDir, outputDir)
+    return actual
+#end streamExtract()
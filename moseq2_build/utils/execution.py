@@ -0,0 +1,185 @@
+""" Asyncio execution core for container commands.
+
+Every command runs in its own process group, so a timeout, a cancelled task
+or Ctrl-C terminates the container together with everything it started:
+first with SIGTERM, then with SIGKILL once the grace period is over. Many
+commands can run at the same time on one event loop; runCommand wraps a
+single command for synchronous callers.
+"""
+import asyncio, os, re, signal, subprocess, threading, time
+from collections import deque
+
+from moseq2_build.utils.constants import TIMEOUT_RETURN_CODE, KILL_GRACE_SECONDS
+
+_liveGroups = set()
+_liveLock = threading.Lock()
+_LINE_END = re.compile(rb'\r\n|\r|\n')
+
+async def terminateProcessGroup(proc, grace=KILL_GRACE_SECONDS):
+    """ Stops the process group of proc, escalating to SIGKILL when it does
+    not exit within grace seconds.
+    """
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        await asyncio.wait_for(proc.wait(), grace)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+#end terminateProcessGroup()
+
+def terminateAllCommands(grace=KILL_GRACE_SECONDS):
+    """ Stops the process groups of every command that is still running, in
+    any thread. Used when the main thread is interrupted while worker
+    threads wait on their commands.
+    """
+    with _liveLock:
+        groups = list(_liveGroups)
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        alive = []
+        for pgid in groups:
+            try:
+                os.killpg(pgid, sig)
+                alive.append(pgid)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + grace
+        while len(alive) != 0 and time.time() < deadline:
+            alive = [pgid for pgid in alive if groupAlive(pgid)]
+            time.sleep(0.05)
+        groups = alive
+#end terminateAllCommands()
+
+def groupAlive(pgid):
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+#end groupAlive()
+
+async def _pump(stream, chunks, onLine, index):
+    if onLine is None:
+        while True:
+            data = await stream.read(65536)
+            if not data:
+                break
+            chunks.append(data)
+        return
+    # Lines are split by hand rather than with readline, which fails once
+    # 64 KiB arrive without a newline, e.g. progress bars redrawn with \r
+    pending = b''
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            break
+        pending += data
+        start = 0
+        for match in _LINE_END.finditer(pending):
+            if match.end() == len(pending) and match.group() == b'\r':
+                break  # The \n of a \r\n may still be on its way
+            line = pending[start:match.end()]
+            chunks.append(line)
+            onLine(index, line)
+            start = match.end()
+        pending = pending[start:]
+    if pending:
+        chunks.append(pending)
+        onLine(index, pending)
+#end _pump()
+
+async def runCommandAsync(commandString, timeout=None, cwd=None, logPath=None, onLine=None, tailLines=None,
+        grace=KILL_GRACE_SECONDS, onStart=None):
+    """ Runs a shell command in its own process group.
+
+    :type commandString: String
+    :param commandString: Command(s) to be executed by the shell.
+
+    :type timeout: Float
+    :param timeout: Seconds after which the command is terminated. Such
+    commands return TIMEOUT_RETURN_CODE.
+
+    :type cwd: String
+    :param cwd: Folder the command is executed in, the current one if None.
+
+    :type logPath: String
+    :param logPath: File receiving stdout and stderr instead of capturing them.
+
+    :type onLine: Function
+    :param onLine: Called with the stream index (0 for stdout, 1 for
+    stderr) and every line of output as it arrives.
+
+    :type tailLines: Integer
+    :param tailLines: Only keep this many chunks of each stream in memory.
+
+    :type onStart: Function
+    :param onStart: Called with the process group id once the command started.
+
+    :rtype: Tuple of the stdout and stderr byte strings, and the return code.
+    """
+    log = open(logPath, 'wb') if logPath is not None else None
+    try:
+        proc = await asyncio.create_subprocess_exec('/bin/sh', '-c', commandString, cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=log if log is not None else subprocess.PIPE,
+            stderr=subprocess.STDOUT if log is not None else subprocess.PIPE,
+            start_new_session=True)
+    finally:
+        if log is not None:
+            log.close()
+    with _liveLock:
+        _liveGroups.add(proc.pid)
+    if onStart is not None:
+        onStart(proc.pid)
+
+    outputs = (deque(maxlen=tailLines), deque(maxlen=tailLines))
+    async def collect():
+        if log is None:
+            await asyncio.gather(_pump(proc.stdout, outputs[0], onLine, 0),
+                _pump(proc.stderr, outputs[1], onLine, 1))
+        return await proc.wait()
+
+    try:
+        retCode = await asyncio.wait_for(collect(), timeout)
+    except asyncio.TimeoutError:
+        await terminateProcessGroup(proc, grace)
+        retCode = TIMEOUT_RETURN_CODE
+    except BaseException:
+        # Cancelled, e.g. by Ctrl-C: do not leave the container behind
+        await asyncio.shield(terminateProcessGroup(proc, grace))
+        raise
+    finally:
+        with _liveLock:
+            _liveGroups.discard(proc.pid)
+    return (b''.join(outputs[0]), b''.join(outputs[1])), retCode
+#end runCommandAsync()
+
+async def runCommandsAsync(commandStrings, limit=None, **kwargs):
+    """ Runs many commands on one event loop, at most limit at a time.
+
+    :rtype: List of the results of runCommandAsync, in the order given.
+    """
+    semaphore = asyncio.Semaphore(limit or len(commandStrings) or 1)
+    async def bounded(commandString):
+        async with semaphore:
+            return await runCommandAsync(commandString, **kwargs)
+    return await asyncio.gather(*[bounded(c) for c in commandStrings])
+#end runCommandsAsync()
+
+def runCommand(commandString, **kwargs):
+    """ Synchronous wrapper of runCommandAsync, usable from any thread
+    that is not running an event loop itself.
+
+    :rtype: Tuple of the stdout and stderr byte strings, and the return code.
+    """
+    return asyncio.run(runCommandAsync(commandString, **kwargs))
+#end runCommand()
@@ -0,0 +1,393 @@
+""" Warm container instances.
+
+An instance is a small server process that keeps one or more shells open
+inside of the container, with the moseq2 environment already activated.
+Commands are sent to it over a unix socket, so they do not pay for
+mounting the image and activating conda every time. A command is
+cancelled when its client goes away, e.g. after a timeout or Ctrl-C.
+The output of a command is returned once it finished, so it is not
+streamed while the command runs.
+
+    python -m moseq2_build.utils.instance serve NAME IMAGE [--bind DIR]...
+    python -m moseq2_build.utils.instance exec NAME COMMAND
+"""
+import argparse, json, os, queue, shlex, signal, socket, socketserver, subprocess, sys, threading, time, uuid
+
+from moseq2_build.utils.constants import INSTANCE_DIR, SINGULARITY_COMS, KILL_GRACE_SECONDS
+from moseq2_build.utils.runtimes import selectDriver
+
+def instancePaths(name):
+    """ Locations of the socket and metadata file of an instance.
+
+    :rtype: Tuple of Strings
+    """
+    return os.path.join(INSTANCE_DIR, name + '.sock'), os.path.join(INSTANCE_DIR, name + '.json')
+#end instancePaths()
+
+def instanceCommands(name):
+    """ Container command table that sends commands to a running instance
+    instead of starting a container, for use with buildContainerCommand.
+
+    :rtype: Dictionary
+    """
+    client = ' '.join(shlex.quote(a) for a in [sys.executable, '-m', 'moseq2_build.utils.instance', 'exec', name])
+    return {'exec': client, 'mount': SINGULARITY_COMS['mount'], 'instance': name}
+#end instanceCommands()
+
+def instanceInfo(name):
+    """ Metadata of a running instance: its image, binds and workers.
+
+    :rtype: Dictionary, or None if the instance is not running.
+    """
+    _, metaPath = instancePaths(name)
+    try:
+        with open(metaPath, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+#end instanceInfo()
+
+def coldCommands(name, mountCommand):
+    """ Container command table to use instead of an instance when a
+    command needs folders the instance was not started with, which are not
+    visible inside of it. Such commands run in a new container of the
+    instance's image.
+
+    :type mountCommand: String
+    :param mountCommand: Mount arguments generated by mountDirectories.
+
+    :rtype: Dictionary, or None when the instance sees every folder or is
+    not running.
+    """
+    from moseq2_build.utils.mount import boundPaths, isInside
+
+    info = instanceInfo(name)
+    if info is None or all(any(isInside(p, b) for b in info['binds']) for p in boundPaths(mountCommand)):
+        return None
+    table = selectDriver(info['image']).commands(info['image'])
+    table['image'] = table.get('image', info['image'])
+    return table
+#end coldCommands()
+
+class WarmShell(object):
+    """ A bash shell running inside of the container in the activated
+    environment. Commands are written to its stdin one at a time and run
+    in a background subshell, whose process id is reported so the command
+    can be cancelled; their output goes to files and a marker line reports
+    the return code.
+    """
+    def __init__(self, shellCommand, workDir):
+        self.shellCommand = shellCommand
+        self.workDir = workDir
+        self.proc = None
+        self.jobPid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.proc = subprocess.Popen(self.shellCommand, shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, start_new_session=True)
+        self.run('true', os.getcwd())
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def run(self, command, cwd, cancelled=None):
+        """ Runs a command in the shell from the given folder.
+
+        :type cancelled: threading.Event
+        :param cancelled: Once set, the command is killed as soon as it started.
+
+        :rtype: Tuple of the stdout and stderr byte strings and the return code.
+        """
+        if not self.alive():
+            self.proc = None
+            self.start()
+        token = uuid.uuid4().hex
+        out = os.path.join(self.workDir, token + '.out')
+        err = os.path.join(self.workDir, token + '.err')
+        line = '( cd {} && {} ) > {} 2> {} < /dev/null & echo "{} pid $!"; wait $!; echo "{} $?"\n'.format(
+            shlex.quote(cwd), command, shlex.quote(out), shlex.quote(err), token, token)
+        self.proc.stdin.write(line.encode('utf-8'))
+        self.proc.stdin.flush()
+        retCode = None
+        try:
+            for reply in iter(self.proc.stdout.readline, b''):
+                reply = reply.decode('utf-8', 'replace').split()
+                if len(reply) == 3 and reply[:2] == [token, 'pid']:
+                    with self.lock:
+                        self.jobPid = int(reply[2])
+                    if cancelled is not None and cancelled.is_set():
+                        self.cancel()
+                elif len(reply) == 2 and reply[0] == token:
+                    retCode = int(reply[1])
+                    break
+        finally:
+            with self.lock:
+                self.jobPid = None
+        if retCode is None:
+            raise RuntimeError('The container shell exited unexpectedly')
+        contents = []
+        for path in (out, err):
+            try:
+                with open(path, 'rb') as f:
+                    contents.append(f.read())
+                os.remove(path)
+            except OSError:
+                contents.append(b'')
+        return (contents[0], contents[1]), retCode
+
+    def cancel(self):
+        """ Terminates the running command and everything it started,
+        killing what is left after a grace period. Containers share the
+        process ids of the host, so the server can signal them.
+        """
+        from moseq2_build.utils.profiling import childProcesses
+
+        with self.lock:
+            pid = self.jobPid
+            if pid is None:
+                return
+            pids = [pid] + childProcesses(pid)
+            self._signal(pids, signal.SIGTERM)
+        timer = threading.Timer(KILL_GRACE_SECONDS, self._kill, (pid, pids))
+        timer.daemon = True
+        timer.start()
+
+    def _kill(self, pid, pids):
+        with self.lock:
+            if self.jobPid == pid:
+                self._signal(pids, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(self):
+        if self.alive():
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+#end WarmShell
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        server = self.server
+        if request.get('stop'):
+            self.reply({'stopped': True})
+            threading.Thread(target=server.shutdown).start()
+            return
+        # The client only sends its request, the end of the connection means it went away
+        gone, finished, shells = threading.Event(), threading.Event(), []
+        def watch():
+            try:
+                while self.connection.recv(4096):
+                    pass
+            except OSError:
+                pass
+            gone.set()
+            if not finished.is_set() and len(shells) != 0:
+                shells[0].cancel()
+        threading.Thread(target=watch, daemon=True).start()
+        shell = server.shells.get()
+        shells.append(shell)
+        try:
+            if gone.is_set():
+                return
+            (stdout, stderr), retCode = shell.run(request['command'], request['cwd'], gone)
+        except Exception as e:
+            (stdout, stderr), retCode = (b'', str(e).encode('utf-8')), 1
+        finally:
+            finished.set()
+            server.shells.put(shell)
+        self.reply({'returnCode': retCode, 'stdout': stdout.decode('utf-8', 'replace'),
+            'stderr': stderr.decode('utf-8', 'replace')})
+
+    def reply(self, response):
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+#end _RequestHandler
+
+class _InstanceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+#end _InstanceServer
+
+def serveInstance(name, image, binds=(), workers=1, command=None):
+    """ Runs the server of an instance until it is stopped. Every worker
+    is a separate warm shell, so up to that many commands run at once.
+
+    :type binds: List of Strings
+    :param binds: Folders mounted into the container.
+
+    :type command: Dictionary
+    :param command: Container command table, singularity or apptainer
+    depending on what is installed if None.
+    """
+    if command is None:
+        command = selectDriver(image).commands(image)
+    socketPath, metaPath = instancePaths(name)
+    workDir = os.path.join(INSTANCE_DIR, name)
+    os.makedirs(workDir, exist_ok=True)
+    binds = [os.path.abspath(b) for b in binds] + [INSTANCE_DIR]
+    mountCommand = ' '.join(command['mount'] + ' ' + shlex.quote(b) for b in binds)
+    shellCommand = '{} {} {} bash --noprofile --norc'.format(command['exec'], mountCommand, image)
+
+    shells = queue.Queue()
+    for i in range(max(1, workers)):
+        shell = WarmShell(shellCommand, workDir)
+        shell.start()
+        shell.run('source activate moseq2', os.getcwd())
+        shells.put(shell)
+
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = _InstanceServer(socketPath, _RequestHandler)
+    server.shells = shells
+    with open(metaPath, 'w') as f:
+        json.dump({'name': name, 'image': image, 'binds': binds, 'workers': workers, 'pid': os.getpid(),
+            'started': time.time()}, f)
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        while not shells.empty():
+            shells.get().stop()
+        for path in (socketPath, metaPath):
+            if os.path.exists(path):
+                os.remove(path)
+#end serveInstance()
+
+def sendRequest(name, request):
+    """ Sends a request to a running instance and returns its reply.
+
+    :rtype: Dictionary
+    """
+    socketPath, _ = instancePaths(name)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = sock.recv(65536)
+            if not data:
+                break
+            reply += data
+    return json.loads(reply.decode('utf-8'))
+#end sendRequest()
+
+def runInInstance(name, command, cwd=None):
+    """ Runs a command in a running instance.
+
+    :rtype: Tuple of the stdout and stderr byte strings and the return code,
+    like executeCommand.
+    """
+    reply = sendRequest(name, {'command': command, 'cwd': cwd or os.getcwd()})
+    return (reply['stdout'].encode('utf-8'), reply['stderr'].encode('utf-8')), reply['returnCode']
+#end runInInstance()
+
+def startInstance(name, image, binds=(), workers=1, timeout=120):
+    """ Starts the server of an instance in the background and waits until
+    it accepts commands.
+
+    :rtype: Integer process id of the server.
+    """
+    socketPath, metaPath = instancePaths(name)
+    if isRunning(name):
+        raise RuntimeError('Instance {} is already running'.format(name))
+    try:
+        driver = selectDriver(image)
+    except ValueError as e:
+        raise RuntimeError(str(e))
+    if not driver.supportsInstances:
+        raise RuntimeError('Warm instances are not supported with {}'.format(driver.name))
+    os.makedirs(INSTANCE_DIR, exist_ok=True)
+    args = [sys.executable, '-m', 'moseq2_build.utils.instance', 'serve', name, os.path.abspath(image),
+        '--workers', str(workers)]
+    for b in binds:
+        args += ['--bind', b]
+    with open(os.path.join(INSTANCE_DIR, name + '.log'), 'wb') as log:
+        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+            start_new_session=True)
+    deadline = time.time() + timeout
+    while not os.path.exists(metaPath):
+        if proc.poll() is not None:
+            raise RuntimeError('Instance {} failed to start, see {}.log'.format(name, os.path.join(INSTANCE_DIR, name)))
+        if time.time() > deadline:
+            proc.kill()
+            raise RuntimeError('Instance {} did not start within {} seconds'.format(name, timeout))
+        time.sleep(0.05)
+    return proc.pid
+#end startInstance()
+
+def stopInstance(name):
+    """ Stops a running instance. """
+    sendRequest(name, {'stop': True})
+    _, metaPath = instancePaths(name)
+    while os.path.exists(metaPath):
+        time.sleep(0.05)
+#end stopInstance()
+
+def isRunning(name):
+    socketPath, _ = instancePaths(name)
+    if not os.path.exists(socketPath):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socketPath)
+        return True
+    except OSError:
+        return False
+#end isRunning()
+
+def listInstances():
+    """ Metadata of every running instance.
+
+    :rtype: List of Dictionaries
+    """
+    instances = []
+    if not os.path.isdir(INSTANCE_DIR):
+        return instances
+    for fname in sorted(os.listdir(INSTANCE_DIR)):
+        if fname.endswith('.json') and isRunning(fname[:-len('.json')]):
+            with open(os.path.join(INSTANCE_DIR, fname), 'r') as f:
+                instances.append(json.load(f))
+    return instances
+#end listInstances()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m moseq2_build.utils.instance')
+    sub = parser.add_subparsers(dest='action')
+    serve = sub.add_parser('serve')
+    serve.add_argument('name')
+    serve.add_argument('image')
+    serve.add_argument('--bind', action='append', default=[])
+    serve.add_argument('--workers', type=int, default=1)
+    run = sub.add_parser('exec')
+    run.add_argument('name')
+    run.add_argument('command')
+    args = parser.parse_args(argv)
+
+    if args.action == 'serve':
+        serveInstance(args.name, args.image, args.bind, args.workers)
+        return 0
+    if args.action == 'exec':
+        try:
+            (stdout, stderr), retCode = runInInstance(args.name, args.command)
+        except OSError:
+            sys.stderr.write('Instance {} is not running\n'.format(args.name))
+            return 1
+        sys.stdout.write(stdout.decode('utf-8'))
+        sys.stderr.write(stderr.decode('utf-8'))
+        return retCode
+    parser.print_help()
+    return 1
+#end main()
+
+if __name__ == '__main__':
+    sys.exit(main())
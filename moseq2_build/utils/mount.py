@@ -1,27 +1,150 @@
-import os, ruamel.yaml as yaml
+import os, shlex, threading
 
-def mountDirectories(remainder, mountString, comTable):
-    pathKeys=[]
-    mountCommand = ''
-    if (len(remainder) == 0):
+_planCache = {}
+_planLock = threading.Lock()
+
+def mountDirectories(remainder, mountString, comTable, extraPaths=(), fullBinds=False):
+    """ Builds the bind mount arguments that make every path passed to the
+    command, and the folders it writes to, visible inside of the container.
+
+    :type remainder: List of Strings
+    :param remainder: Arguments passed through to the container command.
+
+    :type mountString: String
+    :param mountString: Mount flag of the container runtime, e.g. -B.
+
+    :type comTable: List of Strings
+    :param comTable: Options in remainder whose values are paths.
+
+    :type extraPaths: List of Strings
+    :param extraPaths: Additional paths that must be visible in the container.
+
+    :type fullBinds: Boolean
+    :param fullBinds: Write every bind as 'source:destination', as docker
+    and podman need.
+
+    :rtype: String, empty when every path is at the root of the filesystem,
+    which is never mounted. Raises ValueError when an option of comTable
+    has no value.
+    """
+    pathKeys = [os.path.abspath(p) for p in extraPaths]
+    if (len(remainder) == 0 and len(pathKeys) == 0):
         return ''
 
     for param in comTable:
         if param in remainder:
             idx = remainder.index(param) + 1
             if idx >= len(remainder):
-                print('Please make sure each parameter has a valid value.')
-                exit(1)
+                raise ValueError('Please make sure each parameter has a valid value.')
 
             pathKeys.append(os.path.abspath(remainder[idx]))
 
-            if len(pathKeys) != 0:
-                longestCommonPath = os.path.dirname(os.path.commonprefix(pathKeys))
-
-                if longestCommonPath == '\\' or longestCommonPath == '/':
-                    print('Common path is root, so it will not be mounted.')
-                else:
-                    mountCommand = mountString + ' ' + longestCommonPath
-    return mountCommand
+    binds = planMounts(pathKeys)
+    if fullBinds:
+        binds = [b if ':' in b else b + ':' + b for b in binds]
+    return ' '.join(mountString + ' ' + shlex.quote(bind) for bind in binds)
 #end mountDirectories()
 
+def boundPaths(mountCommand):
+    """ Paths that mount arguments made by mountDirectories make visible
+    inside of the container.
+
+    :rtype: List of Strings
+    """
+    args = shlex.split(mountCommand)
+    return [bind.split(':')[-1] for bind in args[1::2]]
+#end boundPaths()
+
+def planMounts(paths):
+    """ Plans the smallest set of bind mounts covering the passed in paths.
+    Plans are cached per set of paths.
+
+    :type paths: List of Strings
+    :param paths: Absolute paths of the inputs and outputs of a command.
+
+    :rtype: List of bind specifications, either a folder or
+    'source:destination' for folders reached through a symlink.
+    """
+    key = frozenset(paths)
+    with _planLock:
+        if key in _planCache:
+            return list(_planCache[key])
+    plan = _computePlan(paths)
+    with _planLock:
+        _planCache[key] = plan
+    return list(plan)
+#end planMounts()
+
+def clearMountPlans():
+    with _planLock:
+        _planCache.clear()
+#end clearMountPlans()
+
+def existingFolder(path):
+    """ Folder that has to be mounted for path: the path itself if it is a
+    folder, otherwise its parent, going up until the folder exists so that
+    outputs which are not created yet are covered.
+
+    :rtype: String
+    """
+    folder = path if os.path.isdir(path) else os.path.dirname(path)
+    while not os.path.isdir(folder) and folder != os.path.dirname(folder):
+        folder = os.path.dirname(folder)
+    return folder
+#end existingFolder()
+
+def mountPoint(path):
+    """ Root of the filesystem containing path.
+
+    :rtype: String
+    """
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+#end mountPoint()
+
+def isInside(path, folder):
+    return path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+#end isInside()
+
+def _computePlan(paths):
+    plain, linked = set(), set()
+    for path in paths:
+        logical = os.path.normpath(existingFolder(path))
+        real = os.path.realpath(logical)
+        if real == os.sep:
+            continue
+        if real == logical:
+            plain.add(real)
+        else:
+            linked.add((real, logical))
+
+    # Folders on the same filesystem are merged into their common ancestor,
+    # as long as that does not mean mounting the whole filesystem
+    groups = {}
+    for folder in plain:
+        groups.setdefault(os.stat(folder).st_dev, []).append(folder)
+    binds = []
+    for folders in groups.values():
+        root = mountPoint(folders[0])
+        folders = sorted(folders)
+        merged = [folders[0]]
+        for folder in folders[1:]:
+            common = os.path.commonpath([merged[-1], folder])
+            if isInside(folder, merged[-1]):
+                continue
+            if common != os.sep and common != root and isInside(common, root):
+                merged[-1] = common
+            else:
+                merged.append(folder)
+        binds += merged
+
+    # A folder reached through a symlink is mounted at the path it was
+    # given as, unless both the link and its target are mounted already
+    for real, logical in sorted(linked):
+        if any(isInside(real, b) for b in binds) and any(isInside(logical, b) for b in binds):
+            continue
+        binds.append('{}:{}'.format(real, logical))
+    return sorted(binds)
+#end _computePlan()
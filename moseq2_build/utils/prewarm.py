@@ -0,0 +1,86 @@
+""" Reads an image into the page cache of this node.
+
+The first container started from an image on a shared filesystem spends
+most of its time reading the image. Pre-warming reads it once with a few
+parallel readers, so the containers of a batch start from memory.
+
+    python -m moseq2_build.utils.prewarm IMAGE [IMAGE]...
+"""
+import os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+from moseq2_build.utils.constants import PREWARM_CHUNK_SIZE, PREWARM_THREADS
+
+def imageFiles(path):
+    """ The files of an image: the file itself, or every file below a
+    sandbox folder.
+
+    :rtype: List of Strings
+    """
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, dirs, names in os.walk(path):
+        files += [os.path.join(root, n) for n in sorted(names) if os.path.isfile(os.path.join(root, n))]
+    return files
+#end imageFiles()
+
+def _readRange(path, start, length, chunkSize):
+    buf = bytearray(min(chunkSize, length))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        done = 0
+        while done < length:
+            view = memoryview(buf)[:min(len(buf), length - done)]
+            n = os.preadv(fd, [view], start + done)
+            if n == 0:
+                break
+            done += n
+        return done
+    finally:
+        os.close(fd)
+#end _readRange()
+
+def prewarmImage(path, threads=PREWARM_THREADS, chunkSize=PREWARM_CHUNK_SIZE):
+    """ Reads every byte of an image so it is in the page cache, splitting
+    each file into ranges that are read in parallel.
+
+    :type path: String
+    :param path: Image file or sandbox folder.
+
+    :type threads: Integer
+    :param threads: Number of parallel readers.
+
+    :rtype: Tuple of the number of bytes read and the seconds it took.
+    """
+    start = time.time()
+    ranges = []
+    for fpath in imageFiles(path):
+        size = os.path.getsize(fpath)
+        try:
+            fd = os.open(fpath, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            os.close(fd)
+        except (AttributeError, OSError):
+            pass
+        # Ranges of a few chunks each keep the reads sequential per thread
+        step = max(chunkSize, -(-size // max(1, threads)))
+        ranges += [(fpath, offset, min(step, size - offset)) for offset in range(0, size, step)]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        total = sum(pool.map(lambda r: _readRange(r[0], r[1], r[2], chunkSize), ranges))
+    return total, time.time() - start
+#end prewarmImage()
+
+def main(argv=None):
+    paths = sys.argv[1:] if argv is None else argv
+    if len(paths) == 0:
+        sys.stderr.write(__doc__)
+        return 1
+    for path in paths:
+        total, elapsed = prewarmImage(path)
+        sys.stdout.write('Pre-warmed {} ({:.2f} GB in {:.1f}s)\n'.format(path, total / 1024.0 ** 3, elapsed))
+    return 0
+#end main()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,412 @@
+import csv, json, os, platform, resource, socket, sys, tempfile, threading, time, uuid
+from contextlib import contextmanager, nullcontext
+from termcolor import colored
+
+from moseq2_build.utils.constants import RUN_RECORDS_PATH, PROFILE_SAMPLE_INTERVAL
+
+def childProcesses(rootPid):
+    """ Finds every descendant of a process by walking /proc.
+
+    :rtype: List of Integer process ids, empty where /proc is not available.
+    """
+    parents = {}
+    try:
+        pids = [int(p) for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return []
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid), 'r') as f:
+                # The command name may contain spaces, the fields after it do not
+                fields = f.read().rsplit(')', 1)[1].split()
+            parents[pid] = int(fields[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    found, frontier = [], [rootPid]
+    while len(frontier) != 0:
+        parent = frontier.pop()
+        children = [pid for pid, ppid in parents.items() if ppid == parent]
+        found += children
+        frontier += children
+    return found
+#end childProcesses()
+
+def processUsage(pid):
+    """ Resident memory and I/O counters of a single process.
+
+    :rtype: Tuple of the resident set size, bytes read and bytes written,
+    or None if the process is gone.
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid), 'r') as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+    read = written = 0
+    try:
+        with open('/proc/{}/io'.format(pid), 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key == 'rchar':
+                    read = int(value)
+                elif key == 'wchar':
+                    written = int(value)
+    except (OSError, ValueError):
+        pass
+    return rss, read, written
+#end processUsage()
+
+class TreeSampler(object):
+    """ Samples the memory and I/O of all child processes of this process
+    in a background thread. The resident memory of the whole tree is
+    summed, so the peak covers containers made of several processes.
+    """
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peakRss = 0
+        self.io = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        total = 0
+        for pid in childProcesses(os.getpid()):
+            usage = processUsage(pid)
+            if usage is None:
+                continue
+            total += usage[0]
+            self.io[pid] = usage[1:]
+        self.peakRss = max(self.peakRss, total)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def bytesRead(self):
+        return sum(r for r, w in self.io.values())
+
+    def bytesWritten(self):
+        return sum(w for r, w in self.io.values())
+#end TreeSampler
+
+class RunProfile(object):
+    """ Collects the run record of one command: wall time of its phases,
+    CPU time and peak memory of the child processes, bytes they read and
+    wrote and the image they ran in. Used as a context manager around the
+    command; the record is appended to the run history when it exits,
+    also when the command exits early.
+
+    :type command: String
+    :param command: Name of the command, e.g. extract or batch.
+
+    :type arguments: List of Strings
+    :param arguments: Arguments passed through to the container.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :type outputPath: String
+    :param outputPath: Additional .json or .csv file the record is written to.
+    """
+    def __init__(self, command, arguments, image, outputPath=None, recordsPath=None):
+        self.command = command
+        self.arguments = list(arguments)
+        self.image = image
+        self.outputPath = outputPath
+        self.recordsPath = recordsPath or RUN_RECORDS_PATH
+        self.phases = {}
+        self.markerPaths = []
+        self.record = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.startUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.sampler = TreeSampler()
+        self.sampler.start()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            returnCode = 0
+        elif issubclass(excType, SystemExit):
+            returnCode = exc.code if isinstance(exc.code, int) else (0 if exc.code is None else 1)
+        else:
+            returnCode = -1
+        self.finish(returnCode)
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        """ Times the enclosed block as the named phase. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addPhase(name, time.time() - start)
+
+    def addPhase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def markerPath(self):
+        """ Creates a file the container writes timestamps to as it starts
+        up, see buildContainerCommand. It is placed in the temporary
+        folder, which singularity mounts by default.
+
+        :rtype: String
+        """
+        path = os.path.join(tempfile.gettempdir(), 'moseq2-env-{}.markers'.format(uuid.uuid4().hex))
+        self.markerPaths.append(path)
+        return path
+
+    @contextmanager
+    def containerPhases(self, name, markerPath):
+        """ Times a container command run in the enclosed block, split into
+        container start up, environment activation and the command itself
+        using the timestamps in markerPath. Without timestamps the whole
+        block counts as the named phase.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            stamps = readMarkers(markerPath)
+            if 'container' in stamps and 'activated' in stamps:
+                self.addPhase('container-start', max(0.0, stamps['container'] - start))
+                self.addPhase('activation', max(0.0, stamps['activated'] - stamps['container']))
+                self.addPhase(name, max(0.0, end - stamps['activated']))
+            else:
+                self.addPhase(name, end - start)
+
+    def finish(self, returnCode):
+        """ Completes the run record and writes it out.
+
+        :rtype: Dictionary
+        """
+        from moseq2_build.env.store import imageFingerprint
+
+        self.sampler.stop()
+        self.sampler.sample()
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        for path in self.markerPaths:
+            if os.path.exists(path):
+                os.remove(path)
+        # ru_maxrss is in KiB on Linux and covers the largest single child
+        self.record = {
+            'id': uuid.uuid4().hex,
+            'command': self.command,
+            'arguments': self.arguments,
+            'image': os.path.abspath(self.image) if self.image else None,
+            'imageDigest': imageFingerprint(self.image) if self.image else None,
+            'host': socket.gethostname(),
+            'platform': platform.platform(),
+            'started': self.started,
+            'elapsed': time.time() - self.started,
+            'returnCode': returnCode,
+            'phases': dict(self.phases),
+            'cpuUser': usage.ru_utime - self.startUsage.ru_utime,
+            'cpuSystem': usage.ru_stime - self.startUsage.ru_stime,
+            'peakRss': max(self.sampler.peakRss, usage.ru_maxrss * 1024),
+            'bytesRead': self.sampler.bytesRead(),
+            'bytesWritten': self.sampler.bytesWritten(),
+        }
+        appendRunRecord(self.record, self.recordsPath)
+        if self.outputPath is not None:
+            writeRunRecord(self.record, self.outputPath)
+        return self.record
+#end RunProfile
+
+class NoProfile(object):
+    """ Stands in for a RunProfile when profiling is off. """
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    @contextmanager
+    def containerPhases(self, name, markerPath):
+        yield
+
+    def markerPath(self):
+        return None
+#end NoProfile
+
+def profiledRun(enabled, command, arguments, image, outputPath=None):
+    """ Context manager yielding a RunProfile when profiling is enabled
+    and None otherwise.
+    """
+    if not enabled:
+        return nullcontext()
+    return RunProfile(command, arguments, image, outputPath)
+#end profiledRun()
+
+def readMarkers(markerPath):
+    """ Reads the 'name timestamp' lines written by a profiled container.
+
+    :rtype: Dictionary of name to timestamp.
+    """
+    stamps = {}
+    try:
+        with open(markerPath, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    stamps[parts[0]] = float(parts[1])
+    except (OSError, ValueError):
+        pass
+    return stamps
+#end readMarkers()
+
+def flattenRecord(record):
+    """ Turns a run record into a flat row, with one phase_<name> column per phase.
+
+    :rtype: Dictionary
+    """
+    row = {k: v for k, v in record.items() if k != 'phases'}
+    row['arguments'] = ' '.join(record['arguments'])
+    for name, seconds in record['phases'].items():
+        row['phase_' + name] = seconds
+    return row
+#end flattenRecord()
+
+def appendRunRecord(record, recordsPath=RUN_RECORDS_PATH):
+    """ Appends a run record to the JSON lines run history. """
+    os.makedirs(os.path.dirname(os.path.abspath(recordsPath)), exist_ok=True)
+    with open(recordsPath, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+#end appendRunRecord()
+
+def writeRunRecord(record, path):
+    """ Writes a single run record as JSON, or as CSV if path ends in .csv. """
+    if path.endswith('.csv'):
+        row = flattenRecord(record)
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(row))
+            writer.writeheader()
+            writer.writerow(row)
+    else:
+        with open(path, 'w') as f:
+            json.dump(record, f, indent=2)
+#end writeRunRecord()
+
+def loadRunRecords(paths):
+    """ Reads run records from the JSON lines history, JSON files holding
+    one record or a list of them, and CSV files written by writeRunRecord.
+
+    :rtype: List of Dictionaries
+    """
+    records = []
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        if path.endswith('.csv'):
+            with open(path, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    records.append(unflattenRow(row))
+            continue
+        with open(path, 'r') as f:
+            contents = f.read()
+        try:
+            loaded = json.loads(contents)
+            records += loaded if isinstance(loaded, list) else [loaded]
+        except ValueError:
+            records += [json.loads(line) for line in contents.splitlines() if line.strip()]
+    return records
+#end loadRunRecords()
+
+def unflattenRow(row):
+    record = {'phases': {}}
+    for key, value in row.items():
+        if key.startswith('phase_'):
+            if value != '':
+                record['phases'][key[len('phase_'):]] = float(value)
+        elif key in ('started', 'elapsed', 'cpuUser', 'cpuSystem'):
+            record[key] = float(value)
+        elif key in ('returnCode', 'peakRss', 'bytesRead', 'bytesWritten'):
+            record[key] = int(value)
+        elif key == 'arguments':
+            record[key] = value.split()
+        else:
+            record[key] = value
+    return record
+#end unflattenRow()
+
+def median(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+#end median()
+
+def aggregateRunRecords(records, threshold):
+    """ Groups run records by command and image digest. The groups of one
+    command are ordered by the first run of the image, and each is compared
+    to the group before it, so a slower image release stands out.
+
+    :type threshold: Float
+    :param threshold: Relative increase of the median wall time that
+    counts as a regression.
+
+    :rtype: List of Dictionaries, one per command and image.
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault((record['command'], record.get('imageDigest')), []).append(record)
+    summaries = []
+    for (command, digest), runs in groups.items():
+        phaseNames = sorted(set(name for r in runs for name in r['phases']))
+        summaries.append({
+            'command': command,
+            'imageDigest': digest,
+            'image': runs[-1].get('image'),
+            'firstRun': min(r['started'] for r in runs),
+            'runs': len(runs),
+            'failures': len([r for r in runs if r['returnCode'] != 0]),
+            'elapsed': median([r['elapsed'] for r in runs]),
+            'cpu': median([r['cpuUser'] + r['cpuSystem'] for r in runs]),
+            'peakRss': median([r['peakRss'] for r in runs]),
+            'bytesRead': median([r['bytesRead'] for r in runs]),
+            'bytesWritten': median([r['bytesWritten'] for r in runs]),
+            'phases': {name: median([r['phases'][name] for r in runs if name in r['phases']]) for name in phaseNames},
+        })
+    summaries.sort(key=lambda s: (s['command'], s['firstRun']))
+    previous = {}
+    for summary in summaries:
+        before = previous.get(summary['command'])
+        summary['change'] = None
+        if before is not None and before['elapsed']:
+            summary['change'] = summary['elapsed'] / before['elapsed'] - 1.0
+        summary['regression'] = summary['change'] is not None and summary['change'] > threshold
+        previous[summary['command']] = summary
+    return summaries
+#end aggregateRunRecords()
+
+def printRunStats(summaries):
+    """ Prints one line per command and image with the median run time,
+    CPU time, peak memory and phase timings, marking regressions.
+
+    :type summaries: List of Dictionaries
+    :param summaries: Output of aggregateRunRecords.
+    """
+    if len(summaries) == 0:
+        sys.stdout.write('No run records found, run extract or batch with --profile first.\n')
+        return
+    sys.stdout.write(colored('{:<16} {:<24} {:>5} {:>5} {:>10} {:>10} {:>10} {:>8}\n'.format('command', 'image',
+        'runs', 'fail', 'elapsed', 'cpu', 'peak MB', 'change'), 'white', attrs=['bold']))
+    for s in summaries:
+        digest = (s['imageDigest'] or '-').split(':')[-1][:24]
+        change = '' if s['change'] is None else '{:+.0%}'.format(s['change'])
+        line = '{:<16} {:<24} {:>5} {:>5} {:>9.1f}s {:>9.1f}s {:>10.0f} {:>8}\n'.format(s['command'], digest,
+            s['runs'], s['failures'], s['elapsed'], s['cpu'], s['peakRss'] / 1024.0 ** 2, change)
+        sys.stdout.write(colored(line, 'red') if s['regression'] else line)
+        phases = '  '.join('{} {:.1f}s'.format(name, seconds) for name, seconds in s['phases'].items())
+        if phases:
+            sys.stdout.write('    {}\n'.format(phases))
+#end printRunStats()
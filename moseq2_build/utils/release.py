@@ -1,10 +1,12 @@
-import getpass, argparse, requests, os, shutil
+import getpass, argparse, hashlib, json, requests, os, re, shutil, time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import tarfile
 
 # local imports
 from moseq2_build.utils.commands import executeCommand, panicIfStderr, printSuccessMessage, printErrorMessage
-from moseq2_build.utils.constants import ENVIRONMENT_CONFIG, GITHUB_LINK
+from moseq2_build.utils.constants import ENVIRONMENT_CONFIG, GITHUB_LINK, DOWNLOAD_SEGMENTS, RELEASE_CACHE_DIR, ASSET_KINDS
+from moseq2_build.utils.download import createSession, downloadFile, streamExtract, extractTar, fileDigest, verifyDigest, assetStem, DownloadError
 
 def getUnamPword():
     """ Prompts the user for a username and password
@@ -17,8 +19,220 @@ def getUnamPword():
     return username, password
 #ned getUnamPword()
 
-def downloadAssets(uname, pword, indices, outputPath, version):
+def releaseUrl(uname, pword, baseUrl=None):
+    """ Builds the url of the releases endpoint.
+
+    :type baseUrl: String
+    :param baseUrl: Alternative releases endpoint, e.g. a local stand-in.
+
+    :rtype: String
+    """
+    if baseUrl is not None:
+        return baseUrl.rstrip('/')
+    return "https://" + uname + ":" + pword + GITHUB_LINK
+#end releaseUrl()
+
+def isLocalMirror(url):
+    """ Whether the releases endpoint is a mirror folder, see syncMirror. """
+    return url.startswith('file://') or os.path.isdir(url)
+#end isLocalMirror()
+
+def mirrorPath(url, *parts):
+    root = url[len('file://'):] if url.startswith('file://') else url
+    return os.path.join(root, *parts)
+#end mirrorPath()
+
+def releaseEndpoint(version):
+    return 'latest' if version is None else 'tags/' + version
+#end releaseEndpoint()
+
+def releaseCachePath(url, version, cacheDir=None):
+    # Credentials in the url are part of the key, but never written to disk
+    key = hashlib.sha256('{} {}'.format(url, version).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(cacheDir or RELEASE_CACHE_DIR, key + '.json')
+#end releaseCachePath()
+
+def fetchReleaseInfo(session, url, version=None, cacheDir=None):
+    """ Looks up the metadata of a release. Responses are cached with their
+    ETag and revalidated with If-None-Match, so an unchanged release costs
+    an empty 304 response. When the server cannot be reached the cached
+    metadata is used. Mirror folders are read directly.
+
+    :type url: String
+    :param url: Releases endpoint, see releaseUrl, or a mirror folder.
+
+    :type version: String
+    :param version: Tag of the release, the latest release if None.
+
+    :rtype: Dictionary, raises DownloadError when there is no metadata.
+    """
+    if isLocalMirror(url):
+        try:
+            with open(mirrorPath(url, releaseEndpoint(version)), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise DownloadError('The mirror has no release {}: {}'.format(version or 'latest', e))
+
+    cachePath = releaseCachePath(url, version, cacheDir)
+    try:
+        with open(cachePath, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+    headers = {'If-None-Match': cached['etag']} if cached is not None and cached.get('etag') else {}
+    try:
+        x = session.get(url + '/' + releaseEndpoint(version), headers=headers, timeout=60)
+    except requests.RequestException as e:
+        if cached is None:
+            raise DownloadError('Could not reach the release server: {}'.format(e))
+        print('\nRelease server unreachable, using release info from {}'.format(time.ctime(cached['fetched'])))
+        return cached['data']
+    if x.status_code == 304 and cached is not None:
+        return cached['data']
+    if x.status_code != 200:
+        raise DownloadError('Release server returned {}'.format(x.status_code))
+    data = x.json()
+    os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+    with open(cachePath + '.tmp', 'w') as f:
+        json.dump({'etag': x.headers.get('ETag'), 'fetched': time.time(), 'data': data}, f)
+    os.replace(cachePath + '.tmp', cachePath)
+    return data
+#end fetchReleaseInfo()
+
+def selectAssets(jsonData, kinds):
+    """ Finds the image archives of a release by name.
+
+    :type kinds: List of Strings
+    :param kinds: Image types from ASSET_KINDS, e.g. ['singularity'].
+
+    :rtype: List of asset Dictionaries, raises DownloadError when one is missing.
+    """
+    assets = []
+    for kind in kinds:
+        matches = [a for a in jsonData['assets'] if re.search(r'\b' + kind + r'\b', a['name'])
+            and a['name'].endswith(('.tar.gz', '.tgz', '.tar'))]
+        if len(matches) == 0:
+            raise DownloadError('Release {} has no {} image'.format(jsonData.get('tag_name'), kind))
+        assets.append(matches[0])
+    return assets
+#end selectAssets()
+
+def readAsset(session, url, asset):
+    """ Contents of a small release asset. """
+    if isLocalMirror(url):
+        with open(mirrorPath(url, 'assets', str(asset['id'])), 'rb') as f:
+            return f.read()
+    x = session.get(url + "/assets/" + str(asset["id"]), headers={'Accept': 'application/octet-stream'}, timeout=60)
+    return x.content if x.status_code == 200 else None
+#end readAsset()
+
+def findAssetDigest(session, url, jsonData, asset):
+    """ Finds the expected digest of a release asset. It is taken from
+    the asset metadata when present, otherwise from a companion
+    "<asset>.sha256" asset of the same release.
+
+    :rtype: String digest of the form "sha256:<hex>", or None.
+    """
+    if asset.get("digest"):
+        return asset["digest"]
+    for other in jsonData["assets"]:
+        if other["name"] == asset["name"] + ".sha256":
+            contents = readAsset(session, url, other)
+            if contents is not None:
+                return "sha256:" + contents.decode('utf-8').split()[0]
+    return None
+#end findAssetDigest()
+
+def extractAsset(assetOutput):
+    """ Unpacks a downloaded .tar.gz asset next to it and removes the archive.
+
+    :rtype: String path of the unpacked folder.
+    """
+    p = os.path.join(os.path.dirname(assetOutput), assetStem(os.path.basename(assetOutput)))
+    with tarfile.open(assetOutput) as tar:
+        extractTar(tar, p)
+    os.remove(assetOutput)
+    return p
+#end extractAsset()
+
+def fetchAsset(session, url, jsonData, asset, outputPath, position=0, store=None, streamed=False):
+    """ Downloads, verifies and unpacks a single release asset. When a
+    store is given, an image that is already in it is reused instead of
+    downloaded, and a new download is added to it. When streamed, the
+    asset is unpacked while it downloads, see streamExtract.
+
+    :rtype: String path of the unpacked folder.
+    """
+    assetName = asset["name"]
+    tag = jsonData.get("tag_name")
+    if store is not None:
+        cached = store.lookup(tag, assetName, digest=asset.get("digest"))
+        if cached is not None:
+            printSuccessMessage("Using stored " + assetName + "\n")
+            return cached
+        outputPath = store.stagingDir()
+
+    finalCom = url + "/assets/" + str(asset["id"])
+    header = {'Accept': 'application/octet-stream'}
+    assetOutput = os.path.join(outputPath, assetName)
+
+    if isLocalMirror(url):
+        # The archive in the mirror is unpacked in place of a download
+        archive = mirrorPath(url, 'assets', str(asset["id"]))
+        if not os.path.isfile(archive):
+            raise DownloadError('The mirror has no {}'.format(assetName))
+        digest = findAssetDigest(session, url, jsonData, asset)
+        digest = verifyDigest(archive, digest) if digest is not None else fileDigest(archive)
+        p = os.path.join(outputPath, assetStem(assetName))
+        with tarfile.open(archive) as tar:
+            extractTar(tar, p)
+        printSuccessMessage("Unpacked " + assetName + " from the mirror\n")
+        if store is not None:
+            p = store.add(digest, tag, assetName, p)
+        return p
+
+    t = tqdm(total=0, unit='B', unit_scale=True, desc=assetName, position=position)
+    def onSize(total, done):
+        t.total = total
+        t.n = done
+        t.refresh()
+    # The digest is known before the download, so a streamed archive is
+    # checked before it replaces anything
+    digest = findAssetDigest(session, url, jsonData, asset)
+    if streamed:
+        p = os.path.join(outputPath, assetStem(assetName))
+        try:
+            actual = streamExtract(finalCom, p, headers=header, session=session, progress=t.update, onSize=onSize,
+                expected=digest)
+        finally:
+            t.close()
+    else:
+        downloadFile(finalCom, assetOutput, headers=header, session=session, progress=t.update, onSize=onSize)
+        t.close()
+        actual = fileDigest(assetOutput)
+
+    if digest is None:
+        digest = actual
+        print("\nNo digest published for {}, recording {}".format(assetName, digest))
+    elif digest.lower() != actual.lower():
+        os.remove(assetOutput)
+        raise DownloadError('Digest mismatch for {}: expected {}, got {}'.format(assetName, digest, actual))
+    else:
+        printSuccessMessage("Verified " + assetName + "\n")
+
+    if not streamed:
+        p = extractAsset(assetOutput)
+    print("Finished unzipping " + assetName + "\n")
+    if store is not None:
+        p = store.add(digest, tag, assetName, p)
+    return p
+#end fetchAsset()
+
+def downloadAssets(uname, pword, indices, outputPath, version, baseUrl=None, store=None, streamed=False):
     """ Downloads the latest assets from the moseq2-build repository.
+    Every asset is fetched in parallel byte ranges, resumed if a
+    previous attempt was interrupted, and checked against its digest
+    before it is unpacked. Several assets are downloaded at once.
 
     :type uname: String
     :param uname: GitHub username.
@@ -26,68 +240,97 @@ def downloadAssets(uname, pword, indices, outputPath, version):
     :type pword: String
     :param pword: GitHub password.
 
-    :type indices: List of Strings
-    :param indices: Contains what assets we are going to download.
-    Either singularity or docker image, or both.
-    """
-    url = "https://" + uname + ":" + pword + GITHUB_LINK
-    if (version is None):
-        x = requests.get(url + "/latest")
+    :type indices: List of Integers
+    :param indices: Image types to download, positions in ASSET_KINDS:
+    the docker or singularity image, or both. The assets are matched by name.
 
-    else:
-        x = requests.get(url + "/tags/" + version)
+    :type baseUrl: String
+    :param baseUrl: Alternative releases endpoint, e.g. a local stand-in,
+    or a mirror folder written by syncMirror.
 
+    :type store: ImageStore
+    :param store: Image store to reuse images from and add downloads to.
+
+    :type streamed: Boolean
+    :param streamed: Unpack the assets while they download instead of
+    storing the archives first. Such downloads cannot be resumed.
+    """
+    url = releaseUrl(uname, pword, baseUrl)
+    session = createSession(DOWNLOAD_SEGMENTS * max(1, len(indices)))
     msg = "Received release info"
 
     print("\nGetting release info")
 
-    if x.status_code != 200:
-        printErrorMessage(msg + '\n')
+    try:
+        jsonData = fetchReleaseInfo(session, url, version)
+        assets = selectAssets(jsonData, [ASSET_KINDS[i] for i in indices])
+    except DownloadError as e:
+        printErrorMessage(msg + ': ' + str(e) + '\n')
         exit(1)
 
-    else:
-        printSuccessMessage(msg + '\n\n')
-
-    jsonData = x.json()
-    for i in indices:
-        asset = jsonData["assets"][i]
-        releaseId = str(asset["id"])
-        assetName = asset["name"]
-        header = {'Accept': 'application/octet-stream'}
-        finalCom = url + "/assets/" + releaseId
-        msg = "Downloaded asset " + assetName
-
-        x = requests.get(finalCom, headers=header, stream=True)
-        if (x.status_code != 200):
-            printErrorMessage(msg + '\n')
-            exit(1)
-
-        totalSize = int(x.headers.get('content-length', 0))
-        blockSize = 1024 # 1KB
-        t = tqdm(total=totalSize, unit='1B', unit_scale=True)
-
+    printSuccessMessage(msg + '\n\n')
+    with ThreadPoolExecutor(max_workers=len(assets)) as pool:
+        futures = [pool.submit(fetchAsset, session, url, jsonData, asset, outputPath, position, store, streamed)
+            for position, asset in enumerate(assets)]
         result = []
+        for asset, future in zip(assets, futures):
+            try:
+                result.append(os.path.join(outputPath, future.result()))
+            except DownloadError as e:
+                printErrorMessage("Downloaded asset " + asset["name"] + ": " + str(e) + '\n')
+                exit(1)
 
-        assetOutput = os.path.join(outputPath, assetName)
-        with open(assetOutput, 'wb') as f:
-            for data in x.iter_content(blockSize):
-                t.update(len(data))
-                f.write(data)
-        t.close()
+    return result
+#end downloadAssets()
 
-        tar = tarfile.open(assetOutput)
-        p = os.path.splitext(assetOutput)[0]
-        p = os.path.splitext(p)[0]
-        # p = os.path.splitext(p)[0]
-        tar.extractall(path=p)
-        tar.close()
-        print("Finished unzipping\n")
-        os.remove(assetOutput)
+def syncMirror(uname, pword, mirrorDir, version=None, baseUrl=None):
+    """ Copies the metadata and every asset of a release into a mirror
+    folder. The folder has the layout of the releases endpoint, so it can
+    be passed as baseUrl to downloadAssets, or be served over HTTP to
+    nodes without outbound network. Assets already in the mirror are
+    kept, and the metadata is written last, so an interrupted sync leaves
+    the mirror as it was.
 
-        result.append(os.path.join(outputPath, p))
+    :type mirrorDir: String
+    :param mirrorDir: Folder of the mirror.
 
-    if totalSize != 0 and t.n != totalSize:
-        printErrorMessage(msg + '\n')
+    :type version: String
+    :param version: Tag of the release, the latest release if None. The
+    latest release of the mirror is only updated for None.
 
-    return result
-#end downloadAssets()
+    :rtype: Dictionary with the metadata of the release.
+    """
+    url = releaseUrl(uname, pword, baseUrl)
+    session = createSession(DOWNLOAD_SEGMENTS)
+    jsonData = fetchReleaseInfo(session, url, version)
+    os.makedirs(os.path.join(mirrorDir, 'assets'), exist_ok=True)
+    os.makedirs(os.path.join(mirrorDir, 'tags'), exist_ok=True)
+    for asset in jsonData["assets"]:
+        target = os.path.join(mirrorDir, 'assets', str(asset["id"]))
+        if os.path.isfile(target) and os.path.getsize(target) == asset.get("size"):
+            continue
+        if isLocalMirror(url):
+            shutil.copyfile(mirrorPath(url, 'assets', str(asset["id"])), target + '.part')
+            os.replace(target + '.part', target)
+        else:
+            t = tqdm(total=asset.get("size"), unit='B', unit_scale=True, desc=asset["name"])
+            downloadFile(url + "/assets/" + str(asset["id"]), target, headers={'Accept': 'application/octet-stream'},
+                session=session, progress=t.update)
+            t.close()
+        if asset.get("digest"):
+            try:
+                verifyDigest(target, asset["digest"])
+            except DownloadError:
+                os.remove(target)
+                raise
+        printSuccessMessage("Mirrored " + asset["name"] + "\n")
+
+    paths = [os.path.join(mirrorDir, 'tags', jsonData["tag_name"])]
+    if version is None:
+        paths.append(os.path.join(mirrorDir, 'latest'))
+    for path in paths:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(jsonData, f, indent=2)
+        os.replace(path + '.tmp', path)
+    return jsonData
+#end syncMirror()
@@ -0,0 +1,245 @@
+import math, os, resource
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+PROC_ROOT = '/proc'
+
+def cgroupDirs():
+    """ Folders of the cgroups this process belongs to, for cgroup v2 and
+    the v1 memory and cpu controllers.
+
+    :rtype: Dictionary of 'unified', 'memory' and 'cpu' to folders, only
+    with the entries that exist.
+    """
+    dirs = {}
+    try:
+        with open(os.path.join(PROC_ROOT, 'self', 'cgroup'), 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return dirs
+    for line in lines:
+        parts = line.split(':', 2)
+        if len(parts) != 3:
+            continue
+        controllers, path = parts[1].split(','), parts[2].lstrip('/')
+        if parts[0] == '0' and parts[1] == '':
+            candidates = [('unified', os.path.join(CGROUP_ROOT, path))]
+        else:
+            candidates = [(c, os.path.join(CGROUP_ROOT, c, path)) for c in controllers if c in ('memory', 'cpu')]
+        for name, folder in candidates:
+            # Inside of a container the cgroup may be mounted as the root
+            for candidate in (folder, os.path.join(CGROUP_ROOT, name) if name != 'unified' else CGROUP_ROOT):
+                if os.path.isdir(candidate):
+                    dirs[name] = candidate
+                    break
+    return dirs
+#end cgroupDirs()
+
+def readCgroupValue(folder, name):
+    """ Reads a single value file of a cgroup.
+
+    :rtype: String, or None if the file cannot be read.
+    """
+    try:
+        with open(os.path.join(folder, name), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+#end readCgroupValue()
+
+def readCgroupStat(folder, key, name='memory.stat'):
+    """ Reads one counter of a cgroup statistics file.
+
+    :rtype: Integer, or None if the file or counter cannot be read.
+    """
+    contents = readCgroupValue(folder, name)
+    for line in (contents or '').splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == key:
+            try:
+                return int(parts[1])
+            except ValueError:
+                return None
+    return None
+#end readCgroupStat()
+
+def cgroupWorkingSet(folder, usageName, inactiveName):
+    """ Memory used by a cgroup without its inactive file cache, which the
+    kernel reclaims before it hits the limit. Reading large depth files
+    fills the cache up to the limit, so the raw usage would leave no room.
+
+    :rtype: Integer number of bytes, or None if the usage cannot be read.
+    """
+    usage = readCgroupValue(folder, usageName)
+    if usage is None:
+        return None
+    return max(0, int(usage) - (readCgroupStat(folder, inactiveName) or 0))
+#end cgroupWorkingSet()
+
+def cgroupAncestors(folder, root):
+    """ The folder of a cgroup followed by those of its parents, up to root. """
+    folders = [folder]
+    while os.path.abspath(folder) != os.path.abspath(root) and os.path.dirname(folder) != folder:
+        folder = os.path.dirname(folder)
+        folders.append(folder)
+    return folders
+#end cgroupAncestors()
+
+def cgroupLimits():
+    """ Memory and CPU limits of the cgroup of this process. Slurm and
+    systemd set the limits on a parent cgroup, e.g. the job's, while the
+    cgroup of the task reports none, so the lowest limit among the cgroup
+    and its parents is taken, with the usage of the cgroup that sets it.
+    The usage leaves out the inactive file cache, see cgroupWorkingSet.
+
+    :rtype: Dictionary with memoryLimit and memoryUsage in bytes and
+    cpuLimit in CPUs, each None when there is no limit or it is unknown.
+    """
+    limits = {'memoryLimit': None, 'memoryUsage': None, 'cpuLimit': None}
+    dirs = cgroupDirs()
+
+    def lowest(folders, readLimit, usageName, inactiveName):
+        for folder in folders:
+            limit = readLimit(folder)
+            if limit is not None and (limits['memoryLimit'] is None or limit < limits['memoryLimit']):
+                limits['memoryLimit'] = limit
+                limits['memoryUsage'] = cgroupWorkingSet(folder, usageName, inactiveName)
+        if limits['memoryLimit'] is None:
+            limits['memoryUsage'] = cgroupWorkingSet(folders[0], usageName, inactiveName)
+
+    def lowestCpu(folders, readLimit):
+        for folder in folders:
+            limit = readLimit(folder)
+            if limit is not None and (limits['cpuLimit'] is None or limit < limits['cpuLimit']):
+                limits['cpuLimit'] = limit
+
+    def v2Memory(folder):
+        memMax = readCgroupValue(folder, 'memory.max')
+        return int(memMax) if memMax is not None and memMax != 'max' else None
+
+    def v2Cpu(folder):
+        cpuMax = readCgroupValue(folder, 'cpu.max')
+        if cpuMax is None or cpuMax.startswith('max'):
+            return None
+        quota, period = cpuMax.split()
+        return int(quota) / float(period)
+
+    def v1Memory(folder):
+        memMax = readCgroupValue(folder, 'memory.limit_in_bytes')
+        # v1 reports "no limit" as a huge page aligned number
+        return int(memMax) if memMax is not None and int(memMax) < 2 ** 60 else None
+
+    def v1Cpu(folder):
+        quota, period = readCgroupValue(folder, 'cpu.cfs_quota_us'), readCgroupValue(folder, 'cpu.cfs_period_us')
+        return int(quota) / float(period) if quota is not None and period is not None and int(quota) > 0 else None
+
+    # On hybrid hierarchies the v2 folder exists without the controllers
+    if 'unified' in dirs:
+        folders = cgroupAncestors(dirs['unified'], CGROUP_ROOT)
+        lowest(folders, v2Memory, 'memory.current', 'inactive_file')
+        lowestCpu(folders, v2Cpu)
+    if 'memory' in dirs and limits['memoryUsage'] is None:
+        lowest(cgroupAncestors(dirs['memory'], os.path.join(CGROUP_ROOT, 'memory')), v1Memory, 'memory.usage_in_bytes',
+            'total_inactive_file')
+    if 'cpu' in dirs and limits['cpuLimit'] is None:
+        lowestCpu(cgroupAncestors(dirs['cpu'], os.path.join(CGROUP_ROOT, 'cpu')), v1Cpu)
+    return limits
+#end cgroupLimits()
+
+def getCpuCount():
+    """ Returns the number of CPUs this process is allowed to run on,
+    bounded by the CPU quota of its cgroup.
+
+    :rtype: Integer
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    cpuLimit = cgroupLimits()['cpuLimit']
+    if cpuLimit is not None:
+        cpus = min(cpus, max(1, int(math.ceil(cpuLimit))))
+    return cpus
+#end getCpuCount()
+
+def getAvailableMemory():
+    """ Reads the amount of memory currently available on the node
+    from /proc/meminfo, bounded by what the memory limit of the cgroup
+    of this process leaves.
+
+    :rtype: Integer number of bytes, or None if it cannot be determined.
+    """
+    available = None
+    try:
+        with open(os.path.join(PROC_ROOT, 'meminfo'), 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    limits = cgroupLimits()
+    if limits['memoryLimit'] is not None:
+        headroom = max(0, limits['memoryLimit'] - (limits['memoryUsage'] or 0))
+        available = headroom if available is None else min(available, headroom)
+    return available
+#end getAvailableMemory()
+
+def pressureStall(resourceName):
+    """ Share of the last 10 seconds in which some tasks were stalled on
+    memory or I/O, from the pressure stall information of the kernel.
+
+    :type resourceName: String
+    :param resourceName: 'memory' or 'io'.
+
+    :rtype: Float percentage, or None where PSI is not available.
+    """
+    try:
+        with open(os.path.join(PROC_ROOT, 'pressure', resourceName), 'r') as f:
+            for line in f:
+                if line.startswith('some '):
+                    return float(dict(p.split('=') for p in line.split()[1:])['avg10'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+#end pressureStall()
+
+def processGroupRss():
+    """ Resident memory of every process group on the node, from /proc.
+    Every container command runs in its own process group, so this is
+    the memory each container uses.
+
+    :rtype: Dictionary of process group id to bytes.
+    """
+    groups = {}
+    pageSize = resource.getpagesize()
+    try:
+        pids = [p for p in os.listdir(PROC_ROOT) if p.isdigit()]
+    except OSError:
+        return groups
+    for pid in pids:
+        try:
+            with open(os.path.join(PROC_ROOT, pid, 'stat'), 'r') as f:
+                # The command name may contain spaces, the fields after it do not
+                fields = f.read().rsplit(')', 1)[1].split()
+            pgid, rss = int(fields[2]), int(fields[21]) * pageSize
+        except (OSError, IndexError, ValueError):
+            continue
+        groups[pgid] = groups.get(pgid, 0) + rss
+    return groups
+#end processGroupRss()
+
+def defaultWorkerCount(memPerSession):
+    """ Determines how many sessions can be extracted at the same time
+    on this node, bounded by both the CPU count and the available memory.
+
+    :type memPerSession: Integer
+    :param memPerSession: Expected peak memory of a single extraction in bytes.
+
+    :rtype: Integer, always at least 1.
+    """
+    workers = getCpuCount()
+    availMem = getAvailableMemory()
+    if availMem is not None and memPerSession:
+        workers = min(workers, availMem // memPerSession)
+    return max(1, int(workers))
+#end defaultWorkerCount()
@@ -0,0 +1,255 @@
+""" Container runtime drivers.
+
+A driver knows how to start containers with one runtime: its executable,
+its bind mount syntax, how an image file becomes something the runtime
+can run, and the CPU and memory limit flags it accepts. Drivers hand out
+the command tables buildContainerCommand and mountDirectories already
+work with, so the rest of moseq2-env does not depend on the runtime.
+
+The driver is picked from the image (a .sif file or sandbox folder for
+singularity and apptainer, a docker archive or unpacked "docker save"
+folder for docker and podman) and the runtimes installed on the host.
+"""
+import abc, json, os, re, shlex, shutil, threading
+
+from moseq2_build.utils.constants import RUNTIME_IMAGES_PATH, DOCKER_MANIFEST_NAME, SANDBOX_METADATA_DIR
+
+_imagesLock = threading.Lock()
+
+def isDockerFolder(path):
+    """ Whether path is a folder holding unpacked "docker save" output. """
+    return os.path.isfile(os.path.join(path, DOCKER_MANIFEST_NAME))
+#end isDockerFolder()
+
+def isSandbox(path):
+    """ Whether path is a singularity or apptainer sandbox folder. """
+    return os.path.isdir(os.path.join(path, SANDBOX_METADATA_DIR))
+#end isSandbox()
+
+class RuntimeDriver(abc.ABC):
+    """ Base class of the runtime drivers. """
+    name = None
+    executable = None
+    mountFlag = None
+    imageSuffixes = ()
+    # Runtimes that treat '-v path' as an anonymous volume need 'path:path'
+    fullBinds = False
+    # Warm instances keep a shell open inside of a singularity container
+    supportsInstances = False
+
+    def available(self):
+        return shutil.which(self.executable) is not None
+
+    def supportsImage(self, image):
+        return image.endswith(self.imageSuffixes)
+
+    @abc.abstractmethod
+    def execPrefix(self):
+        """ Start of the command that runs a container.
+
+        :rtype: String
+        """
+
+    def resourceFlags(self, cpus=None, memoryGB=None):
+        """ Flags limiting the CPUs and memory of a container.
+
+        :rtype: List of Strings
+        """
+        return []
+
+    def prepareImage(self, image):
+        """ Reference of the image that is passed to the runtime.
+
+        :rtype: String
+        """
+        return image
+
+    def commands(self, image, cpus=None, memoryGB=None):
+        """ Container command table that runs image with this runtime.
+
+        :type image: String
+        :param image: Path to the image file.
+
+        :type cpus: Float
+        :param cpus: CPUs a container may use, unlimited if None.
+
+        :type memoryGB: Float
+        :param memoryGB: Memory a container may use in GB, unlimited if None.
+
+        :rtype: Dictionary
+        """
+        table = {'exec': ' '.join([self.execPrefix()] + self.resourceFlags(cpus, memoryGB)),
+            'mount': self.mountFlag, 'runtime': self.name}
+        reference = self.prepareImage(image)
+        if reference != image:
+            table['image'] = reference
+        if self.fullBinds:
+            table['fullBinds'] = True
+        return table
+#end RuntimeDriver
+
+class SingularityDriver(RuntimeDriver):
+    """ Runs .sif images and sandbox folders with singularity. Resource
+    limits are left to the scheduler, as they need cgroup privileges.
+    """
+    name = 'singularity'
+    executable = 'singularity'
+    mountFlag = '-B'
+    imageSuffixes = ('.sif', '.simg')
+    supportsInstances = True
+
+    def supportsImage(self, image):
+        return image.endswith(self.imageSuffixes) or isSandbox(image)
+
+    def execPrefix(self):
+        return self.executable + ' exec'
+#end SingularityDriver
+
+class ApptainerDriver(SingularityDriver):
+    """ Runs the same images as singularity with its successor, apptainer. """
+    name = 'apptainer'
+    executable = 'apptainer'
+#end ApptainerDriver
+
+class DockerDriver(RuntimeDriver):
+    """ Runs docker archives (docker save output), packed or unpacked
+    into a folder. The image is loaded once; the image ID is remembered per image fingerprint and reused for
+    as long as the runtime still has the image.
+    """
+    name = 'docker'
+    executable = 'docker'
+    mountFlag = '-v'
+    imageSuffixes = ('.tar', '.tar.gz', '.tgz')
+    fullBinds = True
+
+    def supportsImage(self, image):
+        return image.endswith(self.imageSuffixes) or isDockerFolder(image)
+
+    def userFlags(self):
+        # Outputs are owned by the calling user instead of root
+        return ['--user', '"$(id -u):$(id -g)"']
+
+    def execPrefix(self):
+        # The image's entrypoint is bash, which would treat our "bash -c" as a script.
+        # The working folder is mounted like singularity does, so relative paths work.
+        return ' '.join([self.executable, 'run', '--rm', '--entrypoint=', '-e', 'HOME=/tmp']
+            + self.userFlags() + ['-v', '"$PWD":"$PWD"', '-w', '"$PWD"'])
+
+    def resourceFlags(self, cpus=None, memoryGB=None):
+        flags = []
+        if cpus:
+            flags.append('--cpus={:g}'.format(cpus))
+        if memoryGB:
+            flags.append('--memory={}m'.format(int(memoryGB * 1024)))
+        return flags
+
+    def prepareImage(self, image):
+        from moseq2_build.env.store import imageFingerprint
+
+        key = '{}/{}'.format(self.name, imageFingerprint(image))
+        with _imagesLock:
+            imageId = loadRuntimeImages().get(key)
+            if imageId is not None and self.hasImage(imageId):
+                return imageId
+            imageId = self.loadImage(image)
+            saveRuntimeImage(key, imageId)
+            return imageId
+
+    def hasImage(self, imageId):
+        from moseq2_build.utils.execution import runCommand
+        return runCommand('{} image inspect {}'.format(self.executable, shlex.quote(imageId)))[1] == 0
+
+    def loadImage(self, image):
+        """ Loads an archive, or a folder it was unpacked into, into the runtime.
+
+        :rtype: String ID of the loaded image.
+        """
+        from moseq2_build.utils.execution import runCommand
+
+        source = shlex.quote(os.path.abspath(image))
+        if os.path.isdir(image):
+            # The folder is packed again on the fly and streamed into "load"
+            command = 'tar -C {} -cf - . | {} load'.format(source, self.executable)
+        else:
+            command = '{} load -i {}'.format(self.executable, source)
+        (stdout, stderr), retCode = runCommand(command)
+        loaded = re.findall(r'Loaded image(?: ID)?(?:\(s\))?: *(\S+)', stdout.decode('utf-8', 'replace'))
+        if retCode != 0 or len(loaded) == 0:
+            raise RuntimeError('{} could not load {}: {}'.format(self.name, image, stderr.decode('utf-8', 'replace').strip()))
+        (stdout, stderr), retCode = runCommand('{} image inspect --format {{{{.Id}}}} {}'.format(self.executable,
+            shlex.quote(loaded[-1].split(',')[0])))
+        return stdout.decode().strip() if retCode == 0 and stdout.strip() else loaded[-1]
+#end DockerDriver
+
+class PodmanDriver(DockerDriver):
+    """ Runs docker archives with rootless podman. """
+    name = 'podman'
+    executable = 'podman'
+
+    def userFlags(self):
+        return ['--userns=keep-id']
+#end PodmanDriver
+
+DRIVERS = [SingularityDriver(), ApptainerDriver(), DockerDriver(), PodmanDriver()]
+
+def getDriver(name):
+    """ Returns the driver of a runtime by name.
+
+    :rtype: RuntimeDriver
+    """
+    for driver in DRIVERS:
+        if driver.name == name:
+            return driver
+    raise ValueError('Unknown container runtime: {}'.format(name))
+#end getDriver()
+
+def selectDriver(image, runtime=None):
+    """ Picks the driver that runs an image: the requested runtime, or the
+    first installed runtime that can run the image, in the order of DRIVERS.
+
+    :type image: String
+    :param image: Path to the image file.
+
+    :type runtime: String
+    :param runtime: Name of the runtime to use, 'auto' or None to pick one.
+
+    :rtype: RuntimeDriver
+    """
+    if runtime not in (None, 'auto'):
+        driver = getDriver(runtime)
+        if not driver.supportsImage(image):
+            raise ValueError('{} cannot run {}'.format(driver.name, image))
+        if not driver.available():
+            raise ValueError('{} is not installed'.format(driver.name))
+        return driver
+    candidates = [d for d in DRIVERS if d.supportsImage(image)]
+    if len(candidates) == 0:
+        raise ValueError('Unsupported image type: {}'.format(image))
+    for driver in candidates:
+        if driver.available():
+            return driver
+    raise ValueError('None of {} is installed to run {}'.format(', '.join(d.name for d in candidates), image))
+#end selectDriver()
+
+def loadRuntimeImages():
+    """ Image IDs of the archives loaded into docker or podman, by runtime
+    and image fingerprint.
+
+    :rtype: Dictionary
+    """
+    try:
+        with open(RUNTIME_IMAGES_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+#end loadRuntimeImages()
+
+def saveRuntimeImage(key, imageId):
+    images = loadRuntimeImages()
+    images[key] = imageId
+    os.makedirs(os.path.dirname(RUNTIME_IMAGES_PATH), exist_ok=True)
+    tmp = RUNTIME_IMAGES_PATH + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(images, f, indent=2)
+    os.replace(tmp, RUNTIME_IMAGES_PATH)
+#end saveRuntimeImage()
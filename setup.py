@@ -17,8 +17,19 @@ setup(
         'pytest',
         'importlib',
         'click',
+        'requests',
+    ],
+    python_requires='>=3.9',
+    classifiers=[
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
+        'License :: OSI Approved :: MIT License',
+        'Operating System :: POSIX :: Linux',
     ],
-    python_requires='>=3.6',
     description='Location of environment images for use during the pipeline',
     packages=find_packages(),
     include_package_data=True,
@@ -0,0 +1,38 @@
+import os, pytest
+
+from fakes import FAKE_SBATCH, FAKE_SQUEUE, FAKE_SACCT, writeScript, installFakeRuntime, startReleaseServer, stopReleaseServer
+
+@pytest.fixture
+def fake_runtime(tmp_path, monkeypatch):
+	""" Puts a fake singularity, conda activate script and moseq2-extract on PATH. """
+	binDir, image = installFakeRuntime(str(tmp_path))
+	monkeypatch.setenv('PATH', binDir + os.pathsep + os.environ['PATH'])
+	return image
+#end fake_runtime()
+
+@pytest.fixture
+def release_server(tmp_path, monkeypatch):
+	""" Runs a local HTTP stand-in for the release API with a docker and a
+	singularity asset. Yields the server, its url is in server.url.
+	Release metadata is cached in tmp_path.
+	"""
+	monkeypatch.setattr('moseq2_build.utils.release.RELEASE_CACHE_DIR', str(tmp_path / 'release_cache'))
+	server = startReleaseServer()
+	yield server
+	stopReleaseServer(server)
+#end release_server()
+
+@pytest.fixture
+def fake_slurm(tmp_path, monkeypatch):
+	""" Puts fake sbatch, squeue and sacct commands on PATH. Returns the folder
+	where they record what was submitted.
+	"""
+	slurmDir = tmp_path / 'slurm'
+	slurmDir.mkdir()
+	writeScript(str(slurmDir / 'sbatch'), FAKE_SBATCH)
+	writeScript(str(slurmDir / 'squeue'), FAKE_SQUEUE)
+	writeScript(str(slurmDir / 'sacct'), FAKE_SACCT)
+	monkeypatch.setenv('FAKE_SLURM_DIR', str(slurmDir))
+	monkeypatch.setenv('PATH', str(slurmDir) + os.pathsep + os.environ['PATH'])
+	return slurmDir
+#end fake_slurm()
@@ -0,0 +1,262 @@
+""" Stand-ins for the container runtime, the release API and Slurm, and
+session data, shared by the tests and the benchmarks.
+"""
+import hashlib, io, json, os, socket, stat, tarfile, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_SINGULARITY = '''#!/bin/sh
+# Stand-in for singularity: drops the mount arguments and the image and
+# runs the remaining command on the host.
+shift
+while [ "$1" = "-B" ]; do shift 2; done
+shift
+exec "$@"
+'''
+
+FAKE_EXTRACT = '''#!/bin/sh
+# Stand-in for moseq2-extract: records its arguments in the output folder.
+[ -z "$FAKE_PIPELINE_LOG" ] || echo "moseq2-extract $1" >> "$FAKE_PIPELINE_LOG"
+if [ "$1" = "extract" ]; then
+    case "$2" in *bad*) echo "failed on $2" >&2; exit 3;; esac
+    # Flaky sessions are killed the first time they run
+    case "$2" in *flaky*) [ -e "$(dirname "$2")/flaked" ] || { touch "$(dirname "$2")/flaked"; exit 137; };; esac
+    mkdir -p "$(dirname "$2")/proc"
+    echo "$@" > "$(dirname "$2")/proc/args.txt"
+    [ -z "$FAKE_EXTRACT_SLEEP" ] || sleep "$FAKE_EXTRACT_SLEEP"
+fi
+if [ "$1" = "generate-config" ] && [ "$2" = "--output-file" ]; then
+    echo "fps: 30" > "$3"
+fi
+echo "moseq2-extract $@"
+'''
+
+FAKE_MOSEQ2_TOOL = '''#!/bin/sh
+# Stand-in for moseq2-pca and moseq2-model: records the command and writes
+# the files the next stages read. FAKE_FAIL names a command that fails.
+[ -z "$FAKE_PIPELINE_LOG" ] || echo "$(basename "$0") $*" >> "$FAKE_PIPELINE_LOG"
+[ "$1" = "$FAKE_FAIL" ] && exit 1
+command=$1; dest=$3; out=
+while [ $# -gt 0 ]; do [ "$1" = "-o" ] && out=$2; shift; done
+case "$command" in
+    train-pca) touch "$out/pca.h5";;
+    apply-pca) touch "$out/pca_scores.h5";;
+    compute-changepoints) touch "$out/changepoints.h5";;
+    learn-model) touch "$dest";;
+esac
+'''
+
+FAKE_H5REPACK = '''#!/bin/sh
+# Stand-in for h5repack: "compresses" the input by keeping its first half.
+while [ $# -gt 2 ]; do shift; done
+head -c $(( $(wc -c < "$1") / 2 )) "$1" > "$2"
+'''
+
+def makeSession(root, name, size=16):
+	""" Writes a session folder root/name holding a depth.dat of size bytes.
+
+	:rtype: String path of the depth file.
+	"""
+	folder = os.path.join(str(root), name)
+	os.makedirs(folder, exist_ok=True)
+	path = os.path.join(folder, 'depth.dat')
+	with open(path, 'wb') as f:
+		f.write(b'\0' * size)
+	return path
+#end makeSession()
+
+def makeSessions(root, sizes):
+	""" Writes the sessions root/session_<i>, one per size of depth.dat.
+
+	:rtype: List of the paths of their depth files.
+	"""
+	return [makeSession(root, 'session_{}'.format(i), size) for i, size in enumerate(sizes)]
+#end makeSessions()
+
+def writeScript(path, contents):
+	with open(path, 'w') as f:
+		f.write(contents)
+	os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+#end writeScript()
+
+FAKE_DOCKER = '''#!/bin/sh
+# Stand-in for docker and podman: "load" counts its calls and keeps an
+# archive streamed to it, "image inspect"
+# knows the loaded image, and "run" records its mounts and runs the
+# command on the host in the requested working folder.
+state="$(dirname "$0")/docker_state"
+case "$1" in
+load)
+    echo x >> "$state.loads"
+    [ "$2" = "-i" ] || cat > "$state.stdin"
+    echo "Loaded image: moseq2:latest"
+    exit 0;;
+image)
+    [ -f "$state.loads" ] || exit 1
+    [ "$3" = "--format" ] && echo "sha256:feed"
+    exit 0;;
+run)
+    shift
+    while [ $# -gt 0 ]; do
+        case "$1" in
+        -v) echo "$2" >> "$state.mounts"; shift 2;;
+        -w) cd "$2"; shift 2;;
+        -e|--user) shift 2;;
+        -*) echo "$1" >> "$state.flags"; shift;;
+        *) break;;
+        esac
+    done
+    shift
+    exec "$@";;
+esac
+exit 2
+'''
+
+def installFakeRuntime(root):
+	""" Writes a fake singularity, conda activate script, moseq2 tools and
+	h5repack into root/bin and an empty image into root.
+
+	:rtype: Tuple of the bin folder and the image path.
+	"""
+	binDir = os.path.join(root, 'bin')
+	os.makedirs(binDir, exist_ok=True)
+	writeScript(os.path.join(binDir, 'singularity'), FAKE_SINGULARITY)
+	writeScript(os.path.join(binDir, 'moseq2-extract'), FAKE_EXTRACT)
+	writeScript(os.path.join(binDir, 'h5repack'), FAKE_H5REPACK)
+	writeScript(os.path.join(binDir, 'moseq2-pca'), FAKE_MOSEQ2_TOOL)
+	writeScript(os.path.join(binDir, 'moseq2-model'), FAKE_MOSEQ2_TOOL)
+	writeScript(os.path.join(binDir, 'activate'), '')
+	image = os.path.join(root, 'moseq2.sif')
+	open(image, 'w').close()
+	return binDir, image
+#end installFakeRuntime()
+
+
+class ReleaseHandler(BaseHTTPRequestHandler):
+	""" Stand-in for the GitHub releases API: serves release metadata with
+	an ETag, answering If-None-Match with 304, and asset contents, honoring
+	single byte ranges.
+	"""
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		server = self.server
+		server.requests.append((self.path, self.headers.get('Range')))
+		path = self.path.split('?')[0]
+		if path in ('/releases/latest', '/releases/tags/' + server.tag):
+			body = json.dumps(server.release).encode()
+			etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+			if self.headers.get('If-None-Match') == etag:
+				server.notModified += 1
+				self.send_response(304)
+				self.send_header('ETag', etag)
+				self.end_headers()
+				return
+			return self.sendBody(200, body, 'application/json', {'ETag': etag})
+		if path.startswith('/releases/assets/'):
+			data = server.assets.get(int(path.rsplit('/', 1)[1]))
+			if data is not None:
+				return self.sendAsset(data)
+		self.sendBody(404, b'{}', 'application/json')
+
+	def sendBody(self, status, body, contentType, headers=None):
+		self.send_response(status)
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def sendAsset(self, data):
+		rangeHeader = self.headers.get('Range')
+		if rangeHeader is None or not self.server.ranges:
+			return self.sendBody(200, data, 'application/octet-stream')
+		start, end = rangeHeader.split('=')[1].split('-')
+		start, end = int(start), min(int(end), len(data) - 1)
+		body = data[start:end + 1]
+		self.send_response(206)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		if self.server.dropAfter is not None and len(body) > self.server.dropAfter:
+			# Simulate a network drop part way through the transfer
+			self.server.dropAfter = None
+			self.wfile.write(body[:len(body) // 2])
+			self.wfile.flush()
+			self.connection.shutdown(socket.SHUT_RDWR)
+			return
+		self.wfile.write(body)
+#end ReleaseHandler
+
+def makeTarball(name, files):
+	buf = io.BytesIO()
+	with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+		for fname, contents in files.items():
+			info = tarfile.TarInfo(fname)
+			info.size = len(contents)
+			tar.addfile(info, io.BytesIO(contents))
+	return buf.getvalue()
+#end makeTarball()
+
+def startReleaseServer(dockerSize=300000, singularitySize=500000):
+	""" Runs a local HTTP stand-in for the release API with a docker and a
+	singularity asset in a background thread. Its url is in server.url.
+
+	:rtype: ThreadingHTTPServer
+	"""
+	server = ThreadingHTTPServer(('127.0.0.1', 0), ReleaseHandler)
+	server.daemon_threads = True
+	server.tag = 'v1'
+	server.requests = []
+	server.ranges = True
+	server.dropAfter = None
+	server.notModified = 0
+	docker = makeTarball('docker', {'image/moseq2.tar': os.urandom(dockerSize)})
+	singularity = makeTarball('singularity', {'image/moseq2.sif': os.urandom(singularitySize)})
+	server.assets = {1: docker, 2: singularity}
+	server.release = {'tag_name': 'v1', 'assets': [
+		{'id': 1, 'name': 'moseq2-docker.v1.tar.gz', 'size': len(docker),
+			'digest': 'sha256:' + hashlib.sha256(docker).hexdigest()},
+		{'id': 2, 'name': 'moseq2-singularity.v1.tar.gz', 'size': len(singularity),
+			'digest': 'sha256:' + hashlib.sha256(singularity).hexdigest()},
+	]}
+	server.url = 'http://127.0.0.1:{}/releases'.format(server.server_address[1])
+	thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+	thread.start()
+	return server
+#end startReleaseServer()
+
+def stopReleaseServer(server):
+	server.shutdown()
+	server.server_close()
+#end stopReleaseServer()
+
+FAKE_SBATCH = '''#!/bin/sh
+# Stand-in for sbatch: records the submitted script and prints a job id.
+echo "$@" >> "$FAKE_SLURM_DIR/sbatch_calls"
+for last; do :; done
+cp "$last" "$FAKE_SLURM_DIR/submitted.sh"
+echo "4242;cluster"
+'''
+
+FAKE_SQUEUE = '''#!/bin/sh
+# Stand-in for squeue: fails once per line of the failures file, then
+# reports each queued task once, then an empty queue.
+if [ -s "$FAKE_SLURM_DIR/failures" ]; then
+    sed -i '1d' "$FAKE_SLURM_DIR/failures"
+    echo "slurm_load_jobs error: Socket timed out" >&2
+    exit 1
+fi
+if [ -s "$FAKE_SLURM_DIR/queue" ]; then
+    cat "$FAKE_SLURM_DIR/queue"
+    : > "$FAKE_SLURM_DIR/queue"
+fi
+'''
+
+FAKE_SACCT = '''#!/bin/sh
+# Stand-in for sacct: prints the recorded task states, fails without them.
+[ -f "$FAKE_SLURM_DIR/accounting" ] || { echo "Slurm accounting storage is disabled" >&2; exit 1; }
+cat "$FAKE_SLURM_DIR/accounting"
+'''
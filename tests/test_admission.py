@@ -0,0 +1,145 @@
+import threading, time
+
+from moseq2_build.utils.constants import SINGULARITY_COMS
+from moseq2_build.utils import resources, admission as admissionModule
+from moseq2_build.utils.admission import AdmissionController, estimateFootprint, loadFootprints, recordFootprint, footprintRuntime
+from moseq2_build.auto.schedule import scheduleExtractions
+from fakes import makeSession
+
+def fakeCgroupTree(root, cgroupLines, files):
+	(root / 'proc' / 'self').mkdir(parents=True)
+	(root / 'proc' / 'self' / 'cgroup').write_text('\n'.join(cgroupLines) + '\n')
+	(root / 'proc' / 'meminfo').write_text('MemTotal: 67108864 kB\nMemAvailable: 33554432 kB\n')
+	for path, value in files.items():
+		target = root / 'cgroup' / path
+		target.parent.mkdir(parents=True, exist_ok=True)
+		target.write_text(value + '\n')
+#end fakeCgroupTree()
+
+def test_cgroup_v2_limits(tmp_path, monkeypatch):
+	fakeCgroupTree(tmp_path, ['0::/job'], {'job/memory.max': str(8 * 1024 ** 3),
+		'job/memory.current': str(3 * 1024 ** 3), 'job/cpu.max': '150000 100000'})
+	monkeypatch.setattr(resources, 'CGROUP_ROOT', str(tmp_path / 'cgroup'))
+	monkeypatch.setattr(resources, 'PROC_ROOT', str(tmp_path / 'proc'))
+	assert resources.cgroupLimits() == {'memoryLimit': 8 * 1024 ** 3, 'memoryUsage': 3 * 1024 ** 3, 'cpuLimit': 1.5}
+	assert resources.getAvailableMemory() == 5 * 1024 ** 3
+	assert resources.getCpuCount() <= 2
+#end test_cgroup_v2_limits()
+
+def test_cgroup_v1_limits(tmp_path, monkeypatch):
+	fakeCgroupTree(tmp_path, ['4:memory:/job', '1:cpu,cpuacct:/job', '0::/'], {
+		'memory/job/memory.limit_in_bytes': str(2 ** 63 - 4096), 'memory/job/memory.usage_in_bytes': '1024',
+		'cpu/job/cpu.cfs_quota_us': '-1', 'cpu/job/cpu.cfs_period_us': '100000'})
+	monkeypatch.setattr(resources, 'CGROUP_ROOT', str(tmp_path / 'cgroup'))
+	monkeypatch.setattr(resources, 'PROC_ROOT', str(tmp_path / 'proc'))
+	assert resources.cgroupLimits() == {'memoryLimit': None, 'memoryUsage': 1024, 'cpuLimit': None}
+	assert resources.getAvailableMemory() == 32 * 1024 ** 3
+#end test_cgroup_v1_limits()
+
+def test_cgroup_limits_of_parents(tmp_path, monkeypatch):
+	# Slurm limits the job, while the cgroup of the task reports no limit
+	fakeCgroupTree(tmp_path, ['0::/slurm/job_7/step_0/task_0'], {
+		'slurm/job_7/memory.max': str(16 * 1024 ** 3), 'slurm/job_7/memory.current': str(10 * 1024 ** 3),
+		'slurm/job_7/cpu.max': '400000 100000',
+		'slurm/job_7/step_0/memory.max': str(32 * 1024 ** 3), 'slurm/job_7/step_0/memory.current': str(9 * 1024 ** 3),
+		'slurm/job_7/step_0/task_0/memory.max': 'max', 'slurm/job_7/step_0/task_0/memory.current': str(1024 ** 3),
+		'slurm/job_7/step_0/task_0/cpu.max': 'max 100000'})
+	monkeypatch.setattr(resources, 'CGROUP_ROOT', str(tmp_path / 'cgroup'))
+	monkeypatch.setattr(resources, 'PROC_ROOT', str(tmp_path / 'proc'))
+	assert resources.cgroupLimits() == {'memoryLimit': 16 * 1024 ** 3, 'memoryUsage': 10 * 1024 ** 3, 'cpuLimit': 4.0}
+	assert resources.getAvailableMemory() == 6 * 1024 ** 3
+#end test_cgroup_limits_of_parents()
+
+def test_cgroup_v1_limits_of_parents(tmp_path, monkeypatch):
+	fakeCgroupTree(tmp_path, ['4:memory:/slurm/uid_1/job_7/step_0', '0::/'], {
+		'memory/slurm/uid_1/job_7/memory.limit_in_bytes': str(4 * 1024 ** 3),
+		'memory/slurm/uid_1/job_7/memory.usage_in_bytes': str(3 * 1024 ** 3),
+		'memory/slurm/uid_1/job_7/step_0/memory.limit_in_bytes': str(2 ** 63 - 4096),
+		'memory/slurm/uid_1/job_7/step_0/memory.usage_in_bytes': '1024'})
+	monkeypatch.setattr(resources, 'CGROUP_ROOT', str(tmp_path / 'cgroup'))
+	monkeypatch.setattr(resources, 'PROC_ROOT', str(tmp_path / 'proc'))
+	assert resources.getAvailableMemory() == 1024 ** 3
+#end test_cgroup_v1_limits_of_parents()
+
+def test_cgroup_usage_leaves_out_file_cache(tmp_path, monkeypatch):
+	# Reading depth files filled the page cache of the job up to its limit
+	fakeCgroupTree(tmp_path, ['0::/job', '4:memory:/job'], {'job/memory.max': str(8 * 1024 ** 3),
+		'job/memory.current': str(8 * 1024 ** 3),
+		'job/memory.stat': 'anon {}\nfile {}\ninactive_file {}'.format(2 * 1024 ** 3, 6 * 1024 ** 3, 5 * 1024 ** 3)})
+	monkeypatch.setattr(resources, 'CGROUP_ROOT', str(tmp_path / 'cgroup'))
+	monkeypatch.setattr(resources, 'PROC_ROOT', str(tmp_path / 'proc'))
+	assert resources.cgroupLimits()['memoryUsage'] == 3 * 1024 ** 3
+	assert resources.getAvailableMemory() == 5 * 1024 ** 3
+
+	fakeCgroupTree(tmp_path / 'v1', ['4:memory:/job', '0::/'], {
+		'memory/job/memory.limit_in_bytes': str(4 * 1024 ** 3), 'memory/job/memory.usage_in_bytes': str(4 * 1024 ** 3),
+		'memory/job/memory.stat': 'cache 100\ninactive_file 10\ntotal_inactive_file {}'.format(3 * 1024 ** 3)})
+	monkeypatch.setattr(resources, 'CGROUP_ROOT', str(tmp_path / 'v1' / 'cgroup'))
+	monkeypatch.setattr(resources, 'PROC_ROOT', str(tmp_path / 'v1' / 'proc'))
+	assert resources.cgroupLimits()['memoryUsage'] == 1024 ** 3
+	assert resources.getAvailableMemory() == 3 * 1024 ** 3
+#end test_cgroup_usage_leaves_out_file_cache()
+
+def test_estimate_footprint():
+	assert estimateFootprint(100, [], 1000) == 1000
+	# Peak memory grows by 2 bytes per input byte on top of a 1000 byte base
+	history = [{'inputBytes': x, 'peakRss': 1000 + 2 * x} for x in (100, 200, 300, 400)]
+	assert estimateFootprint(500, history, 1) == int(2000 * 1.25)
+	assert estimateFootprint(0, history, 1) == int(1200 * 1.25)
+	assert estimateFootprint(0, history[:1], 1) == int(1200 * 1.25)
+#end test_estimate_footprint()
+
+def test_admission_waits_for_memory(tmp_path, monkeypatch):
+	monkeypatch.setattr(admissionModule, 'getAvailableMemory', lambda: 7 * 1024 ** 3)
+	monkeypatch.setattr(admissionModule, 'pressureStall', lambda name: None)
+	controller = AdmissionController(4, 4 * 1024 ** 3, reserve=0, interval=0.05,
+		footprintsPath=str(tmp_path / 'footprints.jsonl'))
+	first = controller.acquire('a')
+	admitted = []
+	waiting = threading.Thread(target=lambda: admitted.append(controller.acquire('b')))
+	# The first run has not grown to its 4GB estimate yet, so 7GB is not enough for another one
+	waiting.start()
+	time.sleep(0.3)
+	assert admitted == []
+	controller.release(first, 1)
+	waiting.join(5)
+	assert len(admitted) == 1
+	controller.release(admitted[0], 1)
+	controller.close()
+	assert loadFootprints(controller.footprintsPath) == []
+#end test_admission_waits_for_memory()
+
+def test_schedule_records_footprints(tmp_path, fake_runtime, monkeypatch):
+	sessions = [makeSession(tmp_path, name) for name in ('a', 'b', 'c')]
+	controller = AdmissionController(2, 1024 ** 2, footprintsPath=str(tmp_path / 'footprints.jsonl'), interval=0.01)
+	monkeypatch.setenv('FAKE_EXTRACT_SLEEP', '0.3')
+	try:
+		results = scheduleExtractions(fake_runtime, sessions, ['extract'], SINGULARITY_COMS, admission=controller, verbose=False)
+	finally:
+		controller.close()
+	assert [r['returnCode'] for r in results] == [0, 0, 0]
+	footprints = loadFootprints(controller.footprintsPath)
+	assert len(footprints) == 3
+	assert all(f['inputBytes'] == 16 and f['peakRss'] > 0 for f in footprints)
+	assert controller.running == {}
+#end test_schedule_records_footprints()
+
+def test_footprints_are_kept_per_measurable_runtime(tmp_path):
+	assert footprintRuntime(SINGULARITY_COMS) == 'singularity'
+	assert footprintRuntime({'exec': 'apptainer exec', 'mount': '-B', 'runtime': 'apptainer'}) == 'apptainer'
+	# The containers run under the daemon, or inside of the instance
+	assert footprintRuntime({'exec': 'docker run', 'mount': '-v', 'runtime': 'docker'}) is None
+	assert footprintRuntime({'exec': 'client', 'mount': '-B', 'instance': 'warm'}) is None
+
+	path = str(tmp_path / 'footprints.jsonl')
+	recordFootprint(16, 4 * 1024 ** 3, 1.0, path, 'singularity')
+	recordFootprint(16, 1024 ** 2, 1.0, path, 'apptainer')
+	assert [f['peakRss'] for f in loadFootprints(path, runtime='apptainer')] == [1024 ** 2]
+	controller = AdmissionController(2, 1024, footprintsPath=path, runtime=None)
+	assert controller.history == [] and controller.footprint(16) == 1024
+	ticket = controller.acquire('a')
+	ticket.peakRss = 1024 ** 2
+	controller.release(ticket, 0)
+	controller.close()
+	assert len(loadFootprints(path)) == 1 and len(loadFootprints(path, runtime='apptainer')) == 1
+#end test_footprints_are_kept_per_measurable_runtime()
@@ -0,0 +1,81 @@
+import asyncio, os, threading, pytest
+import ruamel.yaml as yaml
+
+from moseq2_build.api import Runner, containerCommands
+from fakes import makeSession
+
+def test_container_commands(fake_runtime):
+	with pytest.raises(ValueError):
+		containerCommands(None)
+	with pytest.raises(ValueError):
+		containerCommands('image.img')
+	with pytest.raises(ValueError):
+		containerCommands(fake_runtime, instance='not-running')
+#end test_container_commands()
+
+def test_generate_config(tmp_path, fake_runtime):
+	runner = Runner(fake_runtime, flipPath='/flip.pkl')
+	result = runner.generateConfig('config.yaml', cwd=str(tmp_path))
+	assert result.ok
+	assert result.outputPaths == [str(tmp_path / 'config.yaml')]
+	assert 'moseq2-extract generate-config' in result.stdout
+	with open(result.outputPaths[0]) as f:
+		assert yaml.safe_load(f) == {'fps': 30, 'flip_classifier': '/flip.pkl'}
+#end test_generate_config()
+
+def test_extract_from_threads(tmp_path, fake_runtime):
+	runner = Runner(fake_runtime)
+	sessions = [makeSession(tmp_path, 'session_{}'.format(i)) for i in range(3)] + [makeSession(tmp_path, 'bad')]
+	results = {}
+
+	def run(session):
+		results[os.path.basename(os.path.dirname(session))] = runner.extract(['extract', session])
+
+	threads = [threading.Thread(target=run, args=(s,)) for s in sessions]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+
+	for i in range(3):
+		result = results['session_{}'.format(i)]
+		assert result.ok and result.elapsed >= 0
+		assert result.outputPaths == [str(tmp_path / 'session_{}'.format(i) / 'proc')]
+		assert os.path.isfile(os.path.join(result.outputPaths[0], 'args.txt'))
+	assert results['bad'].returnCode == 3
+	assert 'failed on' in results['bad'].stderr
+#end test_extract_from_threads()
+
+def test_extract_sessions_async(tmp_path, fake_runtime):
+	runner = Runner(fake_runtime)
+	good, bad = tmp_path / 'session_1', tmp_path / 'bad'
+	makeSession(tmp_path, good.name)
+	makeSession(tmp_path, bad.name)
+
+	async def main():
+		return await asyncio.gather(
+			runner.extractSessionsAsync([str(bad), str(tmp_path / 'session_*')], workers=2),
+			runner.extractAsync(['extract', str(good / 'depth.dat'), '--output-dir', 'other']))
+
+	batch, single = asyncio.run(main())
+	assert [r.returnCode for r in batch] == [3, 0]
+	assert batch[0].log == str(bad / 'moseq2-env-extract.log')
+	assert 'failed on' in batch[0].stdout
+	assert batch[1].outputPaths == [str(good / 'proc')]
+	assert single.ok and single.outputPaths == [str(good / 'other')]
+
+	with pytest.raises(ValueError):
+		runner.extractSessions([str(tmp_path / 'missing')])
+#end test_extract_sessions_async()
+
+def test_runner_reports_errors_without_printing(tmp_path, fake_runtime, capsys):
+	runner = Runner(fake_runtime)
+	session = makeSession(tmp_path, 'session_1')
+	(tmp_path / 'session_empty').mkdir()
+	capsys.readouterr()
+	with pytest.raises(ValueError):
+		runner.extract(['extract', session, '--config-file'])
+	results = runner.extractSessions([str(tmp_path / 'session_*')])
+	assert [r.ok for r in results] == [True]
+	assert capsys.readouterr() == ('', '')
+#end test_runner_reports_errors_without_printing()
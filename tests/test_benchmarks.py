@@ -0,0 +1,17 @@
+import json, os, subprocess, sys
+
+BENCHMARK_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'run_benchmarks.py')
+
+def test_benchmarks_smoke(tmp_path):
+	out = tmp_path / 'bench.json'
+	subprocess.run([sys.executable, BENCHMARK_SCRIPT, '-o', str(out), '--scale', '0.01', '--repeat', '1'],
+		stdout=subprocess.PIPE, check=True)
+	report = json.loads(out.read_text())
+	assert set(report['benchmarks']) == {'cli_startup', 'mount_planning', 'batch_script', 'download', 'schedule'}
+	for result in report['benchmarks'].values():
+		assert len(result['samples']) == 1 and result['median'] > 0
+
+	compared = subprocess.run([sys.executable, BENCHMARK_SCRIPT, '-o', str(tmp_path / 'again.json'), '--scale', '0.01',
+		'--repeat', '1', '-b', 'mount_planning', '--compare', str(out)], stdout=subprocess.PIPE, check=True)
+	assert 'mount_planning' in compared.stdout.decode() and ' x' in compared.stdout.decode()
+#end test_benchmarks_smoke()
@@ -0,0 +1,22 @@
+import sys
+
+from moseq2_build.utils.commands import streamCommand, executeCommand
+
+def test_stream_command_keeps_tail(tmp_path, capsys):
+	logPath = str(tmp_path / 'run.log')
+	command = '{} -c "import sys\nfor i in range(1000): print(i)\nsys.stderr.write(\'boom\\\\n\'); sys.exit(2)"'.format(sys.executable)
+	(stdout, stderr), retCode = streamCommand(command, logPath, tailLines=10)
+
+	assert retCode == 2
+	assert stdout.decode().split() == [str(i) for i in range(990, 1000)]
+	assert stderr == b'boom\n'
+	with open(logPath) as f:
+		assert len(f.read().splitlines()) == 1001
+	assert '999' in capsys.readouterr().out
+#end test_stream_command_keeps_tail()
+
+def test_execute_command_stream_mode(tmp_path):
+	(stdout, stderr), retCode = executeCommand('echo hello', stream=True)
+	assert retCode == 0
+	assert stdout == b'hello\n'
+#end test_execute_command_stream_mode()
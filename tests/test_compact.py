@@ -0,0 +1,57 @@
+import os
+
+from moseq2_build.utils.constants import SINGULARITY_COMS, MANIFEST_NAME, COMPACT_INDEX_NAME
+from moseq2_build.auto.compact import compactOutputs, findArtifacts
+from moseq2_build.auto.schedule import scheduleExtractions
+from fakes import makeSession
+
+def makeOutputs(root, name, contents):
+	makeSession(root, name)
+	proc = root / name / 'proc'
+	proc.mkdir()
+	for fileName, data in contents.items():
+		(proc / fileName).write_bytes(data)
+	return proc
+#end makeOutputs()
+
+def test_dedup_links_identical_outputs(tmp_path):
+	movie = os.urandom(4096)
+	first = makeOutputs(tmp_path, 'a', {'results_00.mp4': movie, 'results_00.yaml': b'a: 1', MANIFEST_NAME: b'{}'})
+	second = makeOutputs(tmp_path, 'b', {'results_00.mp4': movie, 'results_00.yaml': b'a: 2', MANIFEST_NAME: b'{}'})
+	third = makeOutputs(tmp_path, 'c', {'results_00.mp4': movie, 'results_00.yaml': b'a: 1'})
+	assert len(findArtifacts([str(tmp_path)])) == 6
+
+	summary = compactOutputs(None, [str(tmp_path)], None, repack=False, workers=2)
+	assert summary['linked'] == 2 and summary['bytesBefore'] - summary['bytesAfter'] == 2 * 4096
+	assert os.stat(first / 'results_00.mp4').st_ino == os.stat(third / 'results_00.mp4').st_ino
+	# Identical configs stay separate files, users edit them in place
+	assert os.stat(first / 'results_00.yaml').st_nlink == 1 and os.stat(third / 'results_00.yaml').st_nlink == 1
+	assert os.stat(first / MANIFEST_NAME).st_nlink == 1
+	assert compactOutputs(None, [str(tmp_path)], None, repack=False)['linked'] == 0
+#end test_dedup_links_identical_outputs()
+
+def test_repack_once_and_keep_links(tmp_path, fake_runtime):
+	results = os.urandom(1000)
+	first = makeOutputs(tmp_path, 'a', {'results_00.h5': results})
+	second = makeOutputs(tmp_path, 'b', {'results_00.h5': results})
+
+	summary = compactOutputs(fake_runtime, [str(tmp_path)], SINGULARITY_COMS, workers=2)
+	assert (summary['repacked'], summary['linked'], summary['failed']) == (1, 1, [])
+	assert summary['bytesAfter'] == 500
+	assert os.stat(first / 'results_00.h5').st_ino == os.stat(second / 'results_00.h5').st_ino
+	assert (first / COMPACT_INDEX_NAME).exists() and (second / COMPACT_INDEX_NAME).exists()
+	assert sorted(os.listdir(first)) == [COMPACT_INDEX_NAME, 'results_00.h5']
+	assert compactOutputs(fake_runtime, [str(tmp_path)], SINGULARITY_COMS)['repacked'] == 0
+#end test_repack_once_and_keep_links()
+
+def test_extraction_separates_linked_outputs(tmp_path, fake_runtime):
+	first = makeOutputs(tmp_path, 'a', {'results_00.mp4': b'movie'})
+	second = makeOutputs(tmp_path, 'b', {'results_00.mp4': b'movie'})
+	compactOutputs(None, [str(tmp_path)], None, repack=False)
+	assert os.stat(first / 'results_00.mp4').st_nlink == 2
+
+	results = scheduleExtractions(fake_runtime, [str(tmp_path / 'a' / 'depth.dat')], ['extract'], SINGULARITY_COMS, verbose=False)
+	assert results[0]['returnCode'] == 0
+	assert os.stat(first / 'results_00.mp4').st_nlink == 1
+	assert (second / 'results_00.mp4').read_bytes() == b'movie'
+#end test_extraction_separates_linked_outputs()
@@ -0,0 +1,60 @@
+import os, pytest
+import ruamel.yaml as yaml
+
+from moseq2_build.utils.constants import SINGULARITY_COMS, SESSION_CONFIG_NAME
+from moseq2_build.auto import configs
+from moseq2_build.auto.configs import ConfigTemplate, cachedConfigTemplate, clearTemplateCache, loadRigOverrides, writeSessionConfigs
+from moseq2_build.auto.batch import doBatch
+
+@pytest.fixture
+def config_cache(tmp_path, monkeypatch):
+	clearTemplateCache()
+	path = str(tmp_path / 'configs')
+	monkeypatch.setattr(configs, 'CONFIG_CACHE_DIR', path)
+	yield path
+	clearTemplateCache()
+#end config_cache()
+
+def test_template_is_generated_once(tmp_path, fake_runtime, config_cache, monkeypatch):
+	calls = []
+	generate = configs.generateTemplate
+	monkeypatch.setattr(configs, 'generateTemplate', lambda *args: calls.append(args) or generate(*args))
+	template = cachedConfigTemplate(fake_runtime, SINGULARITY_COMS)
+	assert cachedConfigTemplate(fake_runtime, SINGULARITY_COMS) is template
+	assert template.render({'flip_classifier': '/flip.pkl'}) == {'fps': 30, 'flip_classifier': '/flip.pkl'}
+	assert template.render() == {'fps': 30}
+
+	# A new process finds the cached file and needs no container either
+	clearTemplateCache()
+	assert cachedConfigTemplate(fake_runtime, SINGULARITY_COMS).render() == {'fps': 30}
+	assert len(calls) == 1 and len(os.listdir(config_cache)) == 1
+#end test_template_is_generated_once()
+
+def test_session_configs(tmp_path):
+	sessions = []
+	for rig in ('rig1', 'rig2'):
+		(tmp_path / rig / 'session').mkdir(parents=True)
+		sessions.append(str(tmp_path / rig / 'session' / 'depth.dat'))
+	(tmp_path / 'rigs.yaml').write_text("'*/rig2/*':\n  flip_classifier: /inscopix.pkl\n  fps: 90\n")
+	template = ConfigTemplate(yaml.round_trip_load('# default config\nfps: 30\n'))
+
+	paths = writeSessionConfigs(template, sessions, '/c57.pkl', loadRigOverrides(str(tmp_path / 'rigs.yaml')))
+	assert paths[sessions[0]] == str(tmp_path / 'rig1' / 'session' / SESSION_CONFIG_NAME)
+	assert open(paths[sessions[0]]).read() == '# default config\nfps: 30\nflip_classifier: /c57.pkl\n'
+	assert yaml.safe_load(open(paths[sessions[1]])) == {'fps': 90, 'flip_classifier': '/inscopix.pkl'}
+#end test_session_configs()
+
+def test_batch_uses_cached_config(tmp_path, fake_runtime, config_cache, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	(tmp_path / 'data' / 'rig2' / 'session').mkdir(parents=True)
+	(tmp_path / 'data' / 'rig2' / 'session' / 'depth.dat').write_bytes(b'')
+	(tmp_path / 'rigs.yaml').write_text("'*/rig2/*':\n  fps: 90\n")
+	doBatch(fake_runtime, '/flip.pkl', str(tmp_path), ['extract-batch', '-i', str(tmp_path / 'data')], SINGULARITY_COMS,
+		rigOverrides=str(tmp_path / 'rigs.yaml'))
+
+	assert yaml.safe_load(open('config.yaml')) == {'fps': 30, 'flip_classifier': '/flip.pkl'}
+	sessionConfig = tmp_path / 'data' / 'rig2' / 'session' / SESSION_CONFIG_NAME
+	assert yaml.safe_load(sessionConfig.read_text()) == {'fps': 90, 'flip_classifier': '/flip.pkl'}
+	args = (tmp_path / 'data' / 'rig2' / 'session' / 'proc' / 'args.txt').read_text()
+	assert '--config-file ' + str(sessionConfig) in args
+#end test_batch_uses_cached_config()
@@ -0,0 +1,134 @@
+import hashlib, io, os, pytest, tarfile
+
+from moseq2_build.utils import constants, download
+from moseq2_build.utils.download import downloadFile, streamExtract, extractTar, planSegments, verifyDigest, DownloadError
+from moseq2_build.utils.release import downloadAssets
+from fakes import makeTarball
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+	# Small chunks so the test assets are split into several segments
+	monkeypatch.setattr(download, 'DOWNLOAD_CHUNK_SIZE', 4096)
+#end small_chunks()
+
+def test_plan_segments():
+	plan = planSegments(100 * constants.DOWNLOAD_CHUNK_SIZE, 4)
+	assert len(plan) == 4
+	assert plan[0][0] == 0 and plan[-1][1] == 100 * constants.DOWNLOAD_CHUNK_SIZE - 1
+	for a, b in zip(plan, plan[1:]):
+		assert a[1] + 1 == b[0]
+	assert planSegments(10, 8) == [[0, 9, 0]]
+#end test_plan_segments()
+
+def test_download_file_in_ranges(tmp_path, release_server, small_chunks):
+	out = str(tmp_path / 'asset.tar.gz')
+	downloadFile(release_server.url + '/assets/2', out, segments=4)
+	with open(out, 'rb') as f:
+		assert f.read() == release_server.assets[2]
+	ranges = [r for p, r in release_server.requests if r is not None and r != 'bytes=0-0']
+	assert len(ranges) == 4
+	assert not os.path.exists(out + '.part')
+	assert not os.path.exists(out + '.part.json')
+#end test_download_file_in_ranges()
+
+def test_download_resumes_after_drop(tmp_path, release_server, small_chunks, monkeypatch):
+	monkeypatch.setattr(download.time, 'sleep', lambda s: None)
+	release_server.dropAfter = 1
+	out = str(tmp_path / 'asset.tar.gz')
+	downloadFile(release_server.url + '/assets/2', out, segments=1, retries=2)
+	with open(out, 'rb') as f:
+		assert f.read() == release_server.assets[2]
+	# The second attempt only asked for the bytes that were still missing
+	ranges = [r for p, r in release_server.requests if r is not None and r != 'bytes=0-0']
+	assert len(ranges) == 2
+	assert ranges[1] != ranges[0]
+#end test_download_resumes_after_drop()
+
+def test_download_without_range_support(tmp_path, release_server):
+	release_server.ranges = False
+	out = str(tmp_path / 'asset.tar.gz')
+	downloadFile(release_server.url + '/assets/1', out)
+	with open(out, 'rb') as f:
+		assert f.read() == release_server.assets[1]
+#end test_download_without_range_support()
+
+def test_verify_digest(tmp_path):
+	path = tmp_path / 'data'
+	path.write_bytes(b'moseq')
+	digest = hashlib.sha256(b'moseq').hexdigest()
+	assert verifyDigest(str(path), digest) == 'sha256:' + digest
+	with pytest.raises(DownloadError):
+		verifyDigest(str(path), 'sha256:' + '0' * 64)
+#end test_verify_digest()
+
+def test_download_assets(tmp_path, release_server, small_chunks):
+	paths = downloadAssets(None, None, [0, 1], str(tmp_path), None, baseUrl=release_server.url)
+	assert paths == [str(tmp_path / 'moseq2-docker.v1'), str(tmp_path / 'moseq2-singularity.v1')]
+	assert (tmp_path / 'moseq2-singularity.v1' / 'image' / 'moseq2.sif').exists()
+	assert not (tmp_path / 'moseq2-singularity.v1.tar.gz').exists()
+#end test_download_assets()
+
+def test_download_assets_rejects_bad_digest(tmp_path, release_server):
+	release_server.release['assets'][1]['digest'] = 'sha256:' + '0' * 64
+	with pytest.raises(SystemExit):
+		downloadAssets(None, None, [1], str(tmp_path), 'v1', baseUrl=release_server.url)
+	assert not (tmp_path / 'moseq2-singularity.v1').exists()
+#end test_download_assets_rejects_bad_digest()
+
+def test_stream_extract(tmp_path, release_server):
+	out = str(tmp_path / 'moseq2-singularity.v1')
+	digest = streamExtract(release_server.url + '/assets/2', out)
+	assert digest == release_server.release['assets'][1]['digest']
+	assert (tmp_path / 'moseq2-singularity.v1' / 'image' / 'moseq2.sif').stat().st_size == 500000
+	assert not os.path.exists(out + '.partial')
+#end test_stream_extract()
+
+def test_stream_extract_rejects_corrupt_archive(tmp_path, release_server):
+	release_server.assets[2] = release_server.assets[2][:1000]
+	out = str(tmp_path / 'moseq2-singularity.v1')
+	with pytest.raises(DownloadError):
+		streamExtract(release_server.url + '/assets/2', out)
+	assert not os.path.exists(out) and not os.path.exists(out + '.partial')
+#end test_stream_extract_rejects_corrupt_archive()
+
+def test_stream_extract_keeps_installed_image_on_mismatch(tmp_path, release_server):
+	out = tmp_path / 'moseq2-singularity.v1'
+	(out / 'image').mkdir(parents=True)
+	(out / 'image' / 'moseq2.sif').write_bytes(b'installed')
+	with pytest.raises(DownloadError):
+		streamExtract(release_server.url + '/assets/2', str(out), expected='sha256:' + '0' * 64)
+	assert (out / 'image' / 'moseq2.sif').read_bytes() == b'installed'
+	assert not os.path.exists(str(out) + '.partial')
+#end test_stream_extract_keeps_installed_image_on_mismatch()
+
+@pytest.mark.parametrize('member', ['../escaped', '/tmp/moseq2-escaped'])
+def test_unsafe_archive_members_are_rejected(tmp_path, release_server, monkeypatch, member):
+	release_server.assets[2] = makeTarball('evil', {member: b'x'})
+	out = tmp_path / 'out' / 'moseq2-singularity.v1'
+	out.parent.mkdir()
+	with pytest.raises(DownloadError):
+		streamExtract(release_server.url + '/assets/2', str(out))
+
+	# Pythons without extraction filters check the member names themselves
+	monkeypatch.delattr(tarfile, 'data_filter')
+	with tarfile.open(fileobj=io.BytesIO(release_server.assets[2])) as tar:
+		with pytest.raises(DownloadError):
+			extractTar(tar, str(out))
+	assert not (tmp_path / 'out' / 'escaped').exists() and not os.path.exists('/tmp/moseq2-escaped')
+#end test_unsafe_archive_members_are_rejected()
+
+def test_download_assets_streamed(tmp_path, release_server):
+	paths = downloadAssets(None, None, [0, 1], str(tmp_path), None, baseUrl=release_server.url, streamed=True)
+	assert paths == [str(tmp_path / 'moseq2-docker.v1'), str(tmp_path / 'moseq2-singularity.v1')]
+	assert (tmp_path / 'moseq2-docker.v1' / 'image' / 'moseq2.tar').exists()
+	assert not (tmp_path / 'moseq2-docker.v1.tar.gz').exists()
+	# Nothing was requested in ranges
+	assert all(r is None for p, r in release_server.requests)
+#end test_download_assets_streamed()
+
+def test_download_assets_streamed_rejects_bad_digest(tmp_path, release_server):
+	release_server.release['assets'][1]['digest'] = 'sha256:' + '0' * 64
+	with pytest.raises(SystemExit):
+		downloadAssets(None, None, [1], str(tmp_path), 'v1', baseUrl=release_server.url, streamed=True)
+	assert not (tmp_path / 'moseq2-singularity.v1').exists()
+#end test_download_assets_streamed_rejects_bad_digest()
@@ -0,0 +1,64 @@
+import asyncio, os, time
+
+from moseq2_build.utils.constants import TIMEOUT_RETURN_CODE, SINGULARITY_COMS
+from moseq2_build.utils.execution import runCommand, runCommandAsync, runCommandsAsync
+from moseq2_build.auto.submit import describeJobs, SlurmBackend
+
+def test_run_command_output(tmp_path):
+	(stdout, stderr), retCode = runCommand('echo out; echo err >&2; exit 3', cwd=str(tmp_path))
+	assert (stdout, stderr, retCode) == (b'out\n', b'err\n', 3)
+#end test_run_command_output()
+
+def test_long_progress_output_is_split_on_carriage_returns(tmp_path):
+	# More than 64 KiB of tqdm-style updates without a single newline
+	script = tmp_path / 'progress.py'
+	script.write_text('import sys\nfor i in range(20000):\n    sys.stdout.write("progress %05d\\r" % i)\nsys.stdout.write("done\\r\\n")\n')
+	lines = []
+	(stdout, stderr), retCode = runCommand('python3 ' + str(script), onLine=lambda index, line: lines.append(line))
+	assert retCode == 0 and len(stdout) > 65536
+	assert len(lines) == 20001 and lines[0] == b'progress 00000\r' and lines[-1] == b'done\r\n'
+#end test_long_progress_output_is_split_on_carriage_returns()
+
+def test_timeout_kills_process_group(tmp_path):
+	pidFile = tmp_path / 'grandchild.pid'
+	start = time.time()
+	(stdout, stderr), retCode = runCommand('sh -c "sleep 30 & echo \\$! > {}; wait"'.format(pidFile), timeout=0.5, grace=1)
+	assert retCode == TIMEOUT_RETURN_CODE
+	assert time.time() - start < 5
+	pid = int(pidFile.read_text())
+	time.sleep(0.1)
+	assert not os.path.exists('/proc/{}'.format(pid)) or open('/proc/{}/stat'.format(pid)).read().split()[2] == 'Z'
+#end test_timeout_kills_process_group()
+
+def test_cancel_kills_process_group():
+	async def cancelled():
+		task = asyncio.ensure_future(runCommandAsync('sleep 30', grace=1))
+		await asyncio.sleep(0.3)
+		task.cancel()
+		try:
+			await task
+		except asyncio.CancelledError:
+			return True
+		return False
+	start = time.time()
+	assert asyncio.run(cancelled())
+	assert time.time() - start < 5
+#end test_cancel_kills_process_group()
+
+def test_many_commands_on_one_loop():
+	commands = ['sleep 0.2; echo {}'.format(i) for i in range(20)]
+	start = time.time()
+	results = asyncio.run(runCommandsAsync(commands, limit=20))
+	assert time.time() - start < 3
+	assert [r[0][0] for r in results] == [str(i).encode() + b'\n' for i in range(20)]
+	assert all(r[1] == 0 for r in results)
+#end test_many_commands_on_one_loop()
+
+def test_slurm_wraps_timeout(tmp_path, fake_slurm):
+	session = tmp_path / 'session_0'
+	session.mkdir()
+	(session / 'depth.dat').write_bytes(b'\0')
+	jobs = describeJobs('/images/moseq2.sif', [str(session / 'depth.dat')], ['extract'], SINGULARITY_COMS, 1)
+	SlurmBackend(str(tmp_path), timeout=90.5).submit(jobs)
+	assert 'timeout -k 10 91 bash -c' in (fake_slurm / 'submitted.sh').read_text()
+#end test_slurm_wraps_timeout()
@@ -0,0 +1,91 @@
+import json, os, pytest, socket, time
+
+from moseq2_build.utils import instance
+from moseq2_build.utils.constants import SINGULARITY_COMS
+from moseq2_build.utils.commands import executeCommand, buildContainerCommand
+from moseq2_build.auto.extract import buildExtractCommand
+
+@pytest.fixture
+def instance_dir(tmp_path, monkeypatch):
+	# The server runs in its own process, which finds its folder through HOME
+	home = tmp_path / 'h'
+	home.mkdir()
+	monkeypatch.setenv('HOME', str(home))
+	path = str(home / '.config' / 'moseq2_environment' / 'instances')
+	monkeypatch.setattr(instance, 'INSTANCE_DIR', path)
+	return path
+#end instance_dir()
+
+def test_instance_commands(fake_runtime, instance_dir, tmp_path):
+	instance.startInstance('test', fake_runtime, binds=[str(tmp_path)], workers=2)
+	try:
+		assert instance.isRunning('test')
+		assert [m['name'] for m in instance.listInstances()] == ['test']
+
+		(stdout, stderr), retCode = instance.runInInstance('test', 'echo $PWD; echo oops >&2; exit 4', cwd=str(tmp_path))
+		assert retCode == 4
+		assert stdout.decode().strip() == str(tmp_path)
+		assert stderr == b'oops\n'
+
+		# Commands built for the instance go through the client and keep their exit code
+		commands = instance.instanceCommands('test')
+		finalCommand = buildContainerCommand(commands, '', fake_runtime, 'moseq2-extract generate-config')
+		(stdout, stderr), retCode = executeCommand(finalCommand)
+		assert retCode == 0
+		assert b'moseq2-extract generate-config' in stdout
+
+		session = tmp_path / 'session'
+		session.mkdir()
+		(session / 'depth.dat').write_bytes(b'')
+		finalCommand = buildExtractCommand(fake_runtime, ['extract', str(session / 'depth.dat')], commands)
+		(stdout, stderr), retCode = executeCommand(finalCommand)
+		assert retCode == 0
+		assert (session / 'proc' / 'args.txt').exists()
+	finally:
+		instance.stopInstance('test')
+	assert not instance.isRunning('test')
+	assert instance.listInstances() == []
+#end test_instance_commands()
+
+def test_unbound_fallback(fake_runtime, instance_dir, tmp_path):
+	(tmp_path / 'bound').mkdir()
+	commands = instance.instanceCommands('test')
+	instance.startInstance('test', fake_runtime, binds=[str(tmp_path / 'bound')])
+	try:
+		for name in ('bound', 'outside'):
+			session = tmp_path / name / 'session'
+			session.mkdir(parents=True)
+			(session / 'depth.dat').write_bytes(b'')
+		inside = buildExtractCommand(fake_runtime, ['extract', str(tmp_path / 'bound' / 'session' / 'depth.dat')],
+			commands, [str(tmp_path / 'bound' / 'session')])
+		assert inside.startswith(commands['exec'])
+
+		# The instance cannot see the folder, so a new container runs the command
+		outside = buildExtractCommand(fake_runtime, ['extract', str(tmp_path / 'outside' / 'session' / 'depth.dat')],
+			commands, [str(tmp_path / 'outside' / 'session')])
+		assert outside.startswith('singularity exec -B ' + str(tmp_path / 'outside' / 'session'))
+		(stdout, stderr), retCode = executeCommand(outside)
+		assert retCode == 0
+		assert (tmp_path / 'outside' / 'session' / 'proc' / 'args.txt').exists()
+	finally:
+		instance.stopInstance('test')
+#end test_unbound_fallback()
+
+def test_cancel_on_disconnect(fake_runtime, instance_dir, tmp_path):
+	instance.startInstance('test', fake_runtime)
+	try:
+		socketPath, _ = instance.instancePaths('test')
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.connect(socketPath)
+			request = {'command': 'sleep 30 && touch done', 'cwd': str(tmp_path)}
+			sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+			time.sleep(0.5)
+		# The only warm shell is free again once the abandoned command was killed
+		start = time.time()
+		(stdout, stderr), retCode = instance.runInInstance('test', 'echo ok', cwd=str(tmp_path))
+		assert retCode == 0 and stdout == b'ok\n'
+		assert time.time() - start < 10
+		assert not (tmp_path / 'done').exists()
+	finally:
+		instance.stopInstance('test')
+#end test_cancel_on_disconnect()
@@ -0,0 +1,66 @@
+import json, os, pytest
+
+from moseq2_build.utils.constants import SINGULARITY_COMS, FAILURE_REPORT_NAME
+from moseq2_build.auto import journal as journalModule
+from moseq2_build.auto.journal import RunJournal, runWithRetries, isTransientFailure
+from moseq2_build.auto.schedule import scheduleExtractions
+from moseq2_build.auto.batch import doBatch
+from fakes import makeSession
+
+def test_journal_states(tmp_path):
+	journal = RunJournal(str(tmp_path / 'journal.jsonl'))
+	journal.record('a', 'running', attempt=1)
+	journal.record('a', 'done', returnCode=0)
+	journal.record('b', 'running', attempt=1)
+	with open(journal.path, 'a') as f:
+		f.write('{"session": "c", "sta')
+	assert journal.states()['a']['state'] == 'done'
+	assert journal.unfinished(['a', 'b', 'c']) == ['b', 'c']
+#end test_journal_states()
+
+def test_run_with_retries(monkeypatch):
+	monkeypatch.setattr(journalModule.time, 'sleep', lambda s: None)
+	codes = iter([255, 137, 0])
+	retries = []
+	assert runWithRetries(lambda n: next(codes), retries=3, onRetry=lambda *a: retries.append(a[:2])) == (0, 3)
+	assert retries == [(1, 255), (2, 137)]
+	assert runWithRetries(lambda n: 3, retries=3) == (3, 1)
+	assert runWithRetries(lambda n: -9, retries=1) == (-9, 2)
+	assert not isTransientFailure(0) and not isTransientFailure(1) and isTransientFailure(-1)
+#end test_run_with_retries()
+
+def test_schedule_retries_and_resumes(tmp_path, fake_runtime):
+	sessions = [makeSession(tmp_path, 'good'), makeSession(tmp_path, 'flaky'), makeSession(tmp_path, 'bad')]
+	journal = RunJournal(str(tmp_path / 'journal.jsonl'))
+	results = scheduleExtractions(fake_runtime, sessions, ['extract'], SINGULARITY_COMS, workers=3,
+		verbose=False, retries=2, backoff=0, journal=journal)
+	assert [(r['returnCode'], r['attempts']) for r in results] == [(0, 1), (0, 2), (3, 1)]
+	assert [e['state'] for e in journal.entries() if e['session'] == sessions[1]] == ['running', 'retrying', 'running', 'done']
+	assert journal.unfinished(sessions) == [sessions[2]]
+
+	resumed = RunJournal(journal.path)
+	results = scheduleExtractions(fake_runtime, sessions, ['extract'], SINGULARITY_COMS, workers=3,
+		verbose=False, journal=resumed, resume=True)
+	assert [r['skipped'] for r in results] == [True, True, False]
+	assert set(e['session'] for e in resumed.entries() if e['run'] == resumed.runId) == {sessions[2]}
+#end test_schedule_retries_and_resumes()
+
+def test_local_batch_reports_failures(tmp_path, fake_runtime):
+	makeSession(tmp_path / 'data', 'good')
+	makeSession(tmp_path / 'data', 'bad')
+	config = tmp_path / 'config.yaml'
+	config.write_text('fps: 30\n')
+	remainder = ['extract-batch', '-i', str(tmp_path / 'data'), '-c', str(config)]
+	with pytest.raises(SystemExit):
+		doBatch(fake_runtime, None, str(tmp_path), remainder, SINGULARITY_COMS, backoff=0)
+	with open(str(tmp_path / FAILURE_REPORT_NAME)) as f:
+		report = json.load(f)
+	assert [os.path.basename(os.path.dirname(r['session'])) for r in report['failed']] == ['bad']
+	assert (tmp_path / 'data' / 'good' / 'proc' / 'args.txt').exists()
+
+	# Resuming only runs the failed session again
+	os.remove(str(tmp_path / 'data' / 'good' / 'proc' / 'args.txt'))
+	with pytest.raises(SystemExit):
+		doBatch(fake_runtime, None, str(tmp_path), remainder, SINGULARITY_COMS, backoff=0, resume=True)
+	assert not (tmp_path / 'data' / 'good' / 'proc' / 'args.txt').exists()
+#end test_local_batch_reports_failures()
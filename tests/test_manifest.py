@@ -0,0 +1,57 @@
+import os
+
+from moseq2_build.utils.constants import SINGULARITY_COMS, MANIFEST_NAME
+from moseq2_build.auto.schedule import scheduleExtractions
+from moseq2_build.auto.manifest import sessionOutputDir, sessionFingerprint, filterChangedSessions
+from fakes import makeSessions
+
+def test_session_output_dir():
+	assert sessionOutputDir('/data/s1/depth.dat', ['extract']) == '/data/s1/proc'
+	assert sessionOutputDir('/data/s1/depth.dat', ['extract', '--output-dir', 'out']) == '/data/s1/out'
+#end test_session_output_dir()
+
+def test_fingerprint_reads_config(tmp_path):
+	session = makeSessions(tmp_path, [16])[0]
+	config = tmp_path / 'config.yaml'
+	config.write_text('flip_classifier: /flip.pkl\n')
+	fingerprint = sessionFingerprint(session, ['extract', session, '--config-file', str(config)], str(tmp_path / 'img.sif'))
+	assert fingerprint['flipClassifier'] == '/flip.pkl'
+	assert fingerprint['config'] == 'flip_classifier: /flip.pkl\n'
+	assert fingerprint['size'] == 16
+	assert session not in fingerprint['arguments']
+	assert 'hash' in sessionFingerprint(session, ['extract'], str(tmp_path / 'img.sif'), useHash=True)
+#end test_fingerprint_reads_config()
+
+def test_incremental_extraction(tmp_path, fake_runtime):
+	data = tmp_path / 'data'
+	data.mkdir()
+	sessions = makeSessions(data, [16] * 3)
+	config = tmp_path / 'config.yaml'
+	config.write_text('flip_classifier: /flip.pkl\n')
+	args = ['extract', '--config-file', str(config)]
+
+	results = scheduleExtractions(fake_runtime, sessions, args, SINGULARITY_COMS, workers=2, incremental=True)
+	assert [r['skipped'] for r in results] == [False] * 3
+	for session in sessions:
+		assert os.path.isfile(os.path.join(os.path.dirname(session), 'proc', MANIFEST_NAME))
+
+	extra = data / 'session_new'
+	extra.mkdir()
+	(extra / 'depth.dat').write_bytes(b'\1' * 16)
+	allSessions = sessions + [str(extra / 'depth.dat')]
+	results = scheduleExtractions(fake_runtime, allSessions, args, SINGULARITY_COMS, workers=2, incremental=True)
+	assert [r['skipped'] for r in results] == [True, True, True, False]
+
+	config.write_text('flip_classifier: /other.pkl\n')
+	changed, skipped, _ = filterChangedSessions(allSessions, lambda s: ['extract', s, '--config-file', str(config)], fake_runtime)
+	assert changed == allSessions and skipped == []
+#end test_incremental_extraction()
+
+def test_failed_extraction_leaves_no_manifest(tmp_path, fake_runtime):
+	bad = tmp_path / 'bad_session'
+	bad.mkdir()
+	(bad / 'depth.dat').write_bytes(b'\0')
+	results = scheduleExtractions(fake_runtime, [str(bad / 'depth.dat')], ['extract'], SINGULARITY_COMS, incremental=True)
+	assert results[0]['returnCode'] != 0
+	assert not (bad / 'proc' / MANIFEST_NAME).exists()
+#end test_failed_extraction_leaves_no_manifest()
@@ -0,0 +1,58 @@
+import json, os, pytest
+
+from moseq2_build.utils.download import createSession, DownloadError
+from moseq2_build.utils.release import downloadAssets, fetchReleaseInfo, selectAssets, syncMirror
+
+def test_release_info_is_revalidated(tmp_path, release_server):
+	session = createSession()
+	first = fetchReleaseInfo(session, release_server.url)
+	assert fetchReleaseInfo(session, release_server.url) == first
+	assert release_server.notModified == 1
+
+	# Without the server, the cached metadata is used
+	url = release_server.url
+	from fakes import stopReleaseServer
+	stopReleaseServer(release_server)
+	assert fetchReleaseInfo(session, url) == first
+	with pytest.raises(DownloadError):
+		fetchReleaseInfo(session, url, 'v2')
+#end test_release_info_is_revalidated()
+
+def test_assets_are_matched_by_name(release_server):
+	release = dict(release_server.release)
+	release['assets'] = [{'id': 3, 'name': 'moseq2-singularity.v1.tar.gz.sha256'}] + list(reversed(release['assets']))
+	docker, singularity = selectAssets(release, ['docker', 'singularity'])
+	assert (docker['id'], singularity['id']) == (1, 2)
+	with pytest.raises(DownloadError):
+		selectAssets({'tag_name': 'v1', 'assets': release['assets'][:2]}, ['docker'])
+#end test_assets_are_matched_by_name()
+
+def test_download_from_mirror(tmp_path, release_server):
+	mirror = tmp_path / 'mirror'
+	syncMirror(None, None, str(mirror), baseUrl=release_server.url)
+	assert json.loads((mirror / 'latest').read_text())['tag_name'] == 'v1'
+	assert (mirror / 'tags' / 'v1').exists() and sorted(os.listdir(str(mirror / 'assets'))) == ['1', '2']
+
+	# A second sync only revalidates the metadata
+	requests = len(release_server.requests)
+	syncMirror(None, None, str(mirror), baseUrl=release_server.url)
+	assert len(release_server.requests) == requests + 1
+
+	requests = len(release_server.requests)
+	out = tmp_path / 'out'
+	out.mkdir()
+	paths = downloadAssets(None, None, [1], str(out), 'v1', baseUrl=str(mirror))
+	assert paths == [str(out / 'moseq2-singularity.v1')]
+	assert (out / 'moseq2-singularity.v1' / 'image' / 'moseq2.sif').exists()
+	assert (mirror / 'assets' / '2').exists()
+	assert len(release_server.requests) == requests
+#end test_download_from_mirror()
+
+def test_mirror_rejects_corrupt_asset(tmp_path, release_server):
+	mirror = tmp_path / 'mirror'
+	syncMirror(None, None, str(mirror), baseUrl=release_server.url)
+	(mirror / 'assets' / '2').write_bytes(b'corrupt')
+	with pytest.raises(SystemExit):
+		downloadAssets(None, None, [1], str(tmp_path), None, baseUrl='file://' + str(mirror))
+	assert not (tmp_path / 'moseq2-singularity.v1').exists()
+#end test_mirror_rejects_corrupt_asset()
@@ -0,0 +1,49 @@
+import os
+
+from moseq2_build.utils import mount
+from moseq2_build.utils.mount import mountDirectories, planMounts, clearMountPlans
+
+def test_mount_common_folder(tmp_path):
+	clearMountPlans()
+	(tmp_path / 'data' / 's1').mkdir(parents=True)
+	(tmp_path / 'data' / 's2').mkdir(parents=True)
+	(tmp_path / 'data' / 's1' / 'depth.dat').write_bytes(b'')
+	remainder = ['extract', '--config-file', str(tmp_path / 'data' / 's2' / 'config.yaml')]
+	command = mountDirectories(remainder, '-B', ['--config-file'], [str(tmp_path / 'data' / 's1')])
+	assert command == '-B ' + str(tmp_path / 'data')
+	# Outputs that do not exist yet are covered by their closest existing folder
+	assert planMounts([str(tmp_path / 'data' / 's1' / 'proc' / 'results.h5')]) == [str(tmp_path / 'data' / 's1')]
+	assert mountDirectories(['--config-file', '/config.yaml'], '-B', ['--config-file']) == ''
+#end test_mount_common_folder()
+
+def test_mount_keeps_filesystems_apart(tmp_path, monkeypatch):
+	clearMountPlans()
+	(tmp_path / 'scratch').mkdir()
+	(tmp_path / 'project').mkdir()
+	# Pretend tmp_path is the root of a shared filesystem, which must not be mounted as a whole
+	monkeypatch.setattr(mount, 'mountPoint', lambda path: str(tmp_path))
+	assert planMounts([str(tmp_path / 'scratch'), str(tmp_path / 'project')]) == [str(tmp_path / 'project'),
+		str(tmp_path / 'scratch')]
+#end test_mount_keeps_filesystems_apart()
+
+def test_mount_symlinks(tmp_path):
+	clearMountPlans()
+	target = tmp_path / 'nfs' / 'session'
+	target.mkdir(parents=True)
+	(tmp_path / 'links').mkdir()
+	os.symlink(str(target), str(tmp_path / 'links' / 'session'))
+	linked = str(tmp_path / 'links' / 'session' / 'depth.dat')
+	assert planMounts([linked]) == ['{}:{}'.format(target, tmp_path / 'links' / 'session')]
+	# Once both the link and its target are mounted, the link needs no bind of its own
+	assert planMounts([linked, str(tmp_path / 'nfs'), str(tmp_path / 'links')]) == [str(tmp_path)]
+#end test_mount_symlinks()
+
+def test_mount_plans_are_cached(tmp_path, monkeypatch):
+	clearMountPlans()
+	calls = []
+	compute = mount._computePlan
+	monkeypatch.setattr(mount, '_computePlan', lambda paths: calls.append(paths) or compute(paths))
+	paths = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+	assert planMounts(paths) == planMounts(list(reversed(paths)))
+	assert len(calls) == 1
+#end test_mount_plans_are_cached()
@@ -0,0 +1,60 @@
+import os
+
+from moseq2_build.utils.constants import SINGULARITY_COMS
+from moseq2_build.auto.pipeline import planPipeline, runPipeline, paramArguments
+from fakes import makeSession
+
+def runLogged(logPath, image, sessions, outputDir, params=None, **kwargs):
+	if logPath.exists():
+		logPath.unlink()
+	steps = planPipeline(image, sessions, [], str(outputDir), params)
+	results = runPipeline(image, steps, SINGULARITY_COMS, workers=4, verbose=False, **kwargs)
+	calls = logPath.read_text().splitlines() if logPath.exists() else []
+	return {r['step']: r['state'] for r in results}, calls
+#end runLogged()
+
+def test_param_arguments():
+	assert paramArguments({'kappa': 1000, 'robust': True, 'skip': False, '-n': 5, 'command': 'x'}) == \
+		['-n', '5', '--kappa', '1000', '--robust']
+#end test_param_arguments()
+
+def test_pipeline_caches_stages(tmp_path, fake_runtime, monkeypatch):
+	logPath = tmp_path / 'calls.log'
+	monkeypatch.setenv('FAKE_PIPELINE_LOG', str(logPath))
+	sessions = [makeSession(tmp_path / 'data', 'a'), makeSession(tmp_path / 'data', 'b')]
+	outputDir = tmp_path / 'pipeline'
+
+	states, calls = runLogged(logPath, fake_runtime, sessions, outputDir, {'model': {'kappa': 10}})
+	assert set(states.values()) == {'done'} and len(states) == 7
+	assert len(calls) == 7
+	assert any(c.startswith('moseq2-model learn-model') and c.endswith('--kappa 10') for c in calls)
+	assert os.path.isfile(os.path.join(str(outputDir), 'model', 'latest', 'model.p'))
+
+	# Nothing changed, so nothing runs again
+	states, calls = runLogged(logPath, fake_runtime, sessions, outputDir, {'model': {'kappa': 10}})
+	assert set(states.values()) == {'cached'} and calls == []
+
+	# A new model parameter only reruns the model
+	states, calls = runLogged(logPath, fake_runtime, sessions, outputDir, {'model': {'kappa': 20}})
+	assert [name for name, state in states.items() if state == 'done'] == ['model']
+	assert len(calls) == 1 and calls[0].endswith('--kappa 20')
+	assert len(os.listdir(os.path.join(str(outputDir), 'model'))) == 3
+
+	states, calls = runLogged(logPath, fake_runtime, sessions, outputDir, {'model': {'kappa': 20}}, force=['train-pca'])
+	assert [name for name, state in states.items() if state == 'done'] == ['train-pca']
+#end test_pipeline_caches_stages()
+
+def test_pipeline_blocks_dependents_of_failures(tmp_path, fake_runtime, monkeypatch):
+	logPath = tmp_path / 'calls.log'
+	monkeypatch.setenv('FAKE_PIPELINE_LOG', str(logPath))
+	monkeypatch.setenv('FAKE_FAIL', 'apply-pca')
+	sessions = [makeSession(tmp_path / 'data', 'a')]
+	states, calls = runLogged(logPath, fake_runtime, sessions, tmp_path / 'pipeline')
+	assert states['apply-pca'] == 'failed' and states['model'] == 'blocked'
+	assert states['changepoints'] == 'done' and states['train-pca'] == 'done'
+
+	# Once the failure is fixed, only the failed and blocked stages run
+	monkeypatch.delenv('FAKE_FAIL')
+	states, calls = runLogged(logPath, fake_runtime, sessions, tmp_path / 'pipeline')
+	assert sorted(name for name, state in states.items() if state == 'done') == ['apply-pca', 'model']
+#end test_pipeline_blocks_dependents_of_failures()
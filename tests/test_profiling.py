@@ -0,0 +1,61 @@
+import json, os
+from click.testing import CliRunner
+
+from moseq2_build.cli import cli
+from moseq2_build.utils.constants import SINGULARITY_COMS
+from moseq2_build.utils.profiling import RunProfile, loadRunRecords, writeRunRecord, aggregateRunRecords
+from moseq2_build.auto.extract import doExtract
+
+def test_profiled_extract(tmp_path, fake_runtime, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	recordsPath = str(tmp_path / 'runs.jsonl')
+	configPath = str(tmp_path / 'config.yaml')
+	with RunProfile('generate-config', ['generate-config'], fake_runtime, str(tmp_path / 'run.csv'), recordsPath) as run:
+		doExtract(fake_runtime, '/flip.pkl', ['generate-config', '--output-file', configPath], SINGULARITY_COMS, profile=run)
+
+	record = run.record
+	assert record['returnCode'] == 0
+	assert record['imageDigest'].startswith('stat:')
+	assert set(record['phases']) == {'prepare', 'container-start', 'activation', 'generate-config', 'output'}
+	assert sum(record['phases'].values()) <= record['elapsed']
+	assert record['cpuUser'] + record['cpuSystem'] > 0 and record['peakRss'] > 0
+	assert len(run.markerPaths) == 1 and not os.path.exists(run.markerPaths[0])
+
+	# The history and the CSV copy hold the same record
+	fromHistory, fromCsv = loadRunRecords([recordsPath]), loadRunRecords([str(tmp_path / 'run.csv')])
+	assert fromHistory == [record]
+	assert fromCsv[0]['phases'] == record['phases'] and fromCsv[0]['peakRss'] == record['peakRss']
+#end test_profiled_extract()
+
+def test_failed_run_is_recorded(tmp_path, fake_runtime):
+	recordsPath = str(tmp_path / 'runs.jsonl')
+	try:
+		with RunProfile('extract', [], fake_runtime, recordsPath=recordsPath):
+			doExtract(fake_runtime, '/flip.pkl', ['extract', str(tmp_path / 'bad.dat')], SINGULARITY_COMS)
+	except SystemExit:
+		pass
+	assert [r['returnCode'] for r in loadRunRecords([recordsPath])] == [1]
+#end test_failed_run_is_recorded()
+
+def makeRecord(digest, started, elapsed, returnCode=0):
+	return {'command': 'extract', 'imageDigest': digest, 'image': '/img.sif', 'started': started, 'elapsed': elapsed,
+		'returnCode': returnCode, 'phases': {'extract': elapsed - 1}, 'cpuUser': 1.0, 'cpuSystem': 0.5,
+		'peakRss': 1024 ** 3, 'bytesRead': 10, 'bytesWritten': 20, 'arguments': []}
+#end makeRecord()
+
+def test_stats(tmp_path):
+	records = [makeRecord('sha256:old', 1, 10), makeRecord('sha256:old', 2, 12), makeRecord('sha256:new', 3, 15),
+		makeRecord('sha256:new', 4, 13, returnCode=2)]
+	summaries = aggregateRunRecords(records, 0.1)
+	assert [(s['imageDigest'], s['runs'], s['failures'], s['elapsed']) for s in summaries] == [
+		('sha256:old', 2, 0, 11), ('sha256:new', 2, 1, 14)]
+	assert not summaries[0]['regression'] and summaries[1]['regression']
+
+	path = str(tmp_path / 'runs.json')
+	writeRunRecord(records, path)
+	result = CliRunner().invoke(cli, ['stats', '--records', path, '--json'])
+	assert result.exit_code == 0
+	assert [s['imageDigest'] for s in json.loads(result.output)] == ['sha256:old', 'sha256:new']
+	result = CliRunner().invoke(cli, ['stats', '--records', path])
+	assert result.exit_code == 0 and 'extract' in result.output and '+27%' in result.output
+#end test_stats()
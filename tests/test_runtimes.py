@@ -0,0 +1,94 @@
+import os, pytest, tarfile
+
+from fakes import FAKE_DOCKER, writeScript, makeSession
+from moseq2_build.api import Runner, containerCommands
+from moseq2_build.utils import runtimes
+from moseq2_build.utils.mount import mountDirectories
+from moseq2_build.utils.runtimes import selectDriver, getDriver, RuntimeDriver
+from moseq2_build.env.shared import imageFileIn
+
+@pytest.fixture
+def fake_docker(fake_runtime, tmp_path, monkeypatch):
+	""" Adds a fake docker next to the fake singularity and returns the
+	path of a docker archive.
+	"""
+	writeScript(str(tmp_path / 'bin' / 'docker'), FAKE_DOCKER)
+	monkeypatch.setattr(runtimes, 'RUNTIME_IMAGES_PATH', str(tmp_path / 'runtime_images.json'))
+	archive = tmp_path / 'moseq2.tar'
+	archive.write_bytes(b'\0' * 16)
+	return str(archive)
+#end fake_docker()
+
+def test_select_driver(fake_docker, fake_runtime):
+	assert selectDriver(fake_runtime).name == 'singularity'
+	assert selectDriver(fake_docker).name == 'docker'
+	with pytest.raises(ValueError):
+		selectDriver(fake_docker, 'apptainer')
+	with pytest.raises(ValueError):
+		selectDriver(fake_docker, 'podman')
+	with pytest.raises(ValueError):
+		selectDriver('image.img')
+#end test_select_driver()
+
+def test_select_driver_for_folders(fake_docker, tmp_path):
+	dockerFolder = tmp_path / 'docker' / 'image'
+	(dockerFolder / 'layer').mkdir(parents=True)
+	(dockerFolder / 'manifest.json').write_text('[]')
+	(dockerFolder / 'repositories').write_text('{}')
+	sandbox = tmp_path / 'sandbox'
+	(sandbox / '.singularity.d').mkdir(parents=True)
+	assert selectDriver(str(dockerFolder)).name == 'docker'
+	assert selectDriver(str(sandbox)).name == 'singularity'
+	with pytest.raises(ValueError):
+		selectDriver(str(dockerFolder), 'singularity')
+	with pytest.raises(ValueError):
+		selectDriver(str(tmp_path / 'docker'))
+	# The release asset unpacks to "docker save" output, whose folder is the image
+	assert imageFileIn(str(tmp_path / 'docker')) == str(dockerFolder)
+	with pytest.raises(TypeError):
+		RuntimeDriver()
+#end test_select_driver_for_folders()
+
+def test_docker_image_is_loaded_once(fake_docker, tmp_path):
+	table = containerCommands(fake_docker, cpus=2, memoryGB=1.5)
+	assert table['image'] == 'sha256:feed'
+	assert table['mount'] == '-v' and table['fullBinds']
+	assert '--cpus=2' in table['exec'] and '--memory=1536m' in table['exec']
+	assert containerCommands(fake_docker)['image'] == 'sha256:feed'
+	assert (tmp_path / 'bin' / 'docker_state.loads').read_text().count('x') == 1
+	assert 'sha256:feed' in (tmp_path / 'runtime_images.json').read_text()
+#end test_docker_image_is_loaded_once()
+
+def test_docker_folder_is_streamed_into_load(fake_docker, tmp_path):
+	dockerFolder = tmp_path / 'image'
+	(dockerFolder / 'layer').mkdir(parents=True)
+	(dockerFolder / 'manifest.json').write_text('[]')
+	(dockerFolder / 'layer' / 'layer.tar').write_bytes(b'layer')
+	assert containerCommands(str(dockerFolder))['image'] == 'sha256:feed'
+	with tarfile.open(str(tmp_path / 'bin' / 'docker_state.stdin')) as tar:
+		names = [os.path.normpath(n) for n in tar.getnames()]
+	assert 'manifest.json' in names and os.path.join('layer', 'layer.tar') in names
+#end test_docker_folder_is_streamed_into_load()
+
+def test_singularity_has_no_resource_flags():
+	for name in ('singularity', 'apptainer'):
+		assert getDriver(name).resourceFlags(4, 8) == []
+	assert getDriver('podman').resourceFlags(None, None) == []
+#end test_singularity_has_no_resource_flags()
+
+def test_full_binds(tmp_path):
+	(tmp_path / 'data').mkdir()
+	path = str(tmp_path / 'data')
+	assert mountDirectories(['extract'], '-v', [], [path], fullBinds=True) == '-v {0}:{0}'.format(path)
+	assert mountDirectories(['extract'], '-B', [], [path]) == '-B {}'.format(path)
+#end test_full_binds()
+
+def test_extract_with_docker(fake_docker, tmp_path):
+	session = tmp_path / 'session_0'
+	result = Runner(fake_docker).extract(['extract', makeSession(tmp_path, session.name)], cwd=str(tmp_path))
+	assert result.ok, result.stderr
+	assert (session / 'proc' / 'args.txt').exists()
+	mounts = (tmp_path / 'bin' / 'docker_state.mounts').read_text().split()
+	assert '{0}:{0}'.format(tmp_path) in mounts
+	assert '--entrypoint=' in (tmp_path / 'bin' / 'docker_state.flags').read_text().split()
+#end test_extract_with_docker()
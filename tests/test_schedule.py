@@ -0,0 +1,37 @@
+import os
+
+from moseq2_build.utils.constants import SINGULARITY_COMS, SESSION_LOG_NAME
+from moseq2_build.auto.schedule import findSessions, sessionRemainder, scheduleExtractions
+from fakes import makeSession
+
+def test_find_sessions(tmp_path):
+	makeSession(tmp_path, 'session_1')
+	makeSession(tmp_path, 'session_2')
+	(tmp_path / 'empty').mkdir()
+	sessions = findSessions([str(tmp_path / 'session_*'), str(tmp_path / 'session_1')])
+	assert sessions == [str(tmp_path / 'session_1' / 'depth.dat'), str(tmp_path / 'session_2' / 'depth.dat')]
+	assert findSessions([str(tmp_path / 'empty')]) == []
+#end test_find_sessions()
+
+def test_session_remainder():
+	assert sessionRemainder('/d/depth.dat', ['extract', '--config-file', 'c.yaml']) == ['extract', '/d/depth.dat', '--config-file', 'c.yaml']
+	assert sessionRemainder('/d/depth.dat', []) == ['extract', '/d/depth.dat']
+#end test_session_remainder()
+
+def test_schedule_extractions(tmp_path, fake_runtime):
+	good = [tmp_path / 'session_{}'.format(i) for i in range(4)]
+	bad = tmp_path / 'bad_session'
+	for session in good + [bad]:
+		makeSession(tmp_path, session.name)
+	sessions = findSessions([str(tmp_path / '*')])
+	results = scheduleExtractions(fake_runtime, sessions, ['extract'], SINGULARITY_COMS, workers=3)
+
+	assert [r['session'] for r in results] == sessions
+	codes = {os.path.dirname(r['session']): r['returnCode'] for r in results}
+	assert codes[str(bad)] == 3
+	for session in good:
+		assert codes[str(session)] == 0
+		assert (session / 'proc' / 'args.txt').exists()
+		assert (session / SESSION_LOG_NAME).exists()
+	assert 'failed on' in (bad / SESSION_LOG_NAME).read_text()
+#end test_schedule_extractions()
@@ -0,0 +1,59 @@
+import hashlib, json, os, pytest
+
+from moseq2_build.utils import constants
+from moseq2_build.utils.prewarm import prewarmImage
+from moseq2_build.env import shared
+from moseq2_build.env.store import ImageStore, imageFingerprint
+
+@pytest.fixture
+def environment_config(tmp_path, monkeypatch):
+	path = str(tmp_path / 'config' / 'moseq2_environment.yaml')
+	monkeypatch.setattr(constants, 'ENVIRONMENT_CONFIG', path)
+	monkeypatch.setattr(shared, 'ENVIRONMENT_CONFIG', path)
+	return path
+#end environment_config()
+
+def test_install_and_attach_shared_image(tmp_path, environment_config):
+	image = tmp_path / 'moseq2.sif'
+	image.write_bytes(os.urandom(4096))
+	digest = 'sha256:' + hashlib.sha256(image.read_bytes()).hexdigest()
+	storeRoot = str(tmp_path / 'shared')
+
+	with pytest.raises(ValueError):
+		shared.installSharedImage(storeRoot, str(image), expectedDigest='sha256:' + '0' * 64)
+	installed = shared.installSharedImage(storeRoot, str(image), expectedDigest=digest.split(':')[1])
+	assert installed == os.path.join(ImageStore(storeRoot).imagePath(digest, 'moseq2'), 'image', 'moseq2.sif')
+	with open(os.path.join(storeRoot, 'default.json')) as f:
+		assert json.load(f)['digest'] == digest
+
+	shared.attachSharedStore(storeRoot)
+	assert constants.getDefaultImage() == installed
+	assert imageFingerprint(installed, store=ImageStore(str(tmp_path / 'own'))) == digest
+#end test_install_and_attach_shared_image()
+
+def test_attach_needs_an_installed_image(tmp_path, environment_config):
+	with pytest.raises(ValueError):
+		shared.attachSharedStore(str(tmp_path / 'empty'))
+#end test_attach_needs_an_installed_image()
+
+def test_make_readable_drops_shared_write(tmp_path):
+	(tmp_path / 'store' / 'images').mkdir(parents=True)
+	image = tmp_path / 'store' / 'images' / 'moseq2.sif'
+	image.write_bytes(b'image')
+	for path in (tmp_path / 'store', tmp_path / 'store' / 'images', image):
+		os.chmod(str(path), 0o770 if path.is_dir() else 0o660)
+	shared.makeReadable(str(tmp_path / 'store'))
+	assert os.stat(str(image)).st_mode & 0o777 == 0o644
+	assert os.stat(str(tmp_path / 'store' / 'images')).st_mode & 0o777 == 0o755
+#end test_make_readable_drops_shared_write()
+
+def test_prewarm(tmp_path):
+	image = tmp_path / 'moseq2.sif'
+	image.write_bytes(os.urandom(10000))
+	assert prewarmImage(str(image), threads=3, chunkSize=1024)[0] == 10000
+	sandbox = tmp_path / 'sandbox'
+	(sandbox / 'bin').mkdir(parents=True)
+	(sandbox / 'bin' / 'tool').write_bytes(b'x' * 100)
+	(sandbox / 'data').write_bytes(b'y' * 50)
+	assert prewarmImage(str(sandbox))[0] == 150
+#end test_prewarm()
@@ -0,0 +1,75 @@
+import os, pytest
+
+from moseq2_build.utils.constants import SINGULARITY_COMS
+from moseq2_build.auto import staging, schedule
+from moseq2_build.auto.staging import Stager
+from moseq2_build.auto.schedule import scheduleExtractions
+from fakes import makeSession
+
+def test_stage_session_copies_in_chunks(tmp_path, monkeypatch):
+	def noLink(source, destination):
+		raise OSError('cross-device link')
+	monkeypatch.setattr(staging.os, 'link', noLink)
+	depthFile = makeSession(tmp_path, 'session')
+	session = tmp_path / 'session'
+	# Random contents, so chunks copied to the wrong place would show
+	(session / 'depth.dat').write_bytes(os.urandom(1000))
+	(session / 'metadata.json').write_text('{}')
+	(session / 'depth.avi').write_bytes(b'other format')
+	(session / 'proc').mkdir()
+
+	stager = Stager(str(tmp_path / 'scratch'), copyThreads=3, chunkSize=64)
+	stager.start([depthFile])
+	staged = stager.get(depthFile)
+	assert staged.startswith(stager.root)
+	assert open(staged, 'rb').read() == (session / 'depth.dat').read_bytes()
+	assert sorted(os.listdir(os.path.dirname(staged))) == ['depth.dat', 'metadata.json']
+	stager.close()
+	assert not os.path.exists(stager.root)
+#end test_stage_session_copies_in_chunks()
+
+def test_schedule_staged_extractions(tmp_path, fake_runtime):
+	inputs = [makeSession(tmp_path, 'session_{}'.format(i)) for i in range(3)] + [makeSession(tmp_path, 'bad')]
+	sessions = [tmp_path / os.path.basename(os.path.dirname(s)) for s in inputs]
+	stager = Stager(str(tmp_path / 'scratch'), prefetch=1)
+	results = scheduleExtractions(fake_runtime, inputs, ['extract'], SINGULARITY_COMS, workers=2, stager=stager,
+		verbose=False)
+
+	assert [r['returnCode'] for r in results] == [0, 0, 0, 3]
+	for session in sessions[:3]:
+		# The extraction ran on the staged copy, its outputs were copied back
+		args = (session / 'proc' / 'args.txt').read_text()
+		assert args.startswith('extract ' + stager.root)
+	assert not (sessions[3] / 'proc').exists()
+	assert not os.path.exists(stager.root)
+#end test_schedule_staged_extractions()
+
+def test_schedule_removes_scratch_on_errors(tmp_path, fake_runtime, monkeypatch):
+	def broken(*args):
+		raise ValueError('broken worker')
+	monkeypatch.setattr(schedule, 'extractSession', broken)
+	stager = Stager(str(tmp_path / 'scratch'))
+	with pytest.raises(ValueError):
+		scheduleExtractions(fake_runtime, [makeSession(tmp_path, 'a')], ['extract'], SINGULARITY_COMS,
+			stager=stager, verbose=False)
+	assert not os.path.exists(stager.root) and stager.closed
+#end test_schedule_removes_scratch_on_errors()
+
+def test_finish_merges_into_existing_outputs(tmp_path):
+	depthFile = makeSession(tmp_path, 'session')
+	(tmp_path / 'session' / 'proc').mkdir()
+	(tmp_path / 'session' / 'proc' / 'notes.txt').write_text('kept')
+	stager = Stager(str(tmp_path / 'scratch'))
+	stager.start([depthFile])
+	staged = stager.get(depthFile)
+	stagedOutput = os.path.join(os.path.dirname(staged), 'proc')
+	os.makedirs(stagedOutput)
+	with open(os.path.join(stagedOutput, 'results_00.h5'), 'w') as f:
+		f.write('results')
+
+	stager.finish(depthFile, ['extract', depthFile])
+	proc = tmp_path / 'session' / 'proc'
+	assert sorted(os.listdir(str(proc))) == ['notes.txt', 'results_00.h5']
+	assert not os.path.exists(os.path.dirname(staged))
+	stager.close()
+#end test_finish_merges_into_existing_outputs()
@@ -0,0 +1,47 @@
+import subprocess, sys, pytest
+
+HEAVY_MODULES = ['requests', 'tqdm', 'ruamel.yaml', 'tarfile', 'termcolor']
+
+# Time in ms that importing the CLI may add on top of click itself
+IMPORT_BUDGET_MS = 25
+
+CHECK_HEAVY = '''
+import sys
+from moseq2_build.cli import cli
+try:
+    cli({args!r})
+except SystemExit:
+    pass
+print('HEAVY:' + ','.join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+@pytest.mark.parametrize('args', [[], ['--help'], ['extract', '--help'], ['batch', '--help'], ['env', '--help'], ['instance', '--help']])
+def test_help_is_lazy(args):
+	out = subprocess.run([sys.executable, '-c', CHECK_HEAVY.format(args=args, heavy=HEAVY_MODULES)],
+		stdout=subprocess.PIPE, check=True).stdout.decode()
+	assert out.splitlines()[-1] == 'HEAVY:'
+#end test_help_is_lazy()
+
+def importTimes(statement):
+	""" Runs python -X importtime and returns the cumulative import time in
+	microseconds of every top-level module.
+	"""
+	proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+		stderr=subprocess.PIPE, check=True)
+	times = {}
+	for line in proc.stderr.decode().splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		selfTime, cumulative, name = line[len('import time:'):].split('|')
+		times[name.strip()] = int(cumulative)
+	return times
+#end importTimes()
+
+def test_import_time_budget():
+	# Take the best of a few runs so a busy machine does not fail the test
+	overhead = []
+	for i in range(3):
+		times = importTimes('import click, moseq2_build.cli')
+		overhead.append(times['moseq2_build.cli'] / 1000.0)
+	assert min(overhead) < IMPORT_BUDGET_MS, 'importing moseq2_build.cli took {:.1f} ms'.format(min(overhead))
+#end test_import_time_budget()
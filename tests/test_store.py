@@ -0,0 +1,47 @@
+import os
+
+from moseq2_build.env.store import ImageStore
+from moseq2_build.utils.release import downloadAssets
+
+def unpacked(tmp_path, name, size):
+	path = tmp_path / name
+	(path / 'image').mkdir(parents=True)
+	(path / 'image' / 'moseq2.sif').write_bytes(b'\0' * size)
+	return str(path)
+#end unpacked()
+
+def test_add_and_lookup(tmp_path):
+	store = ImageStore(str(tmp_path / 'store'))
+	path = store.add('sha256:aa', 'v1', 'moseq2-singularity.v1.tar.gz', unpacked(tmp_path, 'a', 10))
+	assert path == str(tmp_path / 'store' / 'sha256' / 'aa' / 'moseq2-singularity.v1')
+	assert os.path.isfile(os.path.join(path, 'image', 'moseq2.sif'))
+	assert store.lookup('v1', 'moseq2-singularity.v1.tar.gz') == path
+	assert store.lookup(digest='sha256:aa') == path
+	assert store.lookup('v2', 'moseq2-singularity.v2.tar.gz') is None
+#end test_add_and_lookup()
+
+def test_evicts_least_recently_used(tmp_path):
+	store = ImageStore(str(tmp_path / 'store'))
+	a = store.add('sha256:aa', 'v1', 'moseq2-singularity.v1.tar.gz', unpacked(tmp_path, 'a', 100))
+	b = store.add('sha256:bb', 'v2', 'moseq2-singularity.v2.tar.gz', unpacked(tmp_path, 'b', 100))
+	c = store.add('sha256:cc', 'v3', 'moseq2-singularity.v3.tar.gz', unpacked(tmp_path, 'c', 100))
+	store.lookup(digest='sha256:aa')
+
+	# b is the least recently used, c is kept explicitly
+	assert store.evict(150, keep=[os.path.join(c, 'image', 'moseq2.sif')]) == ['sha256:bb', 'sha256:aa']
+	assert not os.path.exists(a) and not os.path.exists(b)
+	assert os.path.exists(c)
+	assert [d for d, e in store.entries()] == ['sha256:cc']
+	assert store.lookup('v1', 'moseq2-singularity.v1.tar.gz') is None
+#end test_evicts_least_recently_used()
+
+def test_download_skips_stored_images(tmp_path, release_server):
+	store = ImageStore(str(tmp_path / 'store'))
+	first = downloadAssets(None, None, [1], str(tmp_path), 'v1', baseUrl=release_server.url, store=store)
+	assert first[0].startswith(store.root)
+	downloads = len([p for p, r in release_server.requests if '/assets/' in p])
+
+	second = downloadAssets(None, None, [1], str(tmp_path), 'v1', baseUrl=release_server.url, store=store)
+	assert second == first
+	assert len([p for p, r in release_server.requests if '/assets/' in p]) == downloads
+#end test_download_skips_stored_images()
@@ -0,0 +1,123 @@
+import json, os, subprocess, pytest
+
+from moseq2_build.utils.constants import SINGULARITY_COMS, BATCH_JOBS_NAME
+from moseq2_build.auto.batch import parseBatchArgs, doBatch
+from moseq2_build.auto.submit import findBatchSessions, packSessions, describeJobs, LocalBackend, SlurmBackend
+from fakes import makeSessions
+
+def test_parse_batch_args():
+	options, extra = parseBatchArgs(['extract-batch', '-i', 'data', '--cluster-type', 'slurm', '--bg-roi-depth-range', '650', '750'])
+	assert options['inputDir'] == 'data'
+	assert options['clusterType'] == 'slurm'
+	assert options['configFile'] is None
+	assert extra == ['--bg-roi-depth-range', '650', '750']
+
+	# Only the first argument can be the cluster type, later ones are values
+	options, extra = parseBatchArgs(['extract-batch', 'slurm', '-i', 'data'])
+	assert options['clusterType'] == 'slurm' and extra == []
+	options, extra = parseBatchArgs(['extract-batch', '--camera-type', 'slurm'])
+	assert options['clusterType'] == 'local' and extra == ['--camera-type', 'slurm']
+	for args in (['extract-batch', '--ncpus', '4'], ['--mem=5000'], ['--cluster-type', 'pbs'], ['-i']):
+		with pytest.raises(ValueError):
+			parseBatchArgs(args)
+#end test_parse_batch_args()
+
+def test_pack_sessions_balances_size(tmp_path):
+	sessions = makeSessions(tmp_path / 'data', [900, 500, 400, 300, 200, 100])
+	jobs = packSessions(sessions, sessionsPerJob=3)
+	assert len(jobs) == 2
+	sizes = [sum(os.path.getsize(s) for s in job) for job in jobs]
+	assert sorted(sizes) == [1200, 1200]
+	assert sorted(s for job in jobs for s in job) == sorted(sessions)
+#end test_pack_sessions_balances_size()
+
+def test_find_batch_sessions_skips_outputs(tmp_path):
+	sessions = makeSessions(tmp_path / 'data', [10, 10])
+	(tmp_path / 'data' / 'session_0' / 'proc').mkdir()
+	(tmp_path / 'data' / 'session_0' / 'proc' / 'depth.dat').write_bytes(b'')
+	assert findBatchSessions(str(tmp_path / 'data'), 'depth.dat') == sessions
+#end test_find_batch_sessions_skips_outputs()
+
+def test_slurm_backend(tmp_path, fake_slurm):
+	sessions = makeSessions(tmp_path / 'data', [30, 20, 10])
+	resources = {'cpus': 2, 'mem': 7.5, 'time': '2:00:00', 'partition': 'main'}
+	jobs = describeJobs('/images/moseq2.sif', sessions, ['extract'], SINGULARITY_COMS, 1, resources)
+	backend = SlurmBackend(str(tmp_path), concurrency=2, prewarm='/images/moseq2.sif', queryBackoff=0)
+	jobId = backend.submit(jobs)
+	assert jobId == '4242'
+
+	script = (fake_slurm / 'submitted.sh').read_text()
+	assert '#SBATCH --array=0-2%2' in script
+	assert '#SBATCH --mem=8G' in script
+	assert '#SBATCH --partition=main' in script
+	assert '-m moseq2_build.utils.prewarm /images/moseq2.sif' in script
+	for session in sessions:
+		assert 'moseq2-extract extract ' + session in script
+	assert subprocess.call(['bash', '-n', str(tmp_path / 'run_batch.sh')]) == 0
+
+	(fake_slurm / 'queue').write_text('4242_0 RUNNING\n4242_1 PENDING\n')
+	assert backend.pendingTasks(jobId) == {'4242_0': 'RUNNING', '4242_1': 'PENDING'}
+	(fake_slurm / 'accounting').write_text('4242_0|COMPLETED|0:0\n4242_1|FAILED|1:0\n4242_2|COMPLETED|0:0\n')
+	assert backend.wait(jobId, interval=0) == {'4242_1': ('FAILED', '1:0')}
+	assert backend.pendingTasks(jobId) == {}
+#end test_slurm_backend()
+
+def test_slurm_queries_retry(tmp_path, fake_slurm):
+	backend = SlurmBackend(str(tmp_path), queryRetries=2, queryBackoff=0)
+	# A queue that cannot be read is not an empty queue
+	(fake_slurm / 'failures').write_text('1\n2\n')
+	(fake_slurm / 'queue').write_text('4242_0 RUNNING\n')
+	assert backend.pendingTasks('4242') == {'4242_0': 'RUNNING'}
+	(fake_slurm / 'failures').write_text('1\n2\n3\n')
+	with pytest.raises(RuntimeError):
+		backend.pendingTasks('4242')
+	# Without accounting there is no telling whether the tasks succeeded
+	with pytest.raises(RuntimeError):
+		backend.wait('4242', interval=0)
+#end test_slurm_queries_retry()
+
+def test_batch_wait_fails_with_failed_tasks(tmp_path, fake_runtime, fake_slurm, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	makeSessions(tmp_path / 'data', [16, 16])
+	config = tmp_path / 'config.yaml'
+	config.write_text('flip_classifier: none\n')
+	(fake_slurm / 'accounting').write_text('4242_0|COMPLETED|0:0\n4242_1|FAILED|1:0\n')
+	with pytest.raises(SystemExit) as e:
+		doBatch(fake_runtime, None, str(tmp_path), ['extract-batch', 'slurm', '-i', str(tmp_path / 'data'),
+			'-c', str(config)], SINGULARITY_COMS, submit=True, wait=True)
+	assert e.value.code == 1
+#end test_batch_wait_fails_with_failed_tasks()
+
+def test_local_backend(tmp_path, fake_runtime):
+	sessions = makeSessions(tmp_path / 'data', [10, 20, 30])
+	jobs = describeJobs(fake_runtime, sessions, ['extract'], SINGULARITY_COMS, 2)
+	results = LocalBackend(concurrency=2, logDir=str(tmp_path / 'logs')).submit(jobs)
+	assert sorted(code for r in results for code in r['returnCodes']) == [0, 0, 0]
+	for session in sessions:
+		assert os.path.exists(os.path.join(os.path.dirname(session), 'proc', 'args.txt'))
+#end test_local_backend()
+
+def test_do_batch_writes_job_descriptions(tmp_path, fake_runtime):
+	sessions = makeSessions(tmp_path / 'data', [10, 20])
+	config = tmp_path / 'config.yaml'
+	config.write_text('flip_classifier: none\n')
+	doBatch(fake_runtime, None, str(tmp_path), ['extract-batch', '-i', str(tmp_path / 'data'), '-c', str(config)], SINGULARITY_COMS)
+	with open(str(tmp_path / BATCH_JOBS_NAME)) as f:
+		jobs = json.load(f)
+	assert sorted(s for job in jobs for s in job['sessions']) == sessions
+	args = (tmp_path / 'data' / 'session_0' / 'proc' / 'args.txt').read_text()
+	assert '--config-file ' + str(config) in args
+#end test_do_batch_writes_job_descriptions()
+
+def test_incremental_batch(tmp_path, fake_runtime):
+	sessions = makeSessions(tmp_path / 'data', [10, 20])
+	config = tmp_path / 'config.yaml'
+	config.write_text('flip_classifier: none\n')
+	remainder = ['extract-batch', '-i', str(tmp_path / 'data'), '-c', str(config)]
+	doBatch(fake_runtime, None, str(tmp_path), remainder, SINGULARITY_COMS, incremental=True)
+	os.remove(str(tmp_path / BATCH_JOBS_NAME))
+
+	# Nothing changed, so no jobs are described the second time
+	doBatch(fake_runtime, None, str(tmp_path), remainder, SINGULARITY_COMS, incremental=True)
+	assert not os.path.exists(str(tmp_path / BATCH_JOBS_NAME))
+#end test_incremental_batch()